@@ -1,12 +1,22 @@
 """Tbw."""
 
 import fnmatch
+import hashlib
+import json
 import os
 import traceback
-from xml.etree.ElementTree import Element, ElementTree, SubElement
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+from xml.etree.ElementTree import Element, ElementTree, SubElement, fromstring, tostring
 
 import apsim.wrapper as apsim
 import pandas as pd
+from apsim.output_profiles import output_profile as get_output_profile
+from apsim.output_store import remove_archived_outputs, remove_output, remove_outputs
+from apsim.progress import ProgressTracker, TerminalProgress
+from apsim.run_manifest import MANIFEST_FILENAME, RunManifest, describe_job
+from apsim.sim_converter import convert_simulation, model_folder
+from apsim.soils import fetch_soil_properties
 
 ###!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!###
 # Set all of the json mgmt keys to be parsed over
@@ -30,6 +40,14 @@ row_spacing_key = "row_spacing"
 # harvest keys
 harvest_crop_key = "harvest"
 harvest_date_key = "harvest_date"
+# stand-ins for what differs between mukeys in a SimulationTemplate
+MUKEY_PLACEHOLDER = "FORESITE_MUKEY"
+MUKEY_PLACEHOLDER_BYTES = MUKEY_PLACEHOLDER.encode("us-ascii")
+SOIL_PLACEHOLDER = "foresite_soil"
+ROTATIONS = ["cfs", "sfc", "cc"]
+# (rotation, years, management keys) -> serialized Manager folder, see management_xml
+MANAGEMENT_CACHE_SIZE = 64
+_management_cache = {}
 
 
 def add_crop_ini(crop, crop_xml=None):
@@ -81,6 +99,609 @@ def get_rot_year_two(years):
     return years[1::2]
 
 
+def build_management_xml(rotation, start_year, end_year, sfc_mgmt=None, cfs_mgmt=None, cc_mgmt=None):
+    """Builds the Manager folder with the operations schedule of a rotation, see create_mukey_runs for the arguments.
+
+    Raises:
+        ValueError: for an unknown rotation, or a number of years not divisible by 3
+
+    Returns:
+        [Element]: the Manager folder
+    """
+    op_man = apsim.OpManager()
+    op_man.add_empty_manager()
+    # get range of years for runs and keep each management year as a list
+    num_years = end_year - start_year
+    years_range = list(range(start_year, end_year + 1))
+    rot_years_one = get_rot_year_one(years_range)
+    rot_years_two = get_rot_year_two(years_range)
+    rot_every_year = years_range[::1]
+    if num_years % 3 == 0:
+        if rotation == "cfs":
+            for i in rot_years_one:
+                # --- add ops for soybean in year 1 ---#
+                # add tillage operations
+                sfc_tillage_df = apsim.man.create_tillage_df(
+                    sfc_mgmt,
+                    tillage_implement_key,
+                    tillage_depth_key,
+                    tillage_f_incorp_key,
+                    tillage_date_key,
+                    i,
+                )
+                apsim.man.add_tillage_ops(sfc_tillage_df, op_man)
+                # add planting operations
+                sfc_planting_df = apsim.man.create_planting_df(
+                    sfc_mgmt,
+                    plant_crop_key,
+                    cultivar_key,
+                    sowing_density_key,
+                    sowing_depth_key,
+                    row_spacing_key,
+                    planting_date_key,
+                    i,
+                )
+                apsim.man.add_planting_ops(sfc_planting_df, op_man)
+                # add fert operations
+                sfc_fert_df = apsim.man.create_fert_df(
+                    sfc_mgmt,
+                    fert_amount_key,
+                    fert_formula_key,
+                    fert_depth_key,
+                    fert_date_key,
+                    i,
+                )
+                apsim.man.add_fert_ops(sfc_fert_df, op_man)
+                # add harvest operations
+                sfc_harvest_df = apsim.man.create_harvest_df(sfc_mgmt, harvest_crop_key, harvest_date_key, i)
+                apsim.man.add_harvest_ops(sfc_harvest_df, op_man)
+            for i in rot_years_two:
+                # --- add ops for corn in year 2 ---#
+                # add tillage operations
+                cfs_tillage_df = apsim.man.create_tillage_df(
+                    cfs_mgmt,
+                    tillage_implement_key,
+                    tillage_depth_key,
+                    tillage_f_incorp_key,
+                    tillage_date_key,
+                    i,
+                )
+                apsim.man.add_tillage_ops(cfs_tillage_df, op_man)
+                # add planting operations
+                cfs_planting_df = apsim.man.create_planting_df(
+                    cfs_mgmt,
+                    plant_crop_key,
+                    cultivar_key,
+                    sowing_density_key,
+                    sowing_depth_key,
+                    row_spacing_key,
+                    planting_date_key,
+                    i,
+                )
+                apsim.man.add_planting_ops(cfs_planting_df, op_man)
+                # add fert operations
+                cfs_fert_df = apsim.man.create_fert_df(
+                    cfs_mgmt,
+                    fert_amount_key,
+                    fert_formula_key,
+                    fert_depth_key,
+                    fert_date_key,
+                    i,
+                )
+                apsim.man.add_fert_ops(cfs_fert_df, op_man)
+                # add harvest operations
+                cfs_harvest_df = apsim.man.create_harvest_df(cfs_mgmt, harvest_crop_key, harvest_date_key, i)
+                apsim.man.add_harvest_ops(cfs_harvest_df, op_man)
+        elif rotation == "sfc":
+            for i in rot_years_one:
+                # --- add ops for corn in year 1 ---#
+                # add tillage operations
+                cfs_tillage_df = apsim.man.create_tillage_df(
+                    cfs_mgmt,
+                    tillage_implement_key,
+                    tillage_depth_key,
+                    tillage_f_incorp_key,
+                    tillage_date_key,
+                    i,
+                )
+                apsim.man.add_tillage_ops(cfs_tillage_df, op_man)
+                # add planting operations
+                cfs_planting_df = apsim.man.create_planting_df(
+                    cfs_mgmt,
+                    plant_crop_key,
+                    cultivar_key,
+                    sowing_density_key,
+                    sowing_depth_key,
+                    row_spacing_key,
+                    planting_date_key,
+                    i,
+                )
+                apsim.man.add_planting_ops(cfs_planting_df, op_man)
+                # add fert operations
+                cfs_fert_df = apsim.man.create_fert_df(
+                    cfs_mgmt,
+                    fert_amount_key,
+                    fert_formula_key,
+                    fert_depth_key,
+                    fert_date_key,
+                    i,
+                )
+                apsim.man.add_fert_ops(cfs_fert_df, op_man)
+                # add harvest operations
+                cfs_harvest_df = apsim.man.create_harvest_df(cfs_mgmt, harvest_crop_key, harvest_date_key, i)
+                apsim.man.add_harvest_ops(cfs_harvest_df, op_man)
+            for i in rot_years_two:
+                # --- add ops for soybeans in year 2 ---#
+                # add tillage operations
+                sfc_tillage_df = apsim.man.create_tillage_df(
+                    sfc_mgmt,
+                    tillage_implement_key,
+                    tillage_depth_key,
+                    tillage_f_incorp_key,
+                    tillage_date_key,
+                    i,
+                )
+                apsim.man.add_tillage_ops(sfc_tillage_df, op_man)
+                # add planting operations
+                sfc_planting_df = apsim.man.create_planting_df(
+                    sfc_mgmt,
+                    plant_crop_key,
+                    cultivar_key,
+                    sowing_density_key,
+                    sowing_depth_key,
+                    row_spacing_key,
+                    planting_date_key,
+                    i,
+                )
+                apsim.man.add_planting_ops(sfc_planting_df, op_man)
+                # add fert operations
+                sfc_fert_df = apsim.man.create_fert_df(
+                    sfc_mgmt,
+                    fert_amount_key,
+                    fert_formula_key,
+                    fert_depth_key,
+                    fert_date_key,
+                    i,
+                )
+                apsim.man.add_fert_ops(sfc_fert_df, op_man)
+                # add harvest operations
+                sfc_harvest_df = apsim.man.create_harvest_df(sfc_mgmt, harvest_crop_key, harvest_date_key, i)
+                apsim.man.add_harvest_ops(sfc_harvest_df, op_man)
+        elif rotation == "cc":
+            for i in rot_every_year:
+                # --- add cc ops every year---#
+                # add tillage operations
+                cc_tillage_df = apsim.man.create_tillage_df(
+                    cc_mgmt,
+                    tillage_implement_key,
+                    tillage_depth_key,
+                    tillage_f_incorp_key,
+                    tillage_date_key,
+                    i,
+                )
+                apsim.man.add_tillage_ops(cc_tillage_df, op_man)
+                # add planting operations
+                cc_planting_df = apsim.man.create_planting_df(
+                    cc_mgmt,
+                    plant_crop_key,
+                    cultivar_key,
+                    sowing_density_key,
+                    sowing_depth_key,
+                    row_spacing_key,
+                    planting_date_key,
+                    i,
+                )
+                apsim.man.add_planting_ops(cc_planting_df, op_man)
+                # add fert operations
+                cc_fert_df = apsim.man.create_fert_df(
+                    cc_mgmt,
+                    fert_amount_key,
+                    fert_formula_key,
+                    fert_depth_key,
+                    fert_date_key,
+                    i,
+                )
+                apsim.man.add_fert_ops(cc_fert_df, op_man)
+                # add harvest operations
+                cc_harvest_df = apsim.man.create_harvest_df(cc_mgmt, harvest_crop_key, harvest_date_key, i)
+                apsim.man.add_harvest_ops(cc_harvest_df, op_man)
+        else:
+            raise ValueError(f"Unknown rotation {rotation}, use one of {ROTATIONS}.")
+    else:
+        raise ValueError("The total number of simulation years should be divisble by 3.")
+    return op_man.man_xml
+
+
+def management_key(mgmt):
+    """Serializes a management dict as a cache key. The key order is kept, it sets the order of the operations, and
+    values JSON can't represent (numpy and pandas scalars, dates) are keyed by their type and repr, so they never
+    share a key with a str or int that would build different operations."""
+    return json.dumps(mgmt, default=lambda value: f"{type(value).__module__}.{type(value).__qualname__}:{value!r}")
+
+
+def management_xml(rotation, start_year, end_year, sfc_mgmt=None, cfs_mgmt=None, cc_mgmt=None):
+    """Returns the Manager folder of build_management_xml, built once per rotation, management and year range and
+    reused for every soil and field that shares them. Each call gets its own copy to add to a simulation.
+    """
+    key = (rotation, start_year, end_year) + tuple(management_key(mgmt) for mgmt in [sfc_mgmt, cfs_mgmt, cc_mgmt])
+    if key not in _management_cache:
+        if len(_management_cache) >= MANAGEMENT_CACHE_SIZE:
+            _management_cache.pop(next(iter(_management_cache)))
+        # built from the dicts as given, the key only tells them apart
+        _management_cache[key] = tostring(build_management_xml(rotation, start_year, end_year, sfc_mgmt, cfs_mgmt, cc_mgmt), encoding="us-ascii")
+    return fromstring(_management_cache[key])
+
+
+def build_mukey_simulation(
+    soil_id,
+    soil_xml,
+    field_name,
+    rotation,
+    met_name,
+    met_path,
+    start_year,
+    end_year,
+    sfc_mgmt=None,
+    cfs_mgmt=None,
+    cc_mgmt=None,
+    swim=False,
+    saxton=False,
+    maize_xml=None,
+    soy_xml=None,
+    output_profile="daily-full",
+    output_precision=5,
+):
+    """Builds the <simulation> of one SSURGO mukey, see create_mukey_runs for the arguments.
+
+    Args:
+        soil_id (str): SSURGO mukey
+        soil_xml (Element): the mukey's <Soil>, see apsim.wrapper.Soil
+        met_path (str): met file path relative to the runs folder
+
+    Raises:
+        ValueError: for an unknown rotation, or a number of years not divisible by 3
+
+    Returns:
+        [Element]: the simulation, named name_{field_name}_mukey_{soil_id}_rot_{rotation}_sim
+    """
+    start_date = f"01/01/{start_year}"
+    end_date = f"31/12/{end_year}"
+    sim = Element("simulation")
+    sim.set("name", f"name_{field_name}_mukey_{soil_id}_rot_{rotation}_sim")
+
+    # set met file
+    metfile = SubElement(sim, "metfile")
+    metfile.set("name", met_name)
+    filename = SubElement(metfile, "filename")
+    filename.set("name", "filename")
+    filename.set("input", "yes")
+    filename.text = met_path
+
+    # set clock
+    clock = SubElement(sim, "clock")
+    clock_start = SubElement(clock, "start_date")
+    clock_start.set("type", "date")
+    clock_start.set("description", "Enter the start date of the simulation")
+    clock_start.text = start_date
+    clock_end = SubElement(clock, "end_date")
+    clock_end.set("type", "date")
+    clock_end.set("description", "Enter the end date of the simulation")
+    clock_end.text = end_date
+    sumfile = SubElement(sim, "summaryfile")
+    area = SubElement(sim, "area")
+    area.set("name", "paddock")
+
+    # add soil xml
+    area.append(soil_xml)
+    ### surface om
+    if rotation == "cfs":
+        surfom_xml = apsim.init_surfaceOM("soybean", "soybean", 1250, 27, 0.0)
+    else:
+        surfom_xml = apsim.init_surfaceOM("maize", "maize", 3500, 65, 0.0)
+    area.append(surfom_xml)
+    ### fertilizer
+    fert_xml = SubElement(area, "fertiliser")
+    ### crops
+    curr_dir = os.getcwd()
+    crop_xml = SubElement(area, "maize")
+    maize_path = os.path.join(curr_dir, maize_xml)
+    add_crop_ini(crop_xml, maize_path)
+    crop_xml = SubElement(area, "soybean")
+    soy_path = os.path.join(curr_dir, soy_xml)
+    add_crop_ini(crop_xml, soy_path)
+    # crop_xml = SubElement( area, 'maize' )
+    # add_crop_ini(crop_xml, maize_xml)
+    # crop_xml = SubElement( area, 'soybean' )
+    # add_crop_ini(crop_xml, soy_xml)
+    # crop_xml = SubElement( area, 'wheat' )
+
+    ### output file
+    outvars, out_events = get_output_profile(output_profile, swim)
+    output_xml = apsim.set_output_variables(
+        f"name_{field_name}_mukey_{soil_id}_rot_{rotation}_sim.out",
+        outvars,
+        out_events,
+        output_precision,
+    )
+    area.append(output_xml)
+    graph_no3 = [
+        "Cumulative subsurface_drain",
+        "Cumulative subsurface_drain_no3",
+        "Cumulative leach_no3",
+        "Cumulative Rain",
+        "Cumulative drain",
+    ]
+    graph_yield = [
+        "soybean_yield",
+        "maize_yield",
+        "soybean_biomass",
+        "maize_biomass",
+        "soy_buac",
+        "corn_buac",
+        "soy_mktyd",
+        "maz_mktyd",
+        "soy_ymgha",
+        "maz_ymgha",
+    ]
+    graph_all = [
+        "soybean_yield",
+        "maize_yield",
+        "soybean_biomass",
+        "maize_biomass",
+        "corn_buac",
+        "soy_buac",
+        "soy_mktyd",
+        "maz_mktyd",
+        "soy_ymgha",
+        "maz_ymgha",
+        "fertiliser",
+        "surfaceom_c",
+        "subsurface_drain",
+        "subsurface_drain_no3",
+        "leach_no3",
+        "Rain",
+        "drain",
+    ]
+
+    output_xml.append(apsim.add_xy_graph("Date", graph_no3, "no3"))
+    output_xml.append(apsim.add_xy_graph("Date", graph_yield, "yield"))
+    output_xml.append(apsim.add_xy_graph("Date", graph_all, "all outputs"))
+
+    area.append(management_xml(rotation, start_year, end_year, sfc_mgmt, cfs_mgmt, cc_mgmt))
+    return sim
+
+
+def split_at_mukey(data):
+    """Splits serialized XML at each mukey placeholder.
+
+    Returns:
+        [tuple]: (pieces between the placeholders, for each placeholder True if it is in an attribute value)
+    """
+    pieces = data.split(MUKEY_PLACEHOLDER_BYTES)
+    in_attribute = []
+    serialized = b""
+    for piece in pieces[:-1]:
+        serialized += piece
+        # < and > are escaped everywhere but in tags
+        in_attribute.append(serialized.rfind(b"<") > serialized.rfind(b">"))
+    return pieces, in_attribute
+
+
+def serialized_mukey(soil_id):
+    """Returns a mukey as ElementTree writes it in an attribute value and in text (which differ in escaped quotes
+    and whitespace), taken from ElementTree itself so they match a simulation built from scratch."""
+    elem = Element("m", {"n": str(soil_id)})
+    elem.text = str(soil_id)
+    attribute, text = tostring(elem, encoding="us-ascii")[len(b'<m n="') : -len(b"</m>")].split(b'">', 1)
+    return {True: attribute, False: text}
+
+
+def join_at_mukey(pieces, in_attribute, mukey):
+    parts = [pieces[0]]
+    for piece, attribute in zip(pieces[1:], in_attribute):
+        parts += [mukey[attribute], piece]
+    return b"".join(parts)
+
+
+class SimulationTemplate:
+    """A create_mukey_runs simulation serialized once per field, rotation, years and management, with placeholders
+    for the two things that differ between mukeys: the <Soil> and the mukey in the simulation and output names. Each
+    mukey's simulation is the template's bytes with those spliced in, the same bytes ElementTree would write for a
+    simulation built from scratch, without building and serializing the metfile, clock, crops, output graphs and
+    management operations again.
+
+    Args:
+        sim_settings (dict): build_mukey_simulation arguments other than soil_id and soil_xml
+    """
+
+    ###
+    def __init__(self, sim_settings):
+        self.field_name = sim_settings["field_name"]
+        self.rotation = sim_settings["rotation"]
+        self.end_year = sim_settings["end_year"]
+        self.swim = sim_settings.get("swim", False)
+        self.saxton = sim_settings.get("saxton", False)
+        soil_placeholder = tostring(Element(SOIL_PLACEHOLDER), encoding="us-ascii")
+        sim = build_mukey_simulation(MUKEY_PLACEHOLDER, Element(SOIL_PLACEHOLDER), **sim_settings)
+        self.head, self.tail = tostring(sim, encoding="us-ascii").split(soil_placeholder)
+        # the pieces around each mukey placeholder, and whether it sits in an attribute value or in text
+        self.head_pieces, self.head_in_attribute = split_at_mukey(self.head)
+        self.tail_pieces, self.tail_in_attribute = split_at_mukey(self.tail)
+        apsim_xml = Element("folder")
+        apsim_xml.set("version", "36")
+        apsim_xml.set("creator", "C-CHANGE Foresite")
+        apsim_xml.set("name", self.field_name)
+        SubElement(apsim_xml, SOIL_PLACEHOLDER)
+        self.folder_head, self.folder_tail = tostring(apsim_xml, encoding="us-ascii").split(soil_placeholder)
+
+    ###
+    def simulation_name(self, soil_id):
+        return f"name_{self.field_name}_mukey_{soil_id}_rot_{self.rotation}_sim"
+
+    ###
+    def mukey_filename(self, runs_folder_path, soil_id, output_format="apsim"):
+        """Returns the file a mukey's simulation is written to when it isn't packed."""
+        if output_format == "sim":
+            return f"{runs_folder_path}/{self.simulation_name(soil_id)}.sim"
+        return f"{runs_folder_path}/{self.field_name}_{soil_id}_{self.rotation}.apsim"
+
+    ###
+    def input_hash(self, soil_df, output_format="apsim"):
+        """Hashes what a mukey's file is generated from: the template (met file, clock, management, crops, output
+        profile and names), the soil flags, the soil rows and the output format."""
+        digest = hashlib.sha256()
+        for part in [self.head, self.tail, self.folder_head, self.folder_tail]:
+            digest.update(part)
+        digest.update(f"{output_format} swim={self.swim} saxton={self.saxton}".encode("utf-8"))
+        digest.update(soil_df.to_csv(index=False).encode("utf-8"))
+        return digest.hexdigest()
+
+    ###
+    def render(self, soil_id, soil_df):
+        """Returns the serialized <simulation> of a mukey.
+
+        Args:
+            soil_id (str): SSURGO mukey
+            soil_df (dataframe): the mukey's horizons, see apsim.soils.fetch_soil_properties
+
+        Returns:
+            [bytes]: us-ascii XML
+        """
+        mukey = serialized_mukey(soil_id)
+        soil_xml = tostring(apsim.Soil(soil_df, self.swim, self.saxton).soil_xml(), encoding="us-ascii")
+        head = join_at_mukey(self.head_pieces, self.head_in_attribute, mukey)
+        return head + soil_xml + join_at_mukey(self.tail_pieces, self.tail_in_attribute, mukey)
+
+    ###
+    def write(self, outfile, sims):
+        """Writes rendered simulations into one .apsim file, as children of a root folder named after the field."""
+        with open(outfile, "wb") as apsim_file:
+            apsim_file.write(self.folder_head + b"".join(sims) + self.folder_tail)
+
+
+def write_mukey_batch(batch, runs_folder_path, template, output_format="apsim", pack_size=1, pack_index=0, model_dir=None):
+    """Writes the simulations of a batch of mukeys, one file per mukey or, with pack_size > 1, one pack file. Runs in
+    create_mukey_runs' worker processes; a mukey that fails doesn't stop the rest of the batch.
+
+    Args:
+        batch (list): (mukey, soil dataframe) pairs
+        runs_folder_path (str): folder to write to
+        template (SimulationTemplate): the simulation every mukey's is rendered from
+        output_format (str, optional): 'apsim' or 'sim', see create_mukey_runs. Defaults to 'apsim'.
+        pack_size (int, optional): write the batch as pack {pack_index} when > 1. Defaults to 1.
+        pack_index (int, optional): number of the pack file. Defaults to 0.
+        model_dir (str, optional): APSIM Model folder for .sim output, see apsim.sim_converter. Defaults to None.
+
+    Returns:
+        [dict]: 'files' written, their 'descriptions' (file -> describe_job, for the run manifest) and 'items', one
+            record per mukey with 'mukey', 'ok', 'error', 'seconds' and 'worker'
+    """
+    field_name = template.field_name
+    rotation = template.rotation
+    files = []
+    items = []
+    pack = []
+    for soil_id, soil_df in batch:
+        started = perf_counter()
+        item = {"mukey": soil_id, "ok": False, "error": None, "worker": f"writer-{os.getpid()}"}
+        try:
+            if soil_df.empty:
+                print(f"Soil {soil_id} not found")
+                item["error"] = "soil not found"
+            else:
+                sim = template.render(soil_id, soil_df)
+                if output_format == "sim":
+                    outfile = template.mukey_filename(runs_folder_path, soil_id, output_format)
+                    tree = ElementTree()
+                    tree._setroot(convert_simulation(fromstring(sim), model_dir))
+                    tree.write(outfile)
+                    files.append(outfile)
+                elif pack_size > 1:
+                    pack.append(sim)
+                else:
+                    outfile = template.mukey_filename(runs_folder_path, soil_id, output_format)
+                    template.write(outfile, [sim])
+                    files.append(outfile)
+                item["ok"] = True
+        except Exception:
+            print(f"File creation failed for {field_name}, {rotation}, {template.end_year}, mukey {soil_id}")
+            traceback.print_exc()
+            item["error"] = traceback.format_exc()
+        item["seconds"] = perf_counter() - started
+        items.append(item)
+    if len(pack) > 0:
+        outfile = f"{runs_folder_path}/{field_name}_{rotation}_pack_{pack_index}.apsim"
+        template.write(outfile, pack)
+        files.append(outfile)
+    # described here, in parallel, rather than read back one file at a time by the process keeping the manifest
+    descriptions = {outfile: describe_job(outfile) for outfile in files}
+    return {"files": files, "descriptions": descriptions, "items": items}
+
+
+def remove_job_outputs(jobs):
+    """Removes what earlier runs of run manifest jobs wrote: their .out and .sum files, plain, compressed or archived,
+    and for .apsim jobs the .sim files they were converted to."""
+    # folder -> output names, so each archive is rewritten once
+    archived = {}
+    for job in jobs:
+        out_filenames = job["outputs"] + [os.path.splitext(sim_filename)[0] + ".sum" for sim_filename in job["sims"]]
+        for out_filename in out_filenames:
+            remove_output(out_filename)
+            archived.setdefault(os.path.dirname(os.path.abspath(out_filename)), set()).add(os.path.basename(out_filename))
+        for sim_filename in job["sims"]:
+            if sim_filename != job["job"] and os.path.exists(sim_filename):
+                os.remove(sim_filename)
+    for folder, names in archived.items():
+        remove_archived_outputs(folder, names)
+
+
+def stale_mukeys(soils_list, runs_folder_path, template, output_format, manifest, file_hashes):
+    """Compares a runs folder's manifest with the files create_mukey_runs would write, prints what is stale and clears
+    it out: outputs of mukeys whose inputs changed, and the files, outputs and manifest entries of mukeys no longer
+    in soils_list or without soil data.
+
+    Args:
+        file_hashes (dict): mukey file -> input hash, see SimulationTemplate.input_hash
+
+    Returns:
+        [list]: the mukeys to write, new or changed (or without soil data, to be reported as failed)
+    """
+    stale = []
+    counts = {"unchanged": 0, "new": 0, "changed": 0, "removed": 0}
+    filenames = set()
+    cleared = []
+    removed = []
+    for i in soils_list:
+        outfile = template.mukey_filename(runs_folder_path, i, output_format)
+        input_hash = file_hashes.get(outfile)
+        if input_hash == None:
+            # no soil data any more: the writer reports the mukey as failed and its old job is removed below
+            stale.append(i)
+            continue
+        filenames.add(os.path.abspath(outfile))
+        job = manifest.job(outfile)
+        if job != None and job.get("input_hash") == input_hash and os.path.exists(outfile):
+            counts["unchanged"] += 1
+            continue
+        if job != None:
+            counts["changed"] += 1
+            cleared.append(job)
+        else:
+            counts["new"] += 1
+        stale.append(i)
+    for job in manifest.jobs():
+        if os.path.abspath(job["job"]) in filenames:
+            continue
+        removed.append(job)
+        if os.path.exists(job["job"]):
+            os.remove(job["job"])
+        manifest.remove_job(job["job"])
+        counts["removed"] += 1
+    remove_job_outputs(cleared + removed)
+    print(f"{counts['unchanged']} mukey files unchanged, {counts['new']} new, {counts['changed']} changed, {counts['removed']} removed.")
+    return stale
+
+
 def create_mukey_runs(
     soils_list,
     dbconn,
@@ -97,6 +718,15 @@ def create_mukey_runs(
     saxton=False,
     maize_xml=None,
     soy_xml=None,
+    pack_size=1,
+    output_format="apsim",
+    progress=False,
+    output_profile="daily-full",
+    output_precision=5,
+    soil_chunk_size=500,
+    num_workers=1,
+    executor=None,
+    incremental=False,
 ):
     """Creates APSIM simulation files for desired list of SSURGO mukeys.
 
@@ -117,389 +747,176 @@ def create_mukey_runs(
         saxton (bool, optional): Create soil profiles using Saxton-Rawls parameters. Defaults to False.
         maize_xml (str, optional): Path to custom maize XML file. Should be in subfolder of current directory.
         soy_xml (str, optional): Path to custom soybean XML file. Should be in subfolder of current directory.
-    Yields:
-        None: Creates .apsim files for each SSURGO soil mukey, management, and weather.
+        pack_size (int, optional): Number of mukey simulations to write into each .apsim file. Packs are named
+        {field_name}_{rotation}_pack_{n}.apsim and are best run with run_all_simulations(packed=True), which runs each
+        pack with one APSIM process. Defaults to 1 (one file per mukey).
+        output_format (str, optional): 'apsim' to write .apsim files, or 'sim' to write each simulation straight to
+        name_{field_name}_mukey_{mukey}_rot_{rotation}_sim.sim with apsim.sim_converter, crop ini files inlined, so
+        run_all_simulations can run them without converting. Defaults to 'apsim'.
+        progress (bool, optional): show a live progress line while writing. Progress is tracked as the 'write' stage
+        either way, for apsim.progress.serve_metrics. Defaults to False.
+        output_profile (str, optional): what each simulation reports: 'daily-full', 'harvest-only' or
+        'annual-summary', see apsim.output_profiles. Summary workflows write and parse far less with the latter two.
+        Defaults to 'daily-full'.
+        output_precision (int, optional): decimal places written to .out files. Defaults to 5.
+        soil_chunk_size (int, optional): soil properties of every mukey are fetched before writing, this many mukeys
+        per query (see apsim.soils.fetch_soil_properties); 1 queries each mukey on its own. Defaults to 500.
+        num_workers (int, optional): processes to build and write the files in. Soil data is fetched once and
+        shipped to the workers in batches of mukeys (a pack per batch with pack_size > 1). Defaults to 1 (serial).
+        executor (ProcessPoolExecutor, optional): pool to write with instead of starting one, e.g. shared across
+        the fields and rotations of create_apsim_files_from_dict. Defaults to None.
+        incremental (bool, optional): keep the runs folder instead of emptying it, and only write the mukeys whose
+        inputs (soil rows, met path, management, years, flags and output settings) changed since the folder's run
+        manifest recorded them, or that are new. Rewritten mukeys lose their old outputs and are pending in the
+        manifest, unchanged ones keep their outputs and status, and files of mukeys no longer in soils_list are
+        removed; run_all_simulations(incremental=True) then only runs what changed. Not for pack_size > 1.
+        Defaults to False.
+    Every written file is listed in run_manifest.json in the runs folder, see apsim.run_manifest.
+    Returns:
+        [list]: one record per mukey whose file wasn't written, with its 'mukey' and 'error' (traceback, or why no
+        file was written for the rotation and years, which leaves the runs folder untouched). Creates .apsim files
+        for each SSURGO soil mukey, management, and weather.
     """
+    if output_format not in ["apsim", "sim"]:
+        raise ValueError(f"Unknown output_format {output_format}, use 'apsim' or 'sim'.")
+    if output_format == "sim" and pack_size > 1:
+        raise ValueError("pack_size only applies to .apsim output.")
+    if incremental and pack_size > 1:
+        raise ValueError("incremental tracks one file per mukey, use pack_size=1.")
+    # raises for an unknown profile before any file is written
+    get_output_profile(output_profile)
+    # reported and skipped, so one bad rotation doesn't stop create_apsim_files_from_dict's other runs
+    if rotation not in ROTATIONS:
+        error = f"Unknown rotation {rotation}, use one of {ROTATIONS}."
+    elif (end_year - start_year) % 3 != 0:
+        error = "The total number of simulation years should be divisble by 3."
+    else:
+        error = None
+    if error != None:
+        print(f"No files created for {field_name}, {rotation}, {end_year}: {error}")
+        return [{"mukey": i, "error": error} for i in soils_list]
     if tar_folder == None:
         tar_folder = os.getcwd()
     runs_folder_path = f"{tar_folder}/apsim_files/{field_name}/{end_year}/{rotation}/"
     if not os.path.exists(runs_folder_path):
         os.makedirs(runs_folder_path)
-    if os.path.exists(runs_folder_path):
-        num_files_removed = 0
+    if os.path.exists(runs_folder_path) and not incremental:
+        num_files_removed = remove_outputs(runs_folder_path)
         for filename in os.listdir(runs_folder_path):
-            for pattern in ["*.apsim", "*.tmp", "*.out", "*.sim", "*.sum"]:
+            for pattern in ["*.apsim", "*.tmp", "*.sim"]:
                 if fnmatch.fnmatch(filename, pattern):
                     os.remove(runs_folder_path + filename)
                     num_files_removed += 1
         print(f"Removed {num_files_removed} old files.")
-    start_date = f"01/01/{start_year}"
-    end_date = f"31/12/{end_year}"
     # save rotation for clukey to crops list
     # loop through field keys e.g., clukeys
     met_folder_path = f"{tar_folder}/apsim_files/{field_name}/{end_year}/{rotation}/met_files"
     if not os.path.exists(met_folder_path):
         os.makedirs(met_folder_path)
     met_path = f"met_files/{met_name}"
+    # index of the written jobs, read by run_all_simulations and parse_manifest_output
+    manifest = RunManifest(runs_folder_path + MANIFEST_FILENAME)
+    if not incremental:
+        manifest.clear()
+    job_info = {"field": field_name, "rotation": rotation, "end_year": end_year, "met": f"{met_folder_path}/{met_name}"}
+    sim_settings = {
+        "field_name": field_name,
+        "rotation": rotation,
+        "met_name": met_name,
+        "met_path": met_path,
+        "start_year": start_year,
+        "end_year": end_year,
+        "sfc_mgmt": sfc_mgmt,
+        "cfs_mgmt": cfs_mgmt,
+        "cc_mgmt": cc_mgmt,
+        "swim": swim,
+        "saxton": saxton,
+        "maize_xml": maize_xml,
+        "soy_xml": soy_xml,
+        "output_profile": output_profile,
+        "output_precision": output_precision,
+    }
+    # everything but the soil and names is the same for every mukey, build and serialize it once
+    template = SimulationTemplate(sim_settings)
+    # APSIM install to inline model constants from, looked up once for every .sim file
+    model_dir = model_folder() if output_format == "sim" else None
+    # a few array queries instead of one round trip per mukey
+    soil_dfs = fetch_soil_properties(dbconn, soils_list, soil_chunk_size)
+    # file -> hash of its inputs, recorded in the manifest for later incremental runs
+    file_hashes = {}
+    if pack_size == 1:
+        for i in soils_list:
+            if str(i) in soil_dfs:
+                file_hashes[template.mukey_filename(runs_folder_path, i, output_format)] = template.input_hash(soil_dfs[str(i)], output_format)
+    if incremental:
+        soils_list = stale_mukeys(soils_list, runs_folder_path, template, output_format, manifest, file_hashes)
     total_sims = len(soils_list)
+    tracker = ProgressTracker("write", total_sims)
+    display = TerminalProgress().start() if progress else None
+    parallel = executor != None or num_workers > 1
+    if pack_size > 1:
+        batch_size = pack_size
+    elif parallel:
+        # a few batches per worker, so workers finish together without a round trip per mukey
+        batch_size = max(1, min(50, len(soils_list) // (4 * num_workers) + 1))
+    else:
+        batch_size = 1
+    batches = [[(i, soil_dfs.get(str(i), pd.DataFrame())) for i in soils_list[k : k + batch_size]] for k in range(0, len(soils_list), batch_size)]
+    failures = []
     sim_count = 0
-    for i in soils_list:
-        try:
-            soil_id = i
-            soil_query = """select * from api.get_soil_properties( array[{}]::text[] )""".format(i)
-            soil_df = pd.read_sql(soil_query, dbconn)
-            if soil_df.empty:
-                print(f"Soil {i} not found")
-                continue
-            # soil_row = soils_df.loc[soils_df[f'{soil_key}'] == i]
-            # initialize .apsim xml
-            apsim_xml = Element("folder")
-            apsim_xml.set("version", "36")
-            apsim_xml.set("creator", "C-CHANGE Foresite")
-            apsim_xml.set("name", field_name)
-            sim = SubElement(apsim_xml, "simulation")
-            sim.set("name", f"name_{field_name}_mukey_{soil_id}_rot_{rotation}_sim")
-
-            # set met file
-            metfile = SubElement(sim, "metfile")
-            metfile.set("name", met_name)
-            filename = SubElement(metfile, "filename")
-            filename.set("name", "filename")
-            filename.set("input", "yes")
-            filename.text = met_path
-
-            # set clock
-            clock = SubElement(sim, "clock")
-            clock_start = SubElement(clock, "start_date")
-            clock_start.set("type", "date")
-            clock_start.set("description", "Enter the start date of the simulation")
-            clock_start.text = start_date
-            clock_end = SubElement(clock, "end_date")
-            clock_end.set("type", "date")
-            clock_end.set("description", "Enter the end date of the simulation")
-            clock_end.text = end_date
-            sumfile = SubElement(sim, "summaryfile")
-            area = SubElement(sim, "area")
-            area.set("name", "paddock")
-
-            # add soil xml
-            soil = apsim.Soil(soil_df, swim, saxton)
-            area.append(soil.soil_xml())
-            ### surface om
-            if rotation == "cfs":
-                surfom_xml = apsim.init_surfaceOM("soybean", "soybean", 1250, 27, 0.0)
-            else:
-                surfom_xml = apsim.init_surfaceOM("maize", "maize", 3500, 65, 0.0)
-            area.append(surfom_xml)
-            ### fertilizer
-            fert_xml = SubElement(area, "fertiliser")
-            ### crops
-            curr_dir = os.getcwd()
-            crop_xml = SubElement(area, "maize")
-            maize_path = os.path.join(curr_dir, maize_xml)
-            add_crop_ini(crop_xml, maize_path)
-            crop_xml = SubElement(area, "soybean")
-            soy_path = os.path.join(curr_dir, soy_xml)
-            add_crop_ini(crop_xml, soy_path)
-            # crop_xml = SubElement( area, 'maize' )
-            # add_crop_ini(crop_xml, maize_xml)
-            # crop_xml = SubElement( area, 'soybean' )
-            # add_crop_ini(crop_xml, soy_xml)
-            # crop_xml = SubElement( area, 'wheat' )
-
-            ### output file
-            outvars = [
-                "title",
-                "dd/mm/yyyy as date",
-                "day",
-                "year",
-                "soybean.yield as soybean_yield",
-                "maize.yield as maize_yield",
-                "soy_mktyd",
-                "maz_mktyd",
-                "soy_ymgha",
-                "maz_ymgha",
-                "soybean.biomass as soybean_biomass",
-                "maize.biomass as maize_biomass",
-                "corn_buac",
-                "soy_buac",
-                "fertiliser",
-                "surfaceom_c",
-                "leach_no3",
-                "Rain",
-                "drain",
-            ]
-            swim_outvars = ["subsurface_drain", "subsurface_drain_no3"]
-            if swim == True:
-                outvars = outvars + swim_outvars
-            output_xml = apsim.set_output_variables(
-                f"name_{field_name}_mukey_{soil_id}_rot_{rotation}_sim.out",
-                outvars,
-            )
-            area.append(output_xml)
-            graph_no3 = [
-                "Cumulative subsurface_drain",
-                "Cumulative subsurface_drain_no3",
-                "Cumulative leach_no3",
-                "Cumulative Rain",
-                "Cumulative drain",
-            ]
-            graph_yield = [
-                "soybean_yield",
-                "maize_yield",
-                "soybean_biomass",
-                "maize_biomass",
-                "soy_buac",
-                "corn_buac",
-                "soy_mktyd",
-                "maz_mktyd",
-                "soy_ymgha",
-                "maz_ymgha",
-            ]
-            graph_all = [
-                "soybean_yield",
-                "maize_yield",
-                "soybean_biomass",
-                "maize_biomass",
-                "corn_buac",
-                "soy_buac",
-                "soy_mktyd",
-                "maz_mktyd",
-                "soy_ymgha",
-                "maz_ymgha",
-                "fertiliser",
-                "surfaceom_c",
-                "subsurface_drain",
-                "subsurface_drain_no3",
-                "leach_no3",
-                "Rain",
-                "drain",
-            ]
-
-            output_xml.append(apsim.add_xy_graph("Date", graph_no3, "no3"))
-            output_xml.append(apsim.add_xy_graph("Date", graph_yield, "yield"))
-            output_xml.append(apsim.add_xy_graph("Date", graph_all, "all outputs"))
-
-            op_man = apsim.OpManager()
-            op_man.add_empty_manager()
-            # get range of years for runs and keep each management year as a list
-            num_years = end_year - start_year
-            years_range = list(range(start_year, end_year + 1))
-            rot_years_one = get_rot_year_one(years_range)
-            rot_years_two = get_rot_year_two(years_range)
-            rot_every_year = years_range[::1]
-            if num_years % 3 == 0:
-                if rotation == "cfs":
-                    for i in rot_years_one:
-                        # --- add ops for soybean in year 1 ---#
-                        # add tillage operations
-                        sfc_tillage_df = apsim.man.create_tillage_df(
-                            sfc_mgmt,
-                            tillage_implement_key,
-                            tillage_depth_key,
-                            tillage_f_incorp_key,
-                            tillage_date_key,
-                            i,
-                        )
-                        apsim.man.add_tillage_ops(sfc_tillage_df, op_man)
-                        # add planting operations
-                        sfc_planting_df = apsim.man.create_planting_df(
-                            sfc_mgmt,
-                            plant_crop_key,
-                            cultivar_key,
-                            sowing_density_key,
-                            sowing_depth_key,
-                            row_spacing_key,
-                            planting_date_key,
-                            i,
-                        )
-                        apsim.man.add_planting_ops(sfc_planting_df, op_man)
-                        # add fert operations
-                        sfc_fert_df = apsim.man.create_fert_df(
-                            sfc_mgmt,
-                            fert_amount_key,
-                            fert_formula_key,
-                            fert_depth_key,
-                            fert_date_key,
-                            i,
-                        )
-                        apsim.man.add_fert_ops(sfc_fert_df, op_man)
-                        # add harvest operations
-                        sfc_harvest_df = apsim.man.create_harvest_df(sfc_mgmt, harvest_crop_key, harvest_date_key, i)
-                        apsim.man.add_harvest_ops(sfc_harvest_df, op_man)
-                    for i in rot_years_two:
-                        # --- add ops for corn in year 2 ---#
-                        # add tillage operations
-                        cfs_tillage_df = apsim.man.create_tillage_df(
-                            cfs_mgmt,
-                            tillage_implement_key,
-                            tillage_depth_key,
-                            tillage_f_incorp_key,
-                            tillage_date_key,
-                            i,
-                        )
-                        apsim.man.add_tillage_ops(cfs_tillage_df, op_man)
-                        # add planting operations
-                        cfs_planting_df = apsim.man.create_planting_df(
-                            cfs_mgmt,
-                            plant_crop_key,
-                            cultivar_key,
-                            sowing_density_key,
-                            sowing_depth_key,
-                            row_spacing_key,
-                            planting_date_key,
-                            i,
-                        )
-                        apsim.man.add_planting_ops(cfs_planting_df, op_man)
-                        # add fert operations
-                        cfs_fert_df = apsim.man.create_fert_df(
-                            cfs_mgmt,
-                            fert_amount_key,
-                            fert_formula_key,
-                            fert_depth_key,
-                            fert_date_key,
-                            i,
-                        )
-                        apsim.man.add_fert_ops(cfs_fert_df, op_man)
-                        # add harvest operations
-                        cfs_harvest_df = apsim.man.create_harvest_df(cfs_mgmt, harvest_crop_key, harvest_date_key, i)
-                        apsim.man.add_harvest_ops(cfs_harvest_df, op_man)
-                elif rotation == "sfc":
-                    for i in rot_years_one:
-                        # --- add ops for corn in year 1 ---#
-                        # add tillage operations
-                        cfs_tillage_df = apsim.man.create_tillage_df(
-                            cfs_mgmt,
-                            tillage_implement_key,
-                            tillage_depth_key,
-                            tillage_f_incorp_key,
-                            tillage_date_key,
-                            i,
-                        )
-                        apsim.man.add_tillage_ops(cfs_tillage_df, op_man)
-                        # add planting operations
-                        cfs_planting_df = apsim.man.create_planting_df(
-                            cfs_mgmt,
-                            plant_crop_key,
-                            cultivar_key,
-                            sowing_density_key,
-                            sowing_depth_key,
-                            row_spacing_key,
-                            planting_date_key,
-                            i,
-                        )
-                        apsim.man.add_planting_ops(cfs_planting_df, op_man)
-                        # add fert operations
-                        cfs_fert_df = apsim.man.create_fert_df(
-                            cfs_mgmt,
-                            fert_amount_key,
-                            fert_formula_key,
-                            fert_depth_key,
-                            fert_date_key,
-                            i,
-                        )
-                        apsim.man.add_fert_ops(cfs_fert_df, op_man)
-                        # add harvest operations
-                        cfs_harvest_df = apsim.man.create_harvest_df(cfs_mgmt, harvest_crop_key, harvest_date_key, i)
-                        apsim.man.add_harvest_ops(cfs_harvest_df, op_man)
-                    for i in rot_years_two:
-                        # --- add ops for soybeans in year 2 ---#
-                        # add tillage operations
-                        sfc_tillage_df = apsim.man.create_tillage_df(
-                            sfc_mgmt,
-                            tillage_implement_key,
-                            tillage_depth_key,
-                            tillage_f_incorp_key,
-                            tillage_date_key,
-                            i,
-                        )
-                        apsim.man.add_tillage_ops(sfc_tillage_df, op_man)
-                        # add planting operations
-                        sfc_planting_df = apsim.man.create_planting_df(
-                            sfc_mgmt,
-                            plant_crop_key,
-                            cultivar_key,
-                            sowing_density_key,
-                            sowing_depth_key,
-                            row_spacing_key,
-                            planting_date_key,
-                            i,
-                        )
-                        apsim.man.add_planting_ops(sfc_planting_df, op_man)
-                        # add fert operations
-                        sfc_fert_df = apsim.man.create_fert_df(
-                            sfc_mgmt,
-                            fert_amount_key,
-                            fert_formula_key,
-                            fert_depth_key,
-                            fert_date_key,
-                            i,
-                        )
-                        apsim.man.add_fert_ops(sfc_fert_df, op_man)
-                        # add harvest operations
-                        sfc_harvest_df = apsim.man.create_harvest_df(sfc_mgmt, harvest_crop_key, harvest_date_key, i)
-                        apsim.man.add_harvest_ops(sfc_harvest_df, op_man)
-                elif rotation == "cc":
-                    for i in rot_every_year:
-                        # --- add cc ops every year---#
-                        # add tillage operations
-                        cc_tillage_df = apsim.man.create_tillage_df(
-                            cc_mgmt,
-                            tillage_implement_key,
-                            tillage_depth_key,
-                            tillage_f_incorp_key,
-                            tillage_date_key,
-                            i,
-                        )
-                        apsim.man.add_tillage_ops(cc_tillage_df, op_man)
-                        # add planting operations
-                        cc_planting_df = apsim.man.create_planting_df(
-                            cc_mgmt,
-                            plant_crop_key,
-                            cultivar_key,
-                            sowing_density_key,
-                            sowing_depth_key,
-                            row_spacing_key,
-                            planting_date_key,
-                            i,
-                        )
-                        apsim.man.add_planting_ops(cc_planting_df, op_man)
-                        # add fert operations
-                        cc_fert_df = apsim.man.create_fert_df(
-                            cc_mgmt,
-                            fert_amount_key,
-                            fert_formula_key,
-                            fert_depth_key,
-                            fert_date_key,
-                            i,
-                        )
-                        apsim.man.add_fert_ops(cc_fert_df, op_man)
-                        # add harvest operations
-                        cc_harvest_df = apsim.man.create_harvest_df(cc_mgmt, harvest_crop_key, harvest_date_key, i)
-                        apsim.man.add_harvest_ops(cc_harvest_df, op_man)
-                else:
-                    continue
-            else:
-                print("The total number of simulation years should be divisble by 3.")
-                break
-
-            area.append(op_man.man_xml)
-            outfile = f"{runs_folder_path}/{field_name}_{soil_id}_{rotation}.apsim"
-            ### management data
-            tree = ElementTree()
-            tree._setroot(apsim_xml)
-            tree.write(outfile)
+
+    def record(result):
+        nonlocal sim_count
+        for item in result["items"]:
+            tracker.finish_job(item["worker"], ok=item["ok"], seconds=item["seconds"])
+            if not item["ok"]:
+                failures.append({"mukey": item["mukey"], "error": item["error"]})
             sim_count += 1
             if sim_count % 20 == 0:
                 print(f"Finished with {sim_count} files.")
-            if sim_count == total_sims:
-                print(f"Finished! All files created for {field_name}, {rotation}, {end_year}!")
-                print(" ")
-        except:
-            print(f"File creation failed for {field_name}, {rotation}, {end_year}, mukey {soil_id}")
-            traceback.print_exc()
-            sim_count += 1
-            continue
+        for outfile in result["files"]:
+            manifest.add_job(outfile, **job_info, input_hash=file_hashes.get(outfile), description=result["descriptions"][outfile])
+
+    def batch_failed(batch, error):
+        # the worker died or the pack couldn't be written
+        print(f"File creation failed for {field_name}, {rotation}, {end_year}: {error}")
+        items = [{"mukey": i, "ok": False, "error": error, "seconds": 0.0, "worker": "writer"} for i, _ in batch]
+        return {"files": [], "descriptions": {}, "items": items}
+
+    try:
+        if not parallel:
+            for pack_index, batch in enumerate(batches):
+                try:
+                    result = write_mukey_batch(batch, runs_folder_path, template, output_format, pack_size, pack_index, model_dir)
+                except Exception as e:
+                    result = batch_failed(batch, repr(e))
+                record(result)
+        else:
+            pool = executor if executor != None else ProcessPoolExecutor(num_workers)
+            try:
+                futures = {}
+                for pack_index, batch in enumerate(batches):
+                    future = pool.submit(write_mukey_batch, batch, runs_folder_path, template, output_format, pack_size, pack_index, model_dir)
+                    futures[future] = batch
+                for future in as_completed(futures):
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = batch_failed(futures[future], repr(e))
+                    record(result)
+            finally:
+                if executor == None:
+                    pool.shutdown(cancel_futures=True)
+    finally:
+        manifest.save()
+        if display != None:
+            display.stop()
+    if len(failures) == 0:
+        print(f"Finished! All files created for {field_name}, {rotation}, {end_year}!")
+    else:
+        print(f"Finished {field_name}, {rotation}, {end_year}: {len(failures)} of {total_sims} mukeys failed.")
+    print(" ")
+    return failures
 
 
 if __name__ == "__main__":
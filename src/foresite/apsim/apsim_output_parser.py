@@ -1,15 +1,22 @@
 """Tbw."""
 
-import glob
 import os
 import re
 
 import numpy as np
 import pandas as pd
+from apsim.output_store import list_outputs, open_output, output_exists
+from apsim.run_manifest import MANIFEST_FILENAME, RunManifest, get_out_filenames
 
 # import apsim.database as db
 
 
+def read_out_file(out_file):
+    """Reads an APSIM .out file, plain, compressed or archived (see apsim.output_store), into a dataframe."""
+    with open_output(out_file) as f:
+        return pd.read_csv(f, header=3, delim_whitespace=True)
+
+
 def parse_all_output_county(
     out_file_dir,
 ):  # , year=2019), db_path, db_schema, db_table
@@ -21,11 +28,11 @@ def parse_all_output_county(
         [df object] -- dataframe with daily data for each .out file
     """
     # dbconn = db.connect_to_db(db_path)
-    file_list = glob.glob(out_file_dir + "/*.out")
+    file_list = list_outputs(out_file_dir)
     push_df = pd.DataFrame()
     for file in file_list:
         # read file
-        daily_df = pd.read_csv(file, header=3, delim_whitespace=True)
+        daily_df = read_out_file(file)
         daily_df = daily_df.drop([0])
         # get the title with mukey, clukey, county info and extract via regex
         df_header = daily_df["title"][1]
@@ -110,11 +117,11 @@ def parse_summary_output_county(out_file_dir, year=2019):  # , db_path, db_schem
         [object] -- df with summary data for each .out file
     """
     # dbconn = db.connect_to_db(db_path)
-    file_list = glob.glob(out_file_dir + "/*.out")
+    file_list = list_outputs(out_file_dir)
     push_data = []
     for file in file_list:
         # read file
-        daily_df = pd.read_csv(file, header=3, delim_whitespace=True)
+        daily_df = read_out_file(file)
         daily_df = daily_df.drop([0])
         # get the header row with mukey, clukey, county info and extract via regex
         df_header = daily_df["title"][1]
@@ -204,11 +211,11 @@ def parse_all_output_field(out_file_dir, year=2019):  # , db_path, db_schema, db
         [df object] -- dataframe with daily data for each .out file
     """
     # dbconn = db.connect_to_db(db_path)
-    file_list = glob.glob(out_file_dir + "/*.out")
+    file_list = list_outputs(out_file_dir)
     push_df = pd.DataFrame()
     for file in file_list:
         # read file
-        daily_df = pd.read_csv(file, header=3, delim_whitespace=True)
+        daily_df = read_out_file(file)
         daily_df = daily_df.drop([0])
         # get field name, mukey, and rotation with regex
         df_header = daily_df["title"][1]
@@ -273,15 +280,14 @@ def parse_summary_output_field(out_file_dir, year, swim=False):  # , db_path, db
         [object] -- df with summary data for each .out file
     """
     # dbconn = db.connect_to_db(db_path)
-    out_dir = os.path.join(out_file_dir, "*.out")
-    file_list = glob.glob(out_dir)
+    file_list = list_outputs(out_file_dir)
     if len(file_list) == 0:
         print("No files found in directory.")
         return
     push_data = []
     for file in file_list:
         # read file
-        daily_df = pd.read_csv(file, header=3, delim_whitespace=True)
+        daily_df = read_out_file(file)
         daily_df = daily_df[1:]
         # get field name, mukey, and rotation with regex
         df_header = daily_df["title"][1]
@@ -398,7 +404,7 @@ def parse_summary_output(out_file, year=None, swim=False):  # , db_path, db_sche
     """
     push_data = []
     # read file
-    daily_df = pd.read_csv(out_file, header=3, delim_whitespace=True)
+    daily_df = read_out_file(out_file)
     daily_df = daily_df[1:]
     # get field name, mukey, and rotation with regex
     df_header = daily_df["title"][1]
@@ -537,7 +543,7 @@ def parse_all_output(out_file, year=None):  # , db_path, db_schema, db_table
     # dbconn = db.connect_to_db(db_path)
     push_df = pd.DataFrame()
     # read file
-    daily_df = pd.read_csv(out_file, header=3, delim_whitespace=True)
+    daily_df = read_out_file(out_file)
     daily_df = daily_df.drop([0])
     # get field name, mukey, and rotation with regex
     df_header = daily_df["title"][1]
@@ -590,6 +596,53 @@ def parse_all_output(out_file, year=None):  # , db_path, db_schema, db_table
     return push_df
 
 
+def parse_pack_output(apsim_file, year=None):
+    """Parses the daily output of every simulation in a packed .apsim file (see create_mukey_runs pack_size). Each
+    simulation writes its own .out file next to the .apsim file; rows keep the mukey parsed from their title.
+    Arguments:
+        apsim_file {str} -- path to .apsim pack
+        year (int) -- the targeted year of simulation data
+    Returns:
+        [df object] -- dataframe with daily data for every simulation, missing .out files are skipped
+    """
+    dfs = []
+    for out_file in get_out_filenames(apsim_file):
+        if not output_exists(out_file):
+            print(f"{out_file} was not written.")
+            continue
+        dfs.append(parse_all_output(out_file, year))
+    if len(dfs) == 0:
+        return pd.DataFrame()
+    return pd.concat(dfs, ignore_index=True)
+
+
+def parse_manifest_output(runs_folder, year=None, new_only=False):
+    """Parses the daily output of every finished job listed in a runs folder's run manifest (see
+    apsim.run_manifest), without searching the folder for .out files. Parsed jobs are marked in the manifest.
+    Arguments:
+        runs_folder {str} -- folder holding run_manifest.json
+        year (int) -- the targeted year of simulation data
+        new_only (bool) -- only parse jobs that finished since they were last parsed
+    Returns:
+        [df object] -- dataframe with daily data for every parsed simulation, missing .out files are skipped
+    """
+    manifest = RunManifest(os.path.join(runs_folder, MANIFEST_FILENAME))
+    dfs = []
+    for job in manifest.jobs(status="ok"):
+        if new_only and job["parsed"]:
+            continue
+        for out_file in job["outputs"]:
+            if not output_exists(out_file):
+                print(f"{out_file} was not written.")
+                continue
+            dfs.append(parse_all_output(out_file, year))
+        manifest.set_parsed(job["job"])
+    manifest.save()
+    if len(dfs) == 0:
+        return pd.DataFrame()
+    return pd.concat(dfs, ignore_index=True)
+
+
 if __name__ == "__main__":
     pass
     # out_file_dir = 'C:\\Users\\mnowatz\\Documents\\Dev\\aepe\\analyses\\apsim_files\\Greene'
@@ -0,0 +1,165 @@
+"""
+asyncio API for running .sim files, alongside the thread based run_many_sims.
+
+Every running simulation is a child process awaited on the event loop, so one loop can drive thousands of
+simulations without a thread per core, next to async database writes or a web service. APSIM's console output is
+streamed to a callback line by line instead of being redirected to .tmp files; a run succeeds when it exits with 0
+and its last line reports 100%, as in run_apsim.classify_run.
+
+Example:
+    failures = await run_sims_async(sim_filenames, concurrency=32)
+    async for out_filename, df in iter_sims_async(sim_filenames, concurrency=32):
+        await write_results(df)
+"""
+
+import asyncio
+from collections import deque
+
+from apsim.apsim_output_parser import parse_all_output
+from apsim.executables import registry
+from apsim.output_store import output_exists
+from apsim.resources import default_num_workers
+from apsim.run_apsim import RetryPolicy, SimFailed
+from apsim.run_manifest import get_out_filenames
+
+
+async def stream_output(stream, filename, tail, on_line=None):
+    """Reads a child's output line by line, keeping the last lines in tail and passing each to on_line."""
+    while True:
+        line = await stream.readline()
+        if not line:
+            return
+        line = line.decode(errors="replace").rstrip()
+        if not line:
+            continue
+        tail.append(line)
+        if on_line != None:
+            on_line(filename, line)
+
+
+async def run_sim_async(sim_filename, policy=None, on_line=None, semaphore=None):
+    """Runs a .sim file with Apsim.exe, retrying failed attempts according to policy.
+
+    Args:
+        sim_filename (str): path to .sim file (or a packed .apsim file)
+        policy (RetryPolicy, optional): retry settings. Defaults to RetryPolicy().
+        on_line (callable, optional): called with (sim_filename, line) for every line APSIM prints. Defaults to None.
+        semaphore (asyncio.Semaphore, optional): held while the APSIM process runs. Defaults to None.
+
+    Raises:
+        SimFailed: when every attempt failed, or the APSIM process couldn't be started
+
+    Returns:
+        [int]: number of attempts it took
+    """
+    if policy == None:
+        policy = RetryPolicy()
+    if semaphore == None:
+        semaphore = asyncio.Semaphore(1)
+    for attempt in range(1, policy.max_attempts + 1):
+        tail = deque(maxlen=5)
+        async with semaphore:
+            try:
+                command = registry.apsim_command() + [sim_filename]
+                proc = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+            except OSError as e:
+                # the executable is missing or not runnable, retrying won't help
+                returncode = None
+                reason = f"error: {e}"
+                break
+            try:
+                await stream_output(proc.stdout, sim_filename, tail, on_line)
+                returncode = await proc.wait()
+            finally:
+                # the task was cancelled, don't leave the simulation running
+                if proc.returncode == None:
+                    proc.kill()
+                    await proc.wait()
+        if returncode != 0:
+            reason = "exit_code"
+        elif len(tail) == 0 or "100%" not in tail[-1]:
+            reason = "incomplete"
+        else:
+            return attempt
+        if attempt < policy.max_attempts:
+            await asyncio.sleep(policy.delay(attempt))
+    record = {
+        "stage": "simulate",
+        "file": sim_filename,
+        "reason": reason,
+        "returncode": returncode,
+        "attempts": attempt,
+        "log_tail": list(tail),
+    }
+    raise SimFailed([record])
+
+
+async def run_sims_async(sim_filename_list, concurrency=None, policy=None, on_line=None):
+    """Runs every .sim file with at most concurrency APSIM processes at a time.
+
+    Args:
+        sim_filename_list (list): paths to .sim files
+        concurrency (int, optional): most simulations running at once. Defaults to default_num_workers().
+        policy (RetryPolicy, optional): retry settings. Defaults to RetryPolicy().
+        on_line (callable, optional): called with (sim_filename, line) for every line APSIM prints. Defaults to None.
+
+    Returns:
+        [list]: failure manifest entries of the sims that failed every retry
+    """
+    failures = []
+    async for sim_filename, error in _run_as_completed(sim_filename_list, concurrency, policy, on_line):
+        if error != None:
+            failures.extend(error.records)
+    return failures
+
+
+async def iter_sims_async(sim_filename_list, concurrency=None, parser=parse_all_output, policy=None, on_line=None, failures=None):
+    """Runs every .sim file and yields each .out file's parsed results as soon as its simulation finishes.
+
+    Parsing runs in the loop's default executor so it doesn't hold up the loop.
+
+    Args:
+        sim_filename_list (list): paths to .sim files
+        concurrency (int, optional): most simulations running at once. Defaults to default_num_workers().
+        parser (callable, optional): called with each .out path. Defaults to parse_all_output.
+        policy (RetryPolicy, optional): retry settings. Defaults to RetryPolicy().
+        on_line (callable, optional): called with (sim_filename, line) for every line APSIM prints. Defaults to None.
+        failures (list, optional): extended with the failure manifest entries of failed sims. Defaults to None.
+
+    Yields:
+        [tuple]: (out_filename, parsed output)
+    """
+    loop = asyncio.get_running_loop()
+    async for sim_filename, error in _run_as_completed(sim_filename_list, concurrency, policy, on_line):
+        if error != None:
+            print(f"{sim_filename} failed: {error}")
+            if failures != None:
+                failures.extend(error.records)
+            continue
+        for out_filename in get_out_filenames(sim_filename):
+            if not output_exists(out_filename):
+                print(f"{out_filename} was not written.")
+                continue
+            yield out_filename, await loop.run_in_executor(None, parser, out_filename)
+
+
+async def _run_as_completed(sim_filename_list, concurrency, policy, on_line):
+    if concurrency == None:
+        concurrency = default_num_workers()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(sim_filename):
+        try:
+            await run_sim_async(sim_filename, policy, on_line, semaphore)
+            return sim_filename, None
+        except SimFailed as e:
+            return sim_filename, e
+
+    tasks = [asyncio.ensure_future(run(sim_filename)) for sim_filename in sim_filename_list]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,68 @@
+"""
+Progress checkpoint of a runner batch.
+
+Every job that finishes successfully appends one JSON line with its stage ('convert', 'simulate' or 'pipeline' for a
+whole .apsim file) and file, so an interrupted batch can be resumed with only the jobs that never finished.
+"""
+
+import json
+import os
+import threading
+
+CHECKPOINT_FILENAME = "checkpoint.jsonl"
+
+
+class Checkpoint:
+    """Records finished jobs of a batch in a JSON lines file. Safe to share between worker threads.
+
+    Args:
+        path (str): checkpoint file, created if it doesn't exist
+    """
+
+    ###
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    ###
+    def mark(self, stage, filename):
+        """Records that stage finished for filename."""
+        line = json.dumps({"stage": stage, "file": filename})
+        with self._lock:
+            with open(self.path, "a") as checkpoint_file:
+                checkpoint_file.write(line + "\n")
+
+    ###
+    def completed(self, stage):
+        """Returns the set of files stage finished for."""
+        if not os.path.exists(self.path):
+            return set()
+        completed = set()
+        with self._lock:
+            with open(self.path, "r") as checkpoint_file:
+                for line in checkpoint_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line of a killed batch can be cut short
+                        continue
+                    if record["stage"] == stage:
+                        completed.add(record["file"])
+        return completed
+
+    ###
+    def clear(self):
+        """Forgets every finished job, for a fresh batch."""
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    ###
+    def callback(self, stage, filename):
+        """Returns a scheduler callback that marks filename when its job succeeded."""
+
+        def mark_done(future):
+            if not future.cancelled() and future.exception() == None:
+                self.mark(stage, filename)
+
+        return mark_done
@@ -1,11 +1,13 @@
 """Tbw."""
 
 from apsim.config import config
-from sqlalchemy import create_engine
 
 
 # create a new database connection
 def connect_to_db(filepath):
+    # imported here so modules that only get a connection passed in don't need sqlalchemy
+    from sqlalchemy import create_engine
+
     # import db info from config file
     params = config(filepath)
     # create new connection from config info
@@ -0,0 +1,134 @@
+"""
+Locates the APSIM 7.XX executables used by the runner.
+
+Paths are resolved once per process, from (in order) explicit configuration, environment variables, an APSIM
+install folder, and finally the default install locations. On Linux the .NET executables are started through a
+launcher such as mono, or a stub executable can be configured in their place.
+
+Environment variables:
+    APSIM_EXE -- path to Apsim.exe (or a stand-in executable)
+    APSIM_TO_SIM_EXE -- path to ApsimToSim.exe (or a stand-in executable)
+    APSIM_HOME -- APSIM install folder that contains Model/Apsim.exe and Model/ApsimToSim.exe
+    APSIM_LAUNCHER -- command prefix used to start the executables, e.g. "mono" or "mono --debug"
+"""
+
+import os
+import shlex
+import shutil
+import sys
+import threading
+from glob import glob
+
+WINDOWS_INSTALL_PATTERNS = [
+    "C:\\Program Files (x86)\\APSIM7*\\Model",
+    "C:\\Program Files\\APSIM7*\\Model",
+]
+LINUX_INSTALL_PATTERNS = [
+    "/opt/APSIM7*/Model",
+    "/usr/local/APSIM7*/Model",
+    "/usr/local/lib/APSIM7*/Model",
+    os.path.expanduser("~/APSIM7*/Model"),
+]
+
+
+def is_windows():
+    return sys.platform.startswith("win")
+
+
+def find_installed_exe(exe_name, patterns=None):
+    """Finds exe_name in the most recent [-1] APSIM 7.XX install matching the default install locations.
+
+    Args:
+        exe_name (str): e.g. 'Apsim.exe' or 'ApsimToSim.exe'
+        patterns (list, optional): glob patterns of APSIM Model folders. Defaults to the platform's install locations.
+
+    Returns:
+        [str]: path to the executable, or None if none is installed
+    """
+    if patterns == None:
+        patterns = WINDOWS_INSTALL_PATTERNS if is_windows() else LINUX_INSTALL_PATTERNS
+    exes = []
+    for pattern in patterns:
+        exes += sorted(glob(os.path.join(pattern, exe_name)))
+    if len(exes) == 0:
+        return None
+    return exes[-1]
+
+
+class ExecutableRegistry:
+    """Resolves and remembers the commands used to start Apsim.exe and ApsimToSim.exe.
+
+    Args:
+        apsim_exe (str, optional): path to Apsim.exe. Defaults to None (look up).
+        to_sim_exe (str, optional): path to ApsimToSim.exe. Defaults to None (look up).
+        apsim_home (str, optional): APSIM install folder. Defaults to None (look up).
+        launcher (str or list, optional): command prefix for starting the executables. Defaults to None (mono for
+            .exe files on Linux when available).
+    """
+
+    ###
+    def __init__(self, apsim_exe=None, to_sim_exe=None, apsim_home=None, launcher=None):
+        self._lock = threading.Lock()
+        self.configure(apsim_exe, to_sim_exe, apsim_home, launcher)
+
+    ###
+    def configure(self, apsim_exe=None, to_sim_exe=None, apsim_home=None, launcher=None):
+        """Sets explicit paths and forgets previously resolved commands."""
+        with self._lock:
+            self.apsim_exe = apsim_exe
+            self.to_sim_exe = to_sim_exe
+            self.apsim_home = apsim_home
+            self.launcher = launcher
+            self._commands = {}
+
+    ###
+    def _resolve_exe(self, exe_name, explicit, env_var):
+        if explicit != None:
+            return explicit
+        if os.environ.get(env_var):
+            return os.environ[env_var]
+        apsim_home = self.apsim_home or os.environ.get("APSIM_HOME")
+        if apsim_home:
+            return os.path.join(apsim_home, "Model", exe_name)
+        return find_installed_exe(exe_name)
+
+    ###
+    def _resolve_launcher(self, exe):
+        launcher = self.launcher
+        if launcher == None:
+            launcher = os.environ.get("APSIM_LAUNCHER")
+        if launcher != None:
+            return shlex.split(launcher) if isinstance(launcher, str) else list(launcher)
+        if not is_windows() and exe.lower().endswith(".exe"):
+            mono = shutil.which("mono")
+            if mono != None:
+                return [mono]
+        return []
+
+    ###
+    def _command(self, exe_name, explicit, env_var):
+        with self._lock:
+            if exe_name not in self._commands:
+                exe = self._resolve_exe(exe_name, explicit, env_var)
+                if exe == None:
+                    raise FileNotFoundError(f"No APSIM 7.XX {exe_name} found. Set {env_var} or APSIM_HOME, or call configure_executables().")
+                self._commands[exe_name] = self._resolve_launcher(exe) + [exe]
+            return list(self._commands[exe_name])
+
+    ###
+    def apsim_command(self):
+        """Returns the command (launcher + Apsim.exe) that runs a .sim file when the file path is appended."""
+        return self._command("Apsim.exe", self.apsim_exe, "APSIM_EXE")
+
+    ###
+    def to_sim_command(self):
+        """Returns the command (launcher + ApsimToSim.exe) that converts an .apsim file when the path is appended."""
+        return self._command("ApsimToSim.exe", self.to_sim_exe, "APSIM_TO_SIM_EXE")
+
+
+registry = ExecutableRegistry()
+
+
+def configure_executables(apsim_exe=None, to_sim_exe=None, apsim_home=None, launcher=None):
+    """Points the runner at specific APSIM executables for the rest of the process. See ExecutableRegistry."""
+    registry.configure(apsim_exe, to_sim_exe, apsim_home, launcher)
@@ -0,0 +1,257 @@
+"""
+Stand-in for Apsim.exe and ApsimToSim.exe, for benchmarking and testing the runner without an APSIM install.
+
+Run as a script:
+    python fake_apsim.py [--latency SECONDS] [--jitter SECONDS] [--failure-rate FRACTION] convert file.apsim
+    python fake_apsim.py [--latency SECONDS] [--jitter SECONDS] [--failure-rate FRACTION] run file.sim|file.apsim
+
+'convert' writes one .sim per <simulation> node, 'run' writes the .out files requested by each simulation's
+outputfile nodes and a .sum file, printing APSIM style progress that ends in 100%. Failed runs either exit with 1,
+leaving the first half of the first simulation's output, or stop part way with exit code 0, the two failure modes
+the runner classifies. Only the standard library is used so the script can be started directly by the runner.
+"""
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+from xml.etree.ElementTree import Element, ElementTree, SubElement, parse
+
+FAKE_OUTVARS = [
+    "title",
+    "dd/mm/yyyy as date",
+    "day",
+    "year",
+    "soybean.yield as soybean_yield",
+    "maize.yield as maize_yield",
+    "soy_mktyd",
+    "maz_mktyd",
+    "soy_ymgha",
+    "maz_ymgha",
+    "soybean.biomass as soybean_biomass",
+    "maize.biomass as maize_biomass",
+    "corn_buac",
+    "soy_buac",
+    "fertiliser",
+    "surfaceom_c",
+    "leach_no3",
+    "Rain",
+    "drain",
+]
+
+
+def parse_date(date_str):
+    day, month, year = [int(d) for d in date_str.split("/")]
+    return datetime.date(year, month, day)
+
+
+def column_name(variable):
+    """Column an APSIM report variable is written under: its alias, or the variable itself."""
+    if " as " in variable:
+        return variable.split(" as ")[-1].strip()
+    return variable.strip()
+
+
+def report_dates(start, end, events):
+    """Dates a report writes a row on for the given output events."""
+    days = [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
+    events = [e.lower() for e in events]
+    if len(events) == 0 or "daily" in events or "end_of_day" in events:
+        return days
+    dates = set()
+    for event in events:
+        if event in ["end_of_year", "end_year"]:
+            dates.update(d for d in days if d.month == 12 and d.day == 31)
+        elif "harvest" in event:
+            dates.update(d for d in days if d.month == 10 and d.day == 10)
+        elif event in ["end_of_month", "end_month"]:
+            dates.update(d for d in days if (d + datetime.timedelta(days=1)).day == 1)
+    return sorted(dates)
+
+
+def fake_value(column, date, rng):
+    if column in ["title"]:
+        return None
+    if column in ["date", "dd/mm/yyyy"]:
+        return date.strftime("%d/%m/%Y")
+    if column == "day":
+        return str(date.timetuple().tm_yday)
+    if column == "year":
+        return str(date.year)
+    if "yield" in column or "mktyd" in column:
+        return f"{rng.uniform(0, 12000):.5f}" if date.month in [9, 10] else "0.00000"
+    if "ymgha" in column:
+        return f"{rng.uniform(0, 12):.5f}" if date.month in [9, 10] else "0.00000"
+    if "buac" in column:
+        return f"{rng.uniform(0, 220):.5f}" if date.month in [9, 10] else "0.00000"
+    if "biomass" in column:
+        return f"{rng.uniform(0, 20000):.5f}"
+    if rng.random() < 0.001:
+        return "?"
+    return f"{rng.uniform(0, 10):.5f}"
+
+
+def write_out_file(out_filename, title, columns, dates, rng):
+    rows = []
+    for date in dates:
+        rows.append([title if c == "title" else fake_value(c, date, rng) for c in columns])
+    units = ["()" if c != "date" else "(dd/mm/yyyy)" for c in columns]
+    widths = [max([len(c), len(u)] + [len(r[i]) for r in rows]) + 2 for i, (c, u) in enumerate(zip(columns, units))]
+    with open(out_filename, "w") as out_file:
+        out_file.write("ApsimVersion = 7.10 r4218\n")
+        out_file.write(f"Title = {title}\n")
+        out_file.write("factors = fake_apsim\n")
+        for line in [columns, units] + rows:
+            out_file.write("".join(v.rjust(w) for v, w in zip(line, widths)) + "\n")
+
+
+def convert(apsim_filename):
+    """Writes <simulation name>.sim next to the .apsim file for every simulation."""
+    folder = os.path.dirname(os.path.abspath(apsim_filename))
+    root = parse(apsim_filename).getroot()
+    for sim in root.iter("simulation"):
+        print(f"Writing {sim.get('name')}.sim")
+        tree = ElementTree(sim)
+        tree.write(os.path.join(folder, f"{sim.get('name')}.sim"))
+    return 0
+
+
+def run(sim_filename, failure_rate, rng):
+    """Writes the .out and .sum files for a .sim file, or for every simulation of an .apsim file."""
+    folder = os.path.dirname(os.path.abspath(sim_filename))
+    root = parse(sim_filename).getroot()
+    sims = [root] if root.tag == "simulation" else list(root.iter("simulation"))
+
+    fatal_error = False
+    if rng.random() < failure_rate:
+        if rng.random() >= 0.5:
+            print(f"{rng.randint(1, 99)}%")
+            return 0
+        fatal_error = True
+
+    for sim in sims:
+        sim_name = sim.get("name") or os.path.splitext(os.path.basename(sim_filename))[0]
+        start = parse_date(next(sim.iter("start_date")).text)
+        end = parse_date(next(sim.iter("end_date")).text)
+        # .apsim outputfile nodes, or the initdata of Report components in a converted .sim file
+        reports = list(sim.iter("outputfile"))
+        if root.tag == "simulation" and root.find(".//component[@class='Report']") != None:
+            reports = [c.find("initdata") for c in root.iter("component") if c.get("class") == "Report"]
+        for outputfile in reports:
+            out_filename = outputfile.findtext("filename") or outputfile.findtext("outputfile") or f"{sim_name}.out"
+            title = outputfile.findtext("title") or os.path.splitext(out_filename)[0]
+            columns = [column_name(v.text) for v in outputfile.iter("variable") if v.text]
+            events = [e.text for e in outputfile.iter("event") if e.text]
+            dates = report_dates(start, end, events)
+            if fatal_error:
+                # the rows reported before the error
+                dates = dates[: len(dates) // 2]
+            write_out_file(os.path.join(folder, out_filename), title, columns, dates, rng)
+
+        with open(os.path.join(folder, f"{sim_name}.sum"), "w") as sum_file:
+            sum_file.write(f"Summary for {sim_name}\nStart date: {start}\nEnd date: {end}\nGenerated by fake_apsim\n")
+        if fatal_error:
+            print("APSIM  Fatal Error: fake_apsim failure", file=sys.stderr)
+            return 1
+        for pct in [25, 50, 75, 100]:
+            print(f"{pct}%")
+    return 0
+
+
+def write_fake_batch(folder, num_files, start_year=2015, end_year=2018, field_name="field", rotation="cfs", pack_size=1, output_profile=None):
+    """Writes num_files minimal .apsim files shaped like create_mukey_runs output, for benchmarking the runner.
+
+    Args:
+        folder (str): folder to write to
+        num_files (int): number of mukey simulations
+        pack_size (int, optional): simulations per .apsim file, see create_mukey_runs. Defaults to 1.
+        output_profile (str, optional): report variables and events from apsim.output_profiles. Defaults to None
+            (FAKE_OUTVARS, daily).
+
+    Returns:
+        [list]: paths of the .apsim files
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    outvars, events = FAKE_OUTVARS, ["daily"]
+    if output_profile != None:
+        from apsim.output_profiles import output_profile as get_output_profile
+
+        outvars, events = get_output_profile(output_profile)
+    apsim_filenames = []
+    for mukey in range(num_files):
+        sim_name = f"name_{field_name}_mukey_{mukey}_rot_{rotation}_sim"
+        if mukey % pack_size == 0:
+            apsim_xml = Element("folder")
+            apsim_xml.set("name", field_name)
+            if pack_size > 1:
+                apsim_filename = os.path.join(folder, f"{field_name}_{rotation}_pack_{mukey // pack_size}.apsim")
+            else:
+                apsim_filename = os.path.join(folder, f"{field_name}_{mukey}_{rotation}.apsim")
+            apsim_filenames.append(apsim_filename)
+        sim = SubElement(apsim_xml, "simulation")
+        sim.set("name", sim_name)
+        clock = SubElement(sim, "clock")
+        SubElement(clock, "start_date").text = f"01/01/{start_year}"
+        SubElement(clock, "end_date").text = f"31/12/{end_year}"
+        area = SubElement(sim, "area")
+        outputfile = SubElement(area, "outputfile")
+        filename = SubElement(outputfile, "filename")
+        filename.set("output", "yes")
+        filename.text = f"{sim_name}.out"
+        SubElement(outputfile, "title").text = sim_name
+        variables = SubElement(outputfile, "variables")
+        for var in outvars:
+            SubElement(variables, "variable").text = var
+        events_xml = SubElement(outputfile, "events")
+        for event in events:
+            SubElement(events_xml, "event").text = event
+        if (mukey + 1) % pack_size == 0 or mukey == num_files - 1:
+            ElementTree(apsim_xml).write(apsim_filename)
+    return apsim_filenames
+
+
+def use_fake_backend(latency=0.0, jitter=0.0, failure_rate=0.0):
+    """Points the runner's executable registry at this script for the rest of the process.
+
+    Args:
+        latency (float, optional): seconds each run takes. Defaults to 0.0.
+        jitter (float, optional): random extra seconds added to each run, up to this much. Defaults to 0.0.
+        failure_rate (float, optional): fraction of runs that fail. Defaults to 0.0.
+    """
+    from apsim.executables import configure_executables
+
+    launcher = [
+        sys.executable,
+        os.path.abspath(__file__),
+        "--latency",
+        str(latency),
+        "--jitter",
+        str(jitter),
+        "--failure-rate",
+        str(failure_rate),
+    ]
+    configure_executables(apsim_exe="run", to_sim_exe="convert", launcher=launcher)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stand-in for Apsim.exe and ApsimToSim.exe.")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each run takes")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra seconds, up to this much")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of runs that fail")
+    parser.add_argument("--seed", type=int, default=None, help="random seed")
+    parser.add_argument("mode", choices=["convert", "run"])
+    parser.add_argument("filename")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    time.sleep(args.latency + rng.uniform(0, args.jitter))
+    if args.mode == "convert":
+        return convert(args.filename)
+    return run(args.filename, args.failure_rate, rng)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""
+Run time estimates for APSIM jobs, used to start the longest jobs first.
+
+A batch finishes when its slowest worker does, so starting long jobs (SWIM water tables, long clocks, deep soil
+profiles) last leaves most cores idle at the end. Jobs are ranked by a cost built from what the .apsim/.sim file
+already says: simulated years, SWIM or SoilWat, and the number of soil layers. When a run ledger (see
+apsim.telemetry) has timings for a job, its measured time is used instead and the other estimates are scaled to
+seconds by the typical measured/estimated ratio.
+"""
+
+import datetime
+import json
+import os
+from xml.etree.ElementTree import parse
+
+# how much slower a SWIM simulation is than a SoilWat one with the same clock and soil
+SWIM_COST_FACTOR = 4.0
+
+
+def parse_clock_date(date_str):
+    day, month, year = [int(d) for d in date_str.split("/")]
+    return datetime.date(year, month, day)
+
+
+def simulation_features(filename):
+    """Reads the cost features of every simulation in an .apsim or .sim file.
+
+    Args:
+        filename (str): path to .apsim or .sim file
+
+    Returns:
+        [list]: one dict per simulation with 'years' (clock length), 'swim' (bool) and 'layers' (soil layers)
+    """
+    root = parse(filename).getroot()
+    sims = [root] if root.tag == "simulation" else list(root.iter("simulation"))
+    features = []
+    for sim in sims:
+        # converted .sim files hold the same values in component initdata
+        start = sim.findtext(".//clock/start_date") or sim.findtext(".//component[@class='Clock']/initdata/start_date")
+        end = sim.findtext(".//clock/end_date") or sim.findtext(".//component[@class='Clock']/initdata/end_date")
+        years = 1.0
+        if start and end:
+            years = max(1.0, ((parse_clock_date(end) - parse_clock_date(start)).days + 1) / 365.25)
+        thickness = sim.find(".//Water/Thickness")
+        if thickness != None:
+            layers = len(thickness.findall("double"))
+        else:
+            layers = len((sim.findtext(".//component/initdata/dlayer") or "").split())
+        swim = sim.find(".//Swim") != None or sim.find(".//component[@class='SWIM3']") != None
+        features.append({"years": years, "swim": swim, "layers": layers})
+    return features
+
+
+def feature_cost(features):
+    """Relative cost of a job from its simulation_features()."""
+    cost = 0.0
+    for sim in features:
+        sim_cost = sim["years"] * (1 + sim["layers"] / 10)
+        if sim["swim"]:
+            sim_cost *= SWIM_COST_FACTOR
+        cost += sim_cost
+    return cost
+
+
+def load_job_history(ledger_path):
+    """Reads the mean run time of every job that finished in a run ledger.
+
+    Returns:
+        [dict]: job file -> mean total_seconds, empty if there is no ledger
+    """
+    if ledger_path == None or not os.path.exists(ledger_path):
+        return {}
+    seconds = {}
+    with open(ledger_path, "r") as ledger_file:
+        for line in ledger_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("status") == "ok" and record.get("total_seconds") != None:
+                seconds.setdefault(record["job"], []).append(record["total_seconds"])
+    return {job: sum(times) / len(times) for job, times in seconds.items()}
+
+
+def estimate_costs(filenames, history=None):
+    """Estimates the run time of each job.
+
+    Args:
+        filenames (list): .apsim or .sim files
+        history (dict, optional): job file -> measured seconds, from load_job_history(). Defaults to None.
+
+    Returns:
+        [dict]: file -> cost; seconds when history is given, otherwise relative units
+    """
+    if history == None:
+        history = {}
+    costs = {}
+    for filename in filenames:
+        try:
+            costs[filename] = feature_cost(simulation_features(filename))
+        except (OSError, ValueError, SyntaxError):
+            # unreadable files fail fast in the runner anyway
+            costs[filename] = 0.0
+    ratios = sorted(history[f] / costs[f] for f in filenames if f in history and costs[f] > 0)
+    scale = ratios[len(ratios) // 2] if len(ratios) > 0 else 1.0
+    return {f: history[f] if f in history else scale * cost for f, cost in costs.items()}
+
+
+def order_by_cost(filenames, priorities=None, history=None):
+    """Orders jobs by priority, then longest estimated run time first.
+
+    Args:
+        filenames (list): .apsim or .sim files
+        priorities (dict, optional): file (path or base name) -> priority, higher runs sooner. Files not listed
+            have priority 0. Defaults to None.
+        history (dict, optional): job file -> measured seconds, from load_job_history(). Defaults to None.
+
+    Returns:
+        [list]: filenames in the order to run them
+    """
+    if priorities == None:
+        priorities = {}
+    costs = estimate_costs(filenames, history)
+
+    def priority(filename):
+        return priorities.get(filename, priorities.get(os.path.basename(filename), 0))
+
+    return sorted(filenames, key=lambda f: (-priority(f), -costs[f]))
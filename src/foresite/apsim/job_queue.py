@@ -0,0 +1,385 @@
+"""
+Shared SQLite job queue for running one batch of .apsim files on several machines.
+
+Every .apsim file of a batch is a row in a job table. Workers lease jobs, renew their leases with heartbeats while
+the job runs and mark it done or failed at the end. A lease that isn't renewed expires, so the job of a worker
+that crashed or lost its node goes back to the queue; a worker that was only too slow to renew finds its lease
+taken over and cancels the job, leaving it to the new owner. Outputs are written next to each .apsim file as
+usual, so the batch folder and the queue database have to be on storage every node can reach, and the database
+on a file system with working file locks (a local disk for several processes on one machine, or e.g. a
+Lustre/GPFS scratch share).
+
+Run as a module with src/foresite on the path:
+    python -m apsim.job_queue enqueue queue.db apsim_files/county [--priority P]
+    python -m apsim.job_queue work queue.db [--cores N] [--lease SECONDS] [--scratch [FOLDER]] [--packed]
+    python -m apsim.job_queue status queue.db
+"""
+
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+from contextlib import nullcontext
+from glob import glob
+from time import sleep, time
+
+from apsim.job_cost import estimate_costs, load_job_history
+from apsim.progress import ProgressTracker, TerminalProgress, serve_metrics
+from apsim.run_apsim import (
+    FAILURE_MANIFEST,
+    RunCancelled,
+    cancel_job,
+    cancel_on_signals,
+    cancellable_job,
+    collect_failures,
+    convert_and_run,
+    run_cancelled,
+    write_failure_manifest,
+)
+from apsim.scheduler import SimScheduler
+from apsim.telemetry import LEDGER_FILENAME
+
+SCHEMA = """
+create table if not exists jobs (
+    id integer primary key,
+    apsim_file text unique not null,
+    status text not null default 'pending',
+    priority integer not null default 0,
+    cost real not null default 0,
+    worker text,
+    lease_expires real,
+    attempts integer not null default 0,
+    failures text,
+    updated real
+)
+"""
+# serves lease's status filter and order without scanning and sorting the whole table
+LEASE_INDEX = "create index if not exists jobs_lease_order on jobs(status, priority desc, cost desc, id)"
+# the next pending job and the next expired lease, each read in index order, then the first of the two
+LEASE_QUERY = """
+select id, apsim_file from (
+    select * from (select id, apsim_file, priority, cost from jobs where status = 'pending' order by priority desc, cost desc, id limit 1)
+    union all
+    select * from (
+        select id, apsim_file, priority, cost from jobs where status = 'leased' and lease_expires < ? order by priority desc, cost desc, id limit 1
+    )
+)
+order by priority desc, cost desc, id
+limit 1
+"""
+
+
+class JobQueue:
+    """Job table of a batch, shared by every worker through one SQLite file.
+
+    Jobs are 'pending', 'leased' to a worker until lease_expires, 'done' or 'failed'. Every lease counts as an
+    attempt; a job whose lease expired max_attempts times is failed instead of leased again.
+
+    Args:
+        path (str): SQLite database, created if it doesn't exist
+        lease_seconds (float, optional): how long a lease lasts without a heartbeat. Defaults to 300.
+        max_attempts (int, optional): most times a job is leased. Defaults to 3.
+    """
+
+    ###
+    def __init__(self, path, lease_seconds=300.0, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with self._connect() as conn:
+            conn.execute(SCHEMA)
+            conn.execute(LEASE_INDEX)
+
+    ###
+    def _connect(self):
+        # a connection per call, so the queue can be used from any thread or process
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return _Transaction(conn)
+
+    ###
+    def enqueue(self, apsim_filenames, priority=0, costs=None):
+        """Adds .apsim files as pending jobs. Files already in the queue are left as they are.
+
+        Jobs are leased highest priority first and, within a priority, longest first, so e.g. an interactive field
+        run queued with a higher priority starts before the rest of a county sweep.
+
+        Args:
+            apsim_filenames (list): .apsim files
+            priority (int, optional): priority of these jobs. Defaults to 0.
+            costs (dict, optional): file -> estimated run time. Defaults to estimate_costs() of the files.
+
+        Returns:
+            [int]: number of jobs added
+        """
+        if costs == None:
+            costs = estimate_costs(apsim_filenames)
+        now = time()
+        rows = [(os.path.abspath(f), priority, costs.get(f, 0.0), now) for f in apsim_filenames]
+        with self._connect() as conn:
+            before = conn.execute("select count(*) from jobs").fetchone()[0]
+            conn.executemany("insert or ignore into jobs (apsim_file, priority, cost, updated) values (?, ?, ?, ?)", rows)
+            return conn.execute("select count(*) from jobs").fetchone()[0] - before
+
+    ###
+    def lease(self, worker):
+        """Leases the next pending or expired job to worker.
+
+        Returns:
+            [tuple]: (job id, apsim file), or None if there is nothing to lease right now
+        """
+        now = time()
+        with self._connect() as conn:
+            # jobs that expired too often are given up on rather than leased again
+            conn.execute(
+                "update jobs set status = 'failed', worker = null, updated = ? where status = 'leased' and lease_expires < ? and attempts >= ?",
+                (now, now, self.max_attempts),
+            )
+            row = conn.execute(LEASE_QUERY, (now,)).fetchone()
+            if row == None:
+                return None
+            conn.execute(
+                "update jobs set status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, updated = ? where id = ?",
+                (worker, now + self.lease_seconds, now, row["id"]),
+            )
+            return row["id"], row["apsim_file"]
+
+    ###
+    def heartbeat(self, job_id, worker):
+        """Extends worker's lease on a job. Returns False if the lease was lost (expired and taken over)."""
+        now = time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "update jobs set lease_expires = ?, updated = ? where id = ? and worker = ? and status = 'leased'",
+                (now + self.lease_seconds, now, job_id, worker),
+            )
+            return cursor.rowcount == 1
+
+    ###
+    def complete(self, job_id, worker, failures=None):
+        """Marks worker's job done, or failed with its failure manifest records. Ignored if the lease was lost."""
+        status = "failed" if failures else "done"
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "update jobs set status = ?, failures = ?, lease_expires = null, updated = ? where id = ? and worker = ? and status = 'leased'",
+                (status, json.dumps(failures) if failures else None, time(), job_id, worker),
+            )
+            return cursor.rowcount == 1
+
+    ###
+    def release(self, job_id, worker):
+        """Gives worker's leased job back to the queue without counting the attempt, e.g. when the worker is stopped."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "update jobs set status = 'pending', worker = null, lease_expires = null, attempts = max(attempts - 1, 0), updated = ? where id = ? and worker = ? and status = 'leased'",
+                (time(), job_id, worker),
+            )
+            return cursor.rowcount == 1
+
+    ###
+    def requeue_failed(self):
+        """Puts failed jobs back in the queue with their attempts reset. Returns the number of jobs requeued."""
+        with self._connect() as conn:
+            cursor = conn.execute("update jobs set status = 'pending', worker = null, attempts = 0, failures = null, updated = ? where status = 'failed'", (time(),))
+            return cursor.rowcount
+
+    ###
+    def counts(self):
+        """Returns the number of jobs in each status."""
+        with self._connect() as conn:
+            rows = conn.execute("select status, count(*) from jobs group by status").fetchall()
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        counts.update({status: n for status, n in rows})
+        return counts
+
+    ###
+    def unfinished(self):
+        """Number of jobs that are pending or leased."""
+        counts = self.counts()
+        return counts["pending"] + counts["leased"]
+
+    ###
+    def failures(self):
+        """Returns the failure manifest records of every failed job."""
+        with self._connect() as conn:
+            rows = conn.execute("select apsim_file, attempts, failures from jobs where status = 'failed' order by id").fetchall()
+        records = []
+        for row in rows:
+            if row["failures"] != None:
+                records += json.loads(row["failures"])
+            else:
+                records.append({"stage": "convert", "file": row["apsim_file"], "reason": "lease_expired", "returncode": None, "attempts": row["attempts"], "log_tail": []})
+        return records
+
+
+class _Transaction:
+    """Runs a with block as one immediate (write locking) transaction and closes the connection afterwards."""
+
+    ###
+    def __init__(self, conn):
+        self.conn = conn
+
+    ###
+    def __enter__(self):
+        self.conn.execute("begin immediate")
+        return self.conn
+
+    ###
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            self.conn.execute("rollback" if exc_type != None else "commit")
+        finally:
+            self.conn.close()
+        return False
+
+
+def enqueue_folder(queue_path, apsim_files_path, priority=0):
+    """Adds every .apsim file in a folder to a queue with the given priority, like run_all_simulations would run
+    them. Run times are estimated with the folder's run ledger when there is one. Returns the number of jobs added."""
+    apsim_filenames = sorted(os.path.abspath(f) for f in glob(os.path.join(apsim_files_path, "*.apsim")))
+    costs = estimate_costs(apsim_filenames, load_job_history(os.path.join(apsim_files_path, LEDGER_FILENAME)))
+    added = JobQueue(queue_path).enqueue(apsim_filenames, priority, costs)
+    print(f"Queued {added} of {len(apsim_filenames)} .apsim files.")
+    return added
+
+
+def run_worker(queue_path, worker=None, num_cores=None, policy=None, cache=None, ledger=None, scratch=False, packed=False, lease_seconds=300.0, poll=5.0, progress=None):
+    """Leases and runs jobs from a queue until every job in it is done or failed.
+
+    Several workers, on one node or many, can share a queue. Each keeps up to num_cores jobs leased and running and
+    renews their leases every lease_seconds / 3. A job whose lease was lost, i.e. taken over by another worker after
+    it expired, is cancelled and its result isn't recorded. SIGINT or SIGTERM (e.g. a node being preempted) stops
+    the worker: its running APSIM processes are terminated and their jobs go back to the queue for other workers.
+
+    Args:
+        queue_path (str): queue database
+        worker (str, optional): worker name recorded on its leases. Defaults to hostname-pid.
+        num_cores (int, optional): jobs to run at once. Defaults to default_num_workers().
+        policy (RetryPolicy, optional): retry settings for each run. Defaults to RetryPolicy().
+        cache (SimCache, optional): result cache shared by the workers. Defaults to None.
+        ledger (RunLedger, optional): ledger to write each job's record to. Defaults to None.
+        scratch (bool or str, optional): run each job in a node-local scratch directory and publish its outputs to
+            the shared folder by atomic rename, see convert_and_run. Defaults to False.
+        packed (bool, optional): run each queued .apsim pack with one Apsim.exe process. Defaults to False.
+        lease_seconds (float, optional): lease length. Defaults to 300.
+        poll (float, optional): seconds to wait before asking again when every unfinished job is leased. Defaults to 5.
+        progress (ProgressTracker, optional): counts this worker's jobs as they start and finish. Defaults to None.
+
+    Returns:
+        [int]: number of jobs this worker finished
+    """
+    queue = JobQueue(queue_path, lease_seconds)
+    if worker == None:
+        worker = f"{socket.gethostname()}-{os.getpid()}"
+    held = {}
+    held_lock = threading.Lock()
+    stop = threading.Event()
+    finished = []
+
+    def beat():
+        while not stop.wait(lease_seconds / 3):
+            with held_lock:
+                job_ids = list(held)
+            for job_id in job_ids:
+                if queue.heartbeat(job_id, worker):
+                    continue
+                with held_lock:
+                    job = held.get(job_id)
+                # None if the job just finished, otherwise another worker runs it now and owns its outputs
+                if job != None:
+                    print(f"{worker} lost its lease on {job[0]}, cancelling it")
+                    cancel_job(job[1])
+
+    def run_job(apsim_filename, cancel):
+        with cancellable_job(cancel):
+            return convert_and_run(apsim_filename, policy=policy, cache=cache, ledger=ledger, scratch=scratch, packed=packed)
+
+    with cancel_on_signals(), SimScheduler(num_cores, progress=progress) as scheduler:
+        free = threading.Semaphore(scheduler.num_workers)
+
+        def on_done(job_id, apsim_filename):
+            def done(future):
+                # before completing, so the heartbeat doesn't take the finished job for a lost one
+                with held_lock:
+                    held.pop(job_id, None)
+                # both are ignored when the lease was lost
+                if future.cancelled() or isinstance(future.exception(), RunCancelled):
+                    queue.release(job_id, worker)
+                elif queue.complete(job_id, worker, collect_failures(future, apsim_filename, "convert")):
+                    finished.append(job_id)
+                free.release()
+
+            return done
+
+        heartbeat = threading.Thread(target=beat, name=f"{worker}-heartbeat", daemon=True)
+        heartbeat.start()
+        print(f"Worker {worker} running up to {scheduler.num_workers} jobs from {queue_path}")
+        try:
+            while True:
+                free.acquire()
+                if run_cancelled():
+                    break
+                job = queue.lease(worker)
+                if job == None:
+                    free.release()
+                    if queue.unfinished() == 0:
+                        break
+                    sleep(poll)
+                    continue
+                job_id, apsim_filename = job
+                cancel = threading.Event()
+                with held_lock:
+                    held[job_id] = (apsim_filename, cancel)
+                scheduler.submit(run_job, apsim_filename, cancel, callback=on_done(job_id, apsim_filename))
+        finally:
+            scheduler.shutdown(wait=True)
+            stop.set()
+            heartbeat.join()
+    print(f"Worker {worker} finished {len(finished)} jobs.")
+    return len(finished)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Shared job queue for running APSIM batches on several nodes.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    enqueue = commands.add_parser("enqueue", help="queue every .apsim file in a folder")
+    enqueue.add_argument("queue")
+    enqueue.add_argument("apsim_files_path")
+    enqueue.add_argument("--priority", type=int, default=0, help="higher priority jobs are leased first")
+    work = commands.add_parser("work", help="run jobs until the queue is finished")
+    work.add_argument("queue")
+    work.add_argument("--cores", type=int, default=None, help="jobs to run at once")
+    work.add_argument("--lease", type=float, default=300.0, help="lease length in seconds")
+    work.add_argument("--scratch", nargs="?", const=True, default=False, help="run jobs in scratch directories, optionally in this folder")
+    work.add_argument("--packed", action="store_true", help="run each .apsim file with one APSIM process")
+    work.add_argument("--poll", type=float, default=5.0, help="seconds between polls when nothing can be leased")
+    work.add_argument("--progress", action="store_true", help="show a live progress line")
+    work.add_argument("--metrics-port", type=int, default=None, help="serve Prometheus progress metrics on this port")
+    status = commands.add_parser("status", help="print job counts and write the failure manifest next to the queue")
+    status.add_argument("queue")
+    args = parser.parse_args(argv)
+
+    if args.command == "enqueue":
+        enqueue_folder(args.queue, args.apsim_files_path, args.priority)
+    elif args.command == "work":
+        progress = None
+        if args.progress or args.metrics_port != None:
+            progress = ProgressTracker("work", JobQueue(args.queue).unfinished())
+        metrics_server = serve_metrics(args.metrics_port) if args.metrics_port != None else None
+        try:
+            with TerminalProgress() if args.progress else nullcontext():
+                run_worker(args.queue, num_cores=args.cores, scratch=args.scratch, packed=args.packed, lease_seconds=args.lease, poll=args.poll, progress=progress)
+        finally:
+            if metrics_server != None:
+                metrics_server.shutdown()
+    else:
+        queue = JobQueue(args.queue)
+        print(queue.counts())
+        write_failure_manifest(os.path.join(os.path.dirname(os.path.abspath(args.queue)), FAILURE_MANIFEST), queue.failures())
+    return 0
+
+
+if __name__ == "__main__":
+    main()
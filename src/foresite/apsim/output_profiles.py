@@ -0,0 +1,65 @@
+"""
+Output profiles: which variables a simulation reports, and on which APSIM events.
+
+Reporting every variable daily writes 365 rows per simulated year that the summary parsers immediately collapse to
+one row per year. A profile instead reports on the events a workflow needs, aggregating daily values in APSIM's
+Report component ('max of ... from reported to now' is the largest value since the last reported row, 'sum of ...'
+the total), so the .out files keep the same columns and every parser in apsim_output_parser reads them unchanged.
+
+Profiles:
+    daily-full -- every variable, every day (the default)
+    harvest-only -- one row per harvest: yields and biomass at harvest, fluxes summed since the previous row
+    annual-summary -- one row on 31 December: largest yields and biomass of the year, fluxes summed over the year
+"""
+
+STATE_VARIABLES = ["title", "dd/mm/yyyy as date", "day", "year"]
+CROP_VARIABLES = [
+    "soybean.yield as soybean_yield",
+    "maize.yield as maize_yield",
+    "soy_mktyd",
+    "maz_mktyd",
+    "soy_ymgha",
+    "maz_ymgha",
+    "soybean.biomass as soybean_biomass",
+    "maize.biomass as maize_biomass",
+    "corn_buac",
+    "soy_buac",
+]
+FLUX_VARIABLES = ["fertiliser", "leach_no3", "Rain", "drain"]
+SWIM_FLUX_VARIABLES = ["subsurface_drain", "subsurface_drain_no3"]
+
+OUTPUT_PROFILES = {
+    "daily-full": {"events": ["daily"], "crop": None, "flux": None},
+    "harvest-only": {"events": ["harvesting"], "crop": None, "flux": "sum"},
+    "annual-summary": {"events": ["end_of_year"], "crop": "max", "flux": "sum"},
+}
+
+
+def aggregate(variable, function):
+    """Wraps a report variable in an APSIM Report aggregation over the days since the last reported row, keeping its
+    column name, e.g. 'sum of Rain on end_of_day from reported to now as Rain'."""
+    if function == None:
+        return variable
+    expression, _, alias = variable.partition(" as ")
+    alias = alias.strip() or expression.strip()
+    return f"{function} of {expression.strip()} on end_of_day from reported to now as {alias}"
+
+
+def output_profile(name="daily-full", swim=False):
+    """Returns the report variables and events of an output profile.
+
+    Args:
+        name (str, optional): one of OUTPUT_PROFILES. Defaults to 'daily-full'.
+        swim (bool, optional): add the SWIM tile drainage variables. Defaults to False.
+
+    Returns:
+        [tuple]: (list of report variables, list of report events)
+    """
+    if name not in OUTPUT_PROFILES:
+        raise ValueError(f"Unknown output profile {name}, use one of {list(OUTPUT_PROFILES)}.")
+    profile = OUTPUT_PROFILES[name]
+    fluxes = [aggregate(v, profile["flux"]) for v in FLUX_VARIABLES + (SWIM_FLUX_VARIABLES if swim else [])]
+    variables = STATE_VARIABLES + [aggregate(v, profile["crop"]) for v in CROP_VARIABLES]
+    # surface organic matter is a state, reported as it is on the day; kept after fertiliser as in earlier files
+    variables += fluxes[:1] + ["surfaceom_c"] + fluxes[1:]
+    return variables, list(profile["events"])
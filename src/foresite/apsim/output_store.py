@@ -0,0 +1,266 @@
+"""
+Compressed storage of APSIM's .out and .sum files.
+
+A county run leaves thousands of whitespace padded text files behind, which compress roughly tenfold. Finished
+outputs can be compressed next to where APSIM wrote them ('gzip' gives <name>.out.gz, 'zstd' <name>.out.zst and
+needs the zstandard package) or, once a batch is done, packed into one outputs.zip archive per runs folder ('zip').
+Files keep their original names everywhere else: open_output, output_exists and list_outputs find a .out file
+wherever it is stored, so apsim_output_parser and the run manifest read compressed folders unchanged.
+
+Example:
+    run_all_simulations(folder, compress="zstd")
+    df = parse_all_output(os.path.join(folder, "name_field_mukey_0_rot_cfs_sim.out"))  # reads the .out.zst
+"""
+
+import gzip
+import io
+import os
+import tempfile
+import threading
+import zipfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = ["gzip", "zstd", "zip"]
+SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+ARCHIVE_FILENAME = "outputs.zip"
+OUTPUT_EXTENSIONS = [".out", ".sum"]
+
+# folder -> (version, member names) of its archive, so looking up many outputs reads the archive's index once
+_archive_members = {}
+_archive_lock = threading.Lock()
+
+
+def check_compression(compression):
+    """Raises ValueError for an unknown compression, or for 'zstd' when zstandard isn't installed."""
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression}, use one of {COMPRESSIONS}.")
+    if compression == "zstd" and zstandard == None:
+        raise ValueError("zstd compression needs the zstandard package, install it or use 'gzip'.")
+
+
+def written_name(name):
+    """Returns the name an output was written as, e.g. 'a.out' for 'a.out.gz'."""
+    for suffix in SUFFIXES.values():
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+def is_output(name):
+    return os.path.splitext(written_name(name))[1] in OUTPUT_EXTENSIONS
+
+
+def archive_members(folder):
+    """Returns the names stored in a folder's outputs.zip, an empty set if it has none."""
+    archive_path = os.path.join(folder, ARCHIVE_FILENAME)
+    with _archive_lock:
+        if not os.path.exists(archive_path):
+            _archive_members.pop(folder, None)
+            return set()
+        stat = os.stat(archive_path)
+        version = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if folder not in _archive_members or _archive_members[folder][0] != version:
+            with zipfile.ZipFile(archive_path) as archive:
+                _archive_members[folder] = (version, set(archive.namelist()))
+        return _archive_members[folder][1]
+
+
+def find_output(filename):
+    """Returns the file an output is stored as: itself, or its .gz or .zst file. None if it is in neither form (it may
+    still be in the folder's archive, see output_exists)."""
+    if os.path.exists(filename):
+        return filename
+    for suffix in SUFFIXES.values():
+        if os.path.exists(filename + suffix):
+            return filename + suffix
+    return None
+
+
+def output_exists(filename):
+    """True if an output was written, whether plain, compressed or archived."""
+    if find_output(filename) != None:
+        return True
+    folder = os.path.dirname(os.path.abspath(filename))
+    return os.path.basename(filename) in archive_members(folder)
+
+
+def output_size(filename):
+    """Bytes an output takes on disk, 0 if it is missing or archived."""
+    stored = find_output(filename)
+    return os.path.getsize(stored) if stored != None else 0
+
+
+def open_output(filename, mode="rt"):
+    """Opens an output for reading wherever it is stored.
+
+    Args:
+        filename (str): path the output was written to, e.g. <folder>/<name>.out
+        mode (str, optional): 'rt' for text or 'rb' for bytes. Defaults to 'rt'.
+
+    Raises:
+        FileNotFoundError: when the output is in none of its forms
+
+    Returns:
+        [file]: readable file object, close it when done
+    """
+    stored = find_output(filename)
+    if stored == None:
+        folder = os.path.dirname(os.path.abspath(filename))
+        name = os.path.basename(filename)
+        if name not in archive_members(folder):
+            raise FileNotFoundError(f"{filename} was not written.")
+        with zipfile.ZipFile(os.path.join(folder, ARCHIVE_FILENAME)) as archive:
+            data = archive.read(name)
+        return io.BytesIO(data) if mode == "rb" else io.TextIOWrapper(io.BytesIO(data))
+    if stored.endswith(SUFFIXES["gzip"]):
+        return gzip.open(stored, mode)
+    if stored.endswith(SUFFIXES["zstd"]):
+        check_compression("zstd")
+        return zstandard.open(stored, mode)
+    return open(stored, mode)
+
+
+def compress_output(filename, compression="gzip"):
+    """Compresses one output next to itself and removes the original. The compressed file appears in one step, so
+    readers never see a partial file.
+
+    Args:
+        filename (str): .out or .sum file
+        compression (str, optional): 'gzip' or 'zstd'. Defaults to 'gzip'.
+
+    Returns:
+        [str]: path of the compressed file, None if filename doesn't exist
+    """
+    check_compression(compression)
+    if compression not in SUFFIXES:
+        raise ValueError(f"{compression} packs a whole folder, see archive_outputs.")
+    if not os.path.exists(filename):
+        return None
+    compressed = filename + SUFFIXES[compression]
+    fd, partial = tempfile.mkstemp(prefix=f".{os.path.basename(compressed)}.", suffix=".partial", dir=os.path.dirname(os.path.abspath(filename)))
+    with os.fdopen(fd, "wb") as partial_file, open(filename, "rb") as src:
+        if compression == "gzip":
+            with gzip.GzipFile(fileobj=partial_file, mode="wb", mtime=0) as dest:
+                for chunk in iter(lambda: src.read(1 << 20), b""):
+                    dest.write(chunk)
+        else:
+            zstandard.ZstdCompressor().copy_stream(src, partial_file)
+    os.replace(partial, compressed)
+    os.remove(filename)
+    return compressed
+
+
+def compress_outputs(filenames, compression="gzip"):
+    """Compresses every output that exists, see compress_output.
+
+    Returns:
+        [list]: paths of the compressed files
+    """
+    compressed = [compress_output(filename, compression) for filename in filenames]
+    return [filename for filename in compressed if filename != None]
+
+
+def archive_outputs(folder):
+    """Moves every .out and .sum file of a folder (plain or compressed) into its outputs.zip, replacing members of the
+    same name. The archive is rewritten and swapped in whole, so an interrupted call loses nothing.
+
+    Returns:
+        [int]: number of outputs archived
+    """
+    names = {}
+    for name in sorted(os.listdir(folder)):
+        if is_output(name):
+            names[written_name(name)] = name
+    if len(names) == 0:
+        return 0
+    archive_path = os.path.join(folder, ARCHIVE_FILENAME)
+    fd, partial = tempfile.mkstemp(prefix=f".{ARCHIVE_FILENAME}.", suffix=".partial", dir=folder)
+    os.close(fd)
+    with zipfile.ZipFile(partial, "w", zipfile.ZIP_DEFLATED) as archive:
+        for stem in names:
+            with open_output(os.path.join(folder, stem), "rb") as output:
+                archive.writestr(stem, output.read())
+        if os.path.exists(archive_path):
+            with zipfile.ZipFile(archive_path) as old_archive:
+                for name in old_archive.namelist():
+                    if name not in names:
+                        archive.writestr(name, old_archive.read(name))
+    os.replace(partial, archive_path)
+    for name in names.values():
+        os.remove(os.path.join(folder, name))
+    return len(names)
+
+
+def remove_archived_outputs(folder, names):
+    """Removes outputs from a folder's outputs.zip. The archive is rewritten and swapped in whole like in
+    archive_outputs, and removed once it is empty.
+
+    Args:
+        folder (str): folder holding the archive
+        names (iterable): names the outputs were written as, e.g. <name>.out
+
+    Returns:
+        [int]: number of outputs removed from the archive
+    """
+    names = set(names) & archive_members(folder)
+    if len(names) == 0:
+        return 0
+    archive_path = os.path.join(folder, ARCHIVE_FILENAME)
+    fd, partial = tempfile.mkstemp(prefix=f".{ARCHIVE_FILENAME}.", suffix=".partial", dir=folder)
+    os.close(fd)
+    num_kept = 0
+    with zipfile.ZipFile(partial, "w", zipfile.ZIP_DEFLATED) as archive, zipfile.ZipFile(archive_path) as old_archive:
+        for name in old_archive.namelist():
+            if name not in names:
+                archive.writestr(name, old_archive.read(name))
+                num_kept += 1
+    if num_kept == 0:
+        os.remove(partial)
+        os.remove(archive_path)
+    else:
+        os.replace(partial, archive_path)
+    return len(names)
+
+
+def list_outputs(folder, extension=".out"):
+    """Lists the outputs of a folder by the names they were written as, wherever they are stored.
+
+    Returns:
+        [list]: sorted paths, e.g. <folder>/<name>.out for a <name>.out.zst file
+    """
+    names = set(name for name in archive_members(folder) if name.endswith(extension))
+    names.update(written_name(name) for name in os.listdir(folder) if written_name(name).endswith(extension))
+    return sorted(os.path.join(folder, name) for name in names)
+
+
+def remove_output(filename):
+    """Removes an output's plain and compressed files; a copy in the folder's archive is left (see
+    remove_archived_outputs), and is shadowed once the output is written again.
+
+    Returns:
+        [int]: number of files removed
+    """
+    num_files_removed = 0
+    for stored in [filename] + [filename + suffix for suffix in SUFFIXES.values()]:
+        if os.path.exists(stored):
+            os.remove(stored)
+            num_files_removed += 1
+    return num_files_removed
+
+
+def remove_outputs(folder):
+    """Removes every output of a folder (plain, compressed or archived).
+
+    Returns:
+        [int]: number of files removed
+    """
+    num_files_removed = 0
+    for name in os.listdir(folder):
+        if is_output(name) or name == ARCHIVE_FILENAME:
+            os.remove(os.path.join(folder, name))
+            num_files_removed += 1
+    return num_files_removed
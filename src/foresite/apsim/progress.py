@@ -0,0 +1,261 @@
+"""
+Live progress of running and writing batches: a terminal line and a Prometheus text endpoint.
+
+A ProgressTracker counts a stage's jobs as they start and finish (SimScheduler updates one for every job it runs,
+create_mukey_runs for every file it writes) and derives jobs/sec over the last minute, the ETA, failures, seconds
+since the last finished job (to spot stalls) and how busy each worker has been. Trackers register themselves by
+stage name, so one TerminalProgress display or metrics endpoint shows every stage of the process.
+
+Example:
+    run_all_simulations(folder, progress=True, metrics_port=9108)  # scrape http://127.0.0.1:9108/metrics
+
+    tracker = ProgressTracker("simulate", len(sim_filenames))
+    with TerminalProgress():
+        run_many_sims(sim_filenames, progress=tracker)
+"""
+
+import sys
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+
+# stage name -> its latest ProgressTracker
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+def format_seconds(seconds):
+    if seconds == None:
+        return "?"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class ProgressTracker:
+    """Counts the jobs of one stage of a batch. Safe to share between worker threads.
+
+    Args:
+        stage (str): stage name, e.g. 'convert', 'simulate', 'pipeline' or 'write'. Replaces an earlier tracker of
+            the same stage in displays and metrics.
+        total (int, optional): number of jobs in the stage, if known. Defaults to None.
+        window (float, optional): seconds of finished jobs the rate is measured over. Defaults to 60.
+    """
+
+    ###
+    def __init__(self, stage, total=None, window=60.0):
+        self.stage = stage
+        self.total = total
+        self.window = window
+        self.started = time()
+        self.done = 0
+        self.failed = 0
+        self.last_progress = self.started
+        self._lock = threading.Lock()
+        # worker -> start time of its running job, and busy seconds of its finished jobs
+        self._running = {}
+        self._busy = {}
+        self._finished = deque()
+        with _trackers_lock:
+            _trackers[stage] = self
+
+    ###
+    def set_total(self, total):
+        with self._lock:
+            self.total = total
+
+    ###
+    def start_job(self, worker):
+        with self._lock:
+            self._running[worker] = time()
+            self._busy.setdefault(worker, 0.0)
+
+    ###
+    def finish_job(self, worker, ok=True, seconds=None):
+        """Counts a finished job; ok=False counts it as failed. seconds gives the job's run time when it ran
+        elsewhere (e.g. in a worker process) and start_job wasn't called."""
+        now = time()
+        with self._lock:
+            started = self._running.pop(worker, now)
+            self._busy[worker] = self._busy.get(worker, 0.0) + (now - started if seconds == None else seconds)
+            if ok:
+                self.done += 1
+            else:
+                self.failed += 1
+            self.last_progress = now
+            self._finished.append(now)
+            while self._finished and self._finished[0] < now - self.window:
+                self._finished.popleft()
+
+    ###
+    def snapshot(self):
+        """Returns the current counts and rates.
+
+        Returns:
+            [dict]: 'stage', 'total', 'done', 'failed', 'running', 'rate' (jobs/sec), 'eta' (seconds, None when
+                unknown), 'elapsed', 'since_progress' (seconds) and 'utilization' (worker -> busy fraction)
+        """
+        now = time()
+        with self._lock:
+            elapsed = max(now - self.started, 1e-9)
+            recent = [t for t in self._finished if t >= now - self.window]
+            rate = len(recent) / min(self.window, elapsed)
+            finished = self.done + self.failed
+            eta = None
+            if self.total != None and rate > 0:
+                eta = max(0, self.total - finished) / rate
+            utilization = {}
+            for worker, busy in self._busy.items():
+                if worker in self._running:
+                    busy += now - self._running[worker]
+                utilization[worker] = min(1.0, busy / elapsed)
+            return {
+                "stage": self.stage,
+                "total": self.total,
+                "done": self.done,
+                "failed": self.failed,
+                "running": len(self._running),
+                "rate": rate,
+                "eta": eta,
+                "elapsed": elapsed,
+                "since_progress": now - self.last_progress,
+                "utilization": utilization,
+            }
+
+    ###
+    def format_line(self):
+        """One line summary, e.g. 'simulate 120/1000 (3 failed) 4.20 jobs/s ETA 3m29s 8 running 97% busy'."""
+        s = self.snapshot()
+        total = "?" if s["total"] == None else s["total"]
+        busy = sum(s["utilization"].values()) / len(s["utilization"]) if len(s["utilization"]) > 0 else 0.0
+        line = f"{s['stage']} {s['done'] + s['failed']}/{total} ({s['failed']} failed) {s['rate']:.2f} jobs/s ETA {format_seconds(s['eta'])}"
+        return line + f" {s['running']} running {busy:.0%} busy"
+
+
+def active_trackers():
+    with _trackers_lock:
+        return list(_trackers.values())
+
+
+class TerminalProgress:
+    """Prints the progress of every tracker in the process while the block runs: rewritten in place on a terminal,
+    one line per interval otherwise (e.g. in a batch job's log).
+
+    Args:
+        interval (float, optional): seconds between updates. Defaults to 1 on a terminal and 30 otherwise.
+        stream (file, optional): where to print. Defaults to sys.stderr.
+    """
+
+    ###
+    def __init__(self, interval=None, stream=None):
+        self.stream = stream if stream != None else sys.stderr
+        self.tty = hasattr(self.stream, "isatty") and self.stream.isatty()
+        self.interval = interval if interval != None else (1.0 if self.tty else 30.0)
+        self._stop = threading.Event()
+        self._thread = None
+        self._width = 0
+
+    ###
+    def render(self):
+        line = " | ".join(tracker.format_line() for tracker in active_trackers())
+        if self.tty:
+            self.stream.write("\r" + line.ljust(self._width))
+            self._width = len(line)
+        elif line:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+    ###
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.render()
+
+    ###
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name="progress-display", daemon=True)
+        self._thread.start()
+        return self
+
+    ###
+    def stop(self):
+        """Stops updating after printing the final state."""
+        self._stop.set()
+        self._thread.join()
+        self.render()
+        if self.tty:
+            self.stream.write("\n")
+
+    ###
+    def __enter__(self):
+        return self.start()
+
+    ###
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+        return False
+
+
+def prometheus_text(trackers=None):
+    """Renders trackers (default: every registered tracker) in the Prometheus text exposition format."""
+    if trackers == None:
+        trackers = active_trackers()
+    metrics = [
+        ("foresite_jobs_total", "gauge", "Jobs in the stage, when known.", lambda s: s["total"]),
+        ("foresite_jobs_done_total", "counter", "Jobs finished without error.", lambda s: s["done"]),
+        ("foresite_jobs_failed_total", "counter", "Jobs that failed.", lambda s: s["failed"]),
+        ("foresite_jobs_running", "gauge", "Jobs running now.", lambda s: s["running"]),
+        ("foresite_jobs_per_second", "gauge", "Jobs finished per second over the last window.", lambda s: s["rate"]),
+        ("foresite_eta_seconds", "gauge", "Estimated seconds until the stage finishes.", lambda s: s["eta"]),
+        ("foresite_seconds_since_progress", "gauge", "Seconds since a job last finished.", lambda s: s["since_progress"]),
+    ]
+    snapshots = [tracker.snapshot() for tracker in trackers]
+    lines = []
+    for name, kind, help_text, value in metrics:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for s in snapshots:
+            if value(s) != None:
+                lines.append(f'{name}{{stage="{s["stage"]}"}} {value(s)}')
+    lines.append("# HELP foresite_worker_utilization Fraction of the stage's time a worker was running a job.")
+    lines.append("# TYPE foresite_worker_utilization gauge")
+    for s in snapshots:
+        for worker, busy in sorted(s["utilization"].items()):
+            lines.append(f'foresite_worker_utilization{{stage="{s["stage"]}",worker="{worker}"}} {busy}')
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    ###
+    def do_GET(self):
+        if self.path.split("?")[0] not in ["/", "/metrics"]:
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    ###
+    def log_message(self, format, *args):
+        # scrapes every few seconds would flood the batch's output
+        pass
+
+
+def serve_metrics(port=9108, host="127.0.0.1"):
+    """Serves prometheus_text() at http://host:port/metrics from a background thread.
+
+    Returns:
+        [ThreadingHTTPServer]: the server; call shutdown() to stop it
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="progress-metrics", daemon=True)
+    thread.start()
+    print(f"Serving progress metrics at http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,219 @@
+"""
+CPU and memory limits of the current machine or container, and adaptive sizing of the runner's worker count.
+
+Limits come from cgroup v2 (or v1) when the process runs under a quota, otherwise from the machine itself. Memory
+use of running APSIM jobs is sampled from /proc, so sizing only adapts on Linux; elsewhere the CPU based worker
+count is used as is.
+"""
+
+import math
+import os
+import threading
+from multiprocessing import cpu_count
+
+# memory assumed per APSIM job until real jobs have been measured
+DEFAULT_JOB_MEMORY = 512 * 1024**2
+
+
+def read_first_line(path):
+    try:
+        with open(path, "r") as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit():
+    """Returns the cgroup CPU quota in cores (e.g. 2.5), or None if the process isn't CPU limited."""
+    cpu_max = read_first_line("/sys/fs/cgroup/cpu.max")
+    if cpu_max != None:
+        quota, period = (cpu_max.split() + ["100000"])[:2]
+        if quota == "max":
+            return None
+        return int(quota) / int(period)
+    quota = read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota == None or period == None or int(quota) <= 0:
+        return None
+    return int(quota) / int(period)
+
+
+def cgroup_memory_limit():
+    """Returns the cgroup memory limit in bytes, or None if the process isn't memory limited."""
+    memory_max = read_first_line("/sys/fs/cgroup/memory.max")
+    if memory_max == None:
+        memory_max = read_first_line("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+    if memory_max == None or memory_max == "max":
+        return None
+    limit = int(memory_max)
+    # cgroup v1 reports 'unlimited' as a huge page aligned number
+    if limit >= 2**60:
+        return None
+    return limit
+
+
+def read_meminfo():
+    """Returns /proc/meminfo as a dict of bytes, or an empty dict if it isn't available."""
+    meminfo = {}
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                meminfo[key] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return meminfo
+
+
+def available_cpus():
+    """Number of CPUs this process may use, honouring CPU affinity and cgroup quotas."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = cpu_count()
+    quota = cgroup_cpu_limit()
+    if quota != None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
+def memory_limit():
+    """Memory in bytes this process tree may use: the cgroup limit, or total RAM. None if unknown."""
+    limit = cgroup_memory_limit()
+    if limit != None:
+        return limit
+    return read_meminfo().get("MemTotal")
+
+
+def available_memory():
+    """Memory in bytes that can still be allocated before hitting the cgroup limit or running out of RAM. None if
+    unknown."""
+    available = read_meminfo().get("MemAvailable")
+    limit = cgroup_memory_limit()
+    if limit != None:
+        current = read_first_line("/sys/fs/cgroup/memory.current") or read_first_line("/sys/fs/cgroup/memory/memory.usage_in_bytes")
+        if current != None:
+            in_cgroup = max(0, limit - int(current))
+            available = in_cgroup if available == None else min(available, in_cgroup)
+    return available
+
+
+def default_num_workers(job_memory=DEFAULT_JOB_MEMORY):
+    """Number of workers to use when none is given: the usable CPUs less two for the OS, capped by how many jobs of
+    job_memory bytes fit in memory, and never below one.
+
+    Returns:
+        [int]: number of workers
+    """
+    workers = available_cpus() - 2
+    limit = memory_limit()
+    if limit != None:
+        workers = min(workers, limit // job_memory)
+    return max(1, int(workers))
+
+
+def process_tree_rss():
+    """Samples the resident memory of each child process of this process, including the child's own descendants
+    (e.g. APSIM started through a launcher script).
+
+    Returns:
+        [dict]: child pid -> resident bytes of it and its descendants
+    """
+    parents = {}
+    rss = {}
+    try:
+        pids = [int(p) for p in os.listdir("/proc") if p.isdigit()]
+    except OSError:
+        return {}
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat", "r") as f:
+                stat = f.read()
+            with open(f"/proc/{pid}/statm", "r") as f:
+                rss[pid] = int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            continue
+        # the command name can contain spaces, fields after it are fixed
+        parents[pid] = int(stat.rsplit(")", 1)[1].split()[1])
+    me = os.getpid()
+    totals = {}
+    for pid in rss:
+        # walk up to find which direct child of ours this process belongs to
+        ancestor = pid
+        while ancestor in parents and parents[ancestor] != me:
+            ancestor = parents[ancestor]
+            if ancestor <= 1:
+                break
+        if parents.get(ancestor) == me:
+            totals[ancestor] = totals.get(ancestor, 0) + rss[pid]
+    return totals
+
+
+class AdaptiveConcurrency:
+    """Scales a scheduler's concurrency between min_workers and the scheduler's worker count so the running jobs fit
+    in memory.
+
+    Every interval seconds the controller samples the memory of each running job and remembers the largest job seen.
+    The target is the number of such jobs that fit in the memory still available (after headroom), given what the
+    running jobs already use. The scheduler is scaled down to the target at once and up by one worker per interval.
+
+    Args:
+        scheduler (SimScheduler): scheduler to resize with set_concurrency()
+        min_workers (int, optional): never go below this. Defaults to 1.
+        headroom (float, optional): fraction of the memory limit to keep free. Defaults to 0.1.
+        interval (float, optional): seconds between samples. Defaults to 1.0.
+        job_memory (int, optional): bytes assumed per job until one has been measured. Defaults to DEFAULT_JOB_MEMORY.
+    """
+
+    ###
+    def __init__(self, scheduler, min_workers=1, headroom=0.1, interval=1.0, job_memory=DEFAULT_JOB_MEMORY):
+        self.scheduler = scheduler
+        self.min_workers = min_workers
+        self.headroom = headroom
+        self.interval = interval
+        self.job_memory = job_memory
+        self.peak_job_rss = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    ###
+    def target_workers(self, job_rss, available, limit):
+        """Number of jobs that fit, given the per-job rss of the running jobs and the memory still available."""
+        per_job = self.peak_job_rss if self.peak_job_rss > 0 else self.job_memory
+        if available == None:
+            return self.scheduler.num_workers
+        budget = available + sum(job_rss.values())
+        if limit != None:
+            budget = min(budget, limit) - self.headroom * limit
+        return max(self.min_workers, min(self.scheduler.num_workers, int(budget // per_job)))
+
+    ###
+    def sample(self):
+        """Takes one measurement and resizes the scheduler."""
+        job_rss = process_tree_rss()
+        if len(job_rss) > 0:
+            self.peak_job_rss = max(self.peak_job_rss, max(job_rss.values()))
+        target = self.target_workers(job_rss, available_memory(), memory_limit())
+        current = self.scheduler.concurrency
+        if target < current:
+            self.scheduler.set_concurrency(target)
+        elif target > current:
+            self.scheduler.set_concurrency(current + 1)
+        return self.scheduler.concurrency
+
+    ###
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    ###
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="apsim-adaptive-concurrency", daemon=True)
+        self._thread.start()
+
+    ###
+    def stop(self):
+        self._stop.set()
+        if self._thread != None:
+            self._thread.join()
@@ -6,159 +6,946 @@ Created as part of ISU C-CHANGE Foresite system on 6 Jan 2020
 """
 
 import fnmatch
+import json
 import os
+import signal
 import subprocess
 import sys
 import threading
 import traceback
+from contextlib import contextmanager, nullcontext
 from glob import glob
-from multiprocessing import cpu_count
-from os import getcwd
 from queue import Queue
 from time import perf_counter
+from xml.etree.ElementTree import parse
+
+from apsim.apsim_output_parser import parse_all_output
+from apsim.checkpoint import CHECKPOINT_FILENAME, Checkpoint
+from apsim.executables import is_windows, registry
+from apsim.job_cost import load_job_history, order_by_cost
+from apsim.output_store import archive_outputs, check_compression, compress_outputs, output_exists, remove_outputs
+from apsim.progress import ProgressTracker, TerminalProgress, serve_metrics
+from apsim.resources import available_cpus, default_num_workers
+from apsim.run_manifest import describe_job_file, get_out_filenames, load_run_manifest
+from apsim.scheduler import SimScheduler
+from apsim.scratch import make_scratch_dir, publish_scratch_dir
+from apsim.sim_converter import UnsupportedComponent, convert_apsim_file
+from apsim.telemetry import LEDGER_FILENAME, RunLedger, add_stage, finish_job_record, get_mukey, start_job_record
 
 
 def find_apsim_exe():
     """
-    Finds the most recent [-1] version of APSIM 7.XX installed on the system (if installed in default Windows location) to get Apsim.exe path.
+    Finds the APSIM 7.XX Apsim.exe path. Resolved once per process, see apsim.executables.
 
     Returns:
         [str] -- [Path to the APSIM 7.XX exe]
     """
     try:
-        # find all installed Apsim.exe at default installation location and return the most recent (last).
-        apsim_exes = glob("C:\\Program Files (x86)\\APSIM7*\\Model\\Apsim.exe")
-        current_apsim_exe = apsim_exes[-1]
-        return current_apsim_exe
-    except:
+        return registry.apsim_command()[-1]
+    except FileNotFoundError:
         print("No APSIM 7.XX executable found.")
 
 
 def find_to_sim_exe():
     """
-    Finds the most recent [-1] version of APSIM 7.XX installed on the system (if installed in default Windows location) to get the ApsimToSim.exe path.
-
-    Keyword Arguments:
-        to_sim_path {str} -- [Path for APSIM to sim executable if one isn't found.] (default: {None})
+    Finds the APSIM 7.XX ApsimToSim.exe path. Resolved once per process, see apsim.executables.
 
     Returns:
         [str] -- [Path to the APSIM 7.XX exe]
     """
     try:
-        # find all installed ApsimToSim.exe at default installation location and return the most recent (last[-1]).
-        sim_exes = glob("C:\\Program Files (x86)\\APSIM7*\\Model\\ApsimToSim.exe")
-        current_to_sim_exe = sim_exes[-1]
-        return current_to_sim_exe
-    except:
+        return registry.to_sim_command()[-1]
+    except FileNotFoundError:
         print("No APSIM 7.XX to sim executable found.")
 
 
-def convert_apsim_to_sim(apsim_filename, lock):
-    """Converts an .apsim file to .sim files."""
-    apsim_to_sim_exe = find_to_sim_exe()
-    startupinfo = None
-    if "win" in sys.platform:
-        si = subprocess.STARTUPINFO()
-        si.dwFlags = subprocess.STARTF_USESHOWWINDOW
-        # si.wShowWindow = 6 # SW_MINIMIZE
-        si.wShowWindow = 0  # SW_HIDE - hides cmd windows
-        startupinfo = si
-    apsim_tmp_filename = apsim_filename.replace(".apsim", ".tmp")
-    with open(apsim_tmp_filename, "w") as tmp_file:
-        subprocess.call(
-            [apsim_to_sim_exe, apsim_filename],
-            startupinfo=startupinfo,
-            stdout=tmp_file,
-            stderr=tmp_file,
-        )
+def get_startupinfo():
+    """Returns subprocess startup info that hides the cmd window on Windows, None elsewhere."""
+    if not is_windows():
+        return None
+    si = subprocess.STARTUPINFO()
+    si.dwFlags = subprocess.STARTF_USESHOWWINDOW
+    # si.wShowWindow = 6 # SW_MINIMIZE
+    si.wShowWindow = 0  # SW_HIDE - hides cmd windows
+    return si
+
+
+FAILURE_MANIFEST = "failed_runs.json"
+
+
+def get_log_filename(filename):
+    """Returns the .tmp log path that APSIM output is redirected to for an .apsim or .sim file."""
+    return os.path.splitext(filename)[0] + ".tmp"
+
+
+def read_log_tail(log_filename, num_lines=5):
+    """Returns the last non-empty lines of a .tmp log, or an empty list if the log doesn't exist."""
+    if not os.path.exists(log_filename):
+        return []
+    with open(log_filename, "r", errors="replace") as log_file:
+        lines = [line.rstrip() for line in log_file if line.strip()]
+    return lines[-num_lines:]
+
+
+def classify_run(stage, filename, returncode):
+    """Decides whether one convert or simulate attempt succeeded.
+
+    A conversion succeeds when ApsimToSim exits with 0 and wrote every .sim file. A simulation succeeds when
+    Apsim.exe exits with 0 and the last line of its .tmp log reports 100%. A pack (an .apsim file run directly)
+    succeeds when Apsim.exe exits with 0 and every simulation wrote its .out files.
+
+    Args:
+        stage (str): 'convert', 'simulate' or 'pack'
+        filename (str): .apsim file for 'convert' and 'pack', .sim file for 'simulate'
+        returncode (int): exit code of the APSIM process
+
+    Returns:
+        [str]: None on success, otherwise the failure class: 'exit_code', 'missing_sim', 'missing_out' or 'incomplete'
+    """
+    if returncode != 0:
+        return "exit_code"
+    if stage == "convert":
+        if not all(os.path.exists(sim_filename) for sim_filename in get_sim_filenames(filename)):
+            return "missing_sim"
+        return None
+    if stage == "pack":
+        if not all(os.path.exists(out_filename) for out_filenames in get_sim_outputs(filename).values() for out_filename in out_filenames):
+            return "missing_out"
+        return None
+    log_tail = read_log_tail(get_log_filename(filename), num_lines=1)
+    if len(log_tail) == 0 or "100%" not in log_tail[-1]:
+        return "incomplete"
+    return None
+
+
+class RetryPolicy:
+    """How often and how patiently to retry a failed APSIM run.
+
+    Args:
+        max_attempts (int, optional): total attempts including the first. Defaults to 5.
+        backoff (float, optional): seconds to wait before the second attempt. Defaults to 1.0.
+        multiplier (float, optional): factor the wait grows by after each attempt. Defaults to 2.0.
+        max_backoff (float, optional): longest wait between attempts in seconds. Defaults to 60.0.
+    """
+
+    ###
+    def __init__(self, max_attempts=5, backoff=1.0, multiplier=2.0, max_backoff=60.0):
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+
+    ###
+    def delay(self, attempt):
+        """Seconds to wait after failed attempt number attempt (1-based)."""
+        return min(self.max_backoff, self.backoff * self.multiplier ** (attempt - 1))
+
+
+class SimFailed(Exception):
+    """Raised when a conversion or simulation still fails after every retry. records holds one failure manifest
+    entry per file that failed."""
+
+    ###
+    def __init__(self, records):
+        self.records = records
+        first = records[0]
+        super().__init__(f"{first['stage']} failed after {first['attempts']} attempt(s): {first['reason']}")
+
+
+# set while a batch is being cancelled, and the APSIM processes running right now with the cancel event of the job
+# each belongs to (see cancellable_job), or None
+_cancel = threading.Event()
+_children = {}
+_children_lock = threading.Lock()
+# the cancel event of the job running on each thread, see cancellable_job
+_job = threading.local()
+# batches running in this process, see cancel_scope
+_batches = 0
+_batches_lock = threading.Lock()
+
+# True/False once use_native_converter() has been called, otherwise FORESITE_NATIVE_CONVERT decides
+_native_convert = None
+
+
+class RunCancelled(Exception):
+    """Raised in jobs that were stopped, or never started, because the batch was cancelled."""
+
+
+def cancel_runs():
+    """Cancels the batch running in this process: jobs that haven't started are skipped and running APSIM processes
+    are terminated. Finished jobs stay in the batch checkpoint, see resume."""
+    _cancel.set()
+    with _children_lock:
+        procs = list(_children)
+    for proc in procs:
+        try:
+            proc.terminate()
+        except OSError:
+            pass
+
+
+def run_cancelled():
+    """True while the batch running in this process is being cancelled."""
+    return _cancel.is_set()
+
+
+def check_cancelled():
+    """Raises RunCancelled if the batch, or the job running on this thread (see cancel_job), has been cancelled."""
+    if _cancel.is_set():
+        raise RunCancelled("run cancelled")
+    event = getattr(_job, "cancel", None)
+    if event != None and event.is_set():
+        raise RunCancelled("job cancelled")
+
+
+@contextmanager
+def cancellable_job(event):
+    """Runs the block, on the current thread, as a job that cancel_job(event) stops on its own while the rest of the
+    batch goes on."""
+    _job.cancel = event
+    try:
+        yield
+    finally:
+        _job.cancel = None
+
+
+def cancel_job(event):
+    """Cancels the job running in cancellable_job(event): its running APSIM process is terminated and it raises
+    RunCancelled before starting another."""
+    with _children_lock:
+        event.set()
+        procs = [proc for proc, job_event in _children.items() if job_event is event]
+    for proc in procs:
+        try:
+            proc.terminate()
+        except OSError:
+            pass
+
+
+@contextmanager
+def cancel_scope():
+    """Runs the block as a batch for cancel_runs(). A cancellation lasts until the outermost batch running in the
+    process ends, so it never carries over into the next batch."""
+    global _batches
+    with _batches_lock:
+        if _batches == 0:
+            _cancel.clear()
+        _batches += 1
+    try:
+        yield
+    finally:
+        with _batches_lock:
+            _batches -= 1
+            if _batches == 0:
+                _cancel.clear()
 
 
-def worker_apsim(queue, lock):
-    """Process files from the queue."""
-    for args in iter(queue.get, None):
+@contextmanager
+def cancel_on_signals():
+    """Runs the block as a batch (see cancel_scope) and cancels it with cancel_runs() when SIGINT or SIGTERM arrives.
+    A second signal interrupts the process as usual. Handlers can only be installed from the main thread; elsewhere
+    the block runs without them."""
+    with cancel_scope():
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+
+        def handler(signum, frame):
+            if _cancel.is_set():
+                raise KeyboardInterrupt
+            print(f"Received signal {signum}, cancelling runs...")
+            cancel_runs()
+
+        previous = {signum: signal.signal(signum, handler) for signum in [signal.SIGINT, signal.SIGTERM]}
         try:
-            convert_apsim_to_sim(args, lock)
-        except Exception as e:  # catch exceptions to avoid exiting the thread prematurely
-            print(f"{args} failed: {e}")  # , file=sys.stderr
+            yield
+        finally:
+            for signum, prev_handler in previous.items():
+                signal.signal(signum, prev_handler)
+
+
+def run_with_retry(stage, filename, policy=None, lock=None, stats=None):
+    """Converts an .apsim file or runs a .sim file, retrying failed attempts according to policy.
+
+    Args:
+        stage (str): 'convert', 'simulate' or 'pack'
+        filename (str): .apsim file for 'convert' and 'pack', .sim file for 'simulate'
+        policy (RetryPolicy, optional): retry settings. Defaults to RetryPolicy().
+        stats (dict, optional): updated with 'seconds' (all attempts and waits), 'attempts', 'returncode' and
+            'peak_rss' (largest over attempts). Defaults to None.
+
+    Raises:
+        SimFailed: when every attempt failed, or the APSIM process couldn't be started
+        RunCancelled: when the batch was cancelled
+
+    Returns:
+        [int]: number of attempts it took
+    """
+    if policy == None:
+        policy = RetryPolicy()
+    if stats == None:
+        stats = {}
+    run = {"convert": convert_apsim_to_sim, "simulate": run_a_sim, "pack": run_a_pack}[stage]
+    start = perf_counter()
+    peak_rss = None
+    for attempt in range(1, policy.max_attempts + 1):
+        check_cancelled()
+        attempt_stats = {}
+        try:
+            returncode = run(filename, lock, attempt_stats)
+        except OSError as e:
+            # the executable is missing or not runnable, retrying won't help
+            returncode = None
+            reason = f"error: {e}"
+            break
+        if attempt_stats.get("peak_rss") != None:
+            peak_rss = max(peak_rss or 0, attempt_stats["peak_rss"])
+        stats.update(seconds=perf_counter() - start, attempts=attempt, returncode=returncode, peak_rss=peak_rss)
+        # a terminated process is no failure of the run itself
+        check_cancelled()
+        reason = classify_run(stage, filename, returncode)
+        if reason == None:
+            return attempt
+        if attempt < policy.max_attempts:
+            _cancel.wait(policy.delay(attempt))
+    stats.update(seconds=perf_counter() - start, attempts=attempt, returncode=returncode, peak_rss=peak_rss)
+    record = {
+        "stage": stage,
+        "file": filename,
+        "reason": reason,
+        "returncode": returncode,
+        "attempts": attempt,
+        "log_tail": read_log_tail(get_log_filename(filename)),
+    }
+    raise SimFailed([record])
+
+
+def collect_failures(future, filename=None, stage=None):
+    """Returns the failure manifest entries carried by a finished scheduler future. Unexpected exceptions are
+    recorded against filename and stage."""
+    if future.cancelled():
+        return []
+    e = future.exception()
+    if e == None or isinstance(e, RunCancelled):
+        return []
+    if isinstance(e, SimFailed):
+        return e.records
+    return [{"stage": stage, "file": filename, "reason": f"error: {e}", "returncode": None, "attempts": 1, "log_tail": []}]
+
+
+def write_failure_manifest(manifest_path, failures):
+    """Writes failure records to a JSON manifest, replacing any previous manifest."""
+    with open(manifest_path, "w") as manifest_file:
+        json.dump(failures, manifest_file, indent=1)
+    if len(failures) > 0:
+        print(f"{len(failures)} runs failed, see {manifest_path}")
+
+
+def load_failure_manifest(manifest_path):
+    """Reads failure records written by write_failure_manifest. Returns an empty list if there is no manifest."""
+    if not os.path.exists(manifest_path):
+        return []
+    with open(manifest_path, "r") as manifest_file:
+        return json.load(manifest_file)
+
+
+def call_apsim(command, log_filename, stats=None):
+    """Runs an APSIM command with stdout and stderr redirected to log_filename.
+
+    Args:
+        command (list): command and arguments
+        log_filename (str): .tmp log to write
+        stats (dict, optional): updated with 'peak_rss', the child's peak resident memory in bytes where the platform
+            reports it (None elsewhere). Defaults to None.
+
+    Returns:
+        [int]: exit code
+    """
+    with open(log_filename, "w") as tmp_file:
+        proc = subprocess.Popen(command, stdout=tmp_file, stderr=tmp_file, startupinfo=get_startupinfo())
+        event = getattr(_job, "cancel", None)
+        with _children_lock:
+            _children[proc] = event
+        # cancel_runs() or cancel_job() may have gone through the children just before this one was added
+        if _cancel.is_set() or (event != None and event.is_set()):
+            proc.terminate()
+        try:
+            if not hasattr(os, "wait4"):
+                peak_rss = None
+                proc.wait()
+            else:
+                # reap the child ourselves to get its resource usage
+                _, status, rusage = os.wait4(proc.pid, 0)
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                # ru_maxrss is in kilobytes on Linux and bytes on macOS
+                peak_rss = rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+        finally:
+            with _children_lock:
+                _children.pop(proc, None)
+    if stats != None:
+        stats["peak_rss"] = peak_rss
+    return proc.returncode
+
+
+def use_native_converter(enabled=True):
+    """Converts .apsim files in-process with apsim.sim_converter instead of starting ApsimToSim.exe for each file,
+    for the rest of the process. Setting FORESITE_NATIVE_CONVERT=1 does the same, e.g. for job queue workers."""
+    global _native_convert
+    _native_convert = enabled
 
 
-def convert_all_apsim_to_sim(apsim_filename_list, num_cores=None):
-    """Converts .apsim files to .sim files."""
-    if num_cores == None:
-        num_cores = cpu_count() - 2
+def native_convert_enabled():
+    if _native_convert != None:
+        return _native_convert
+    return os.environ.get("FORESITE_NATIVE_CONVERT") == "1"
+
+
+def convert_natively(apsim_filename, log_filename):
+    """Converts an .apsim file with apsim.sim_converter, logging like ApsimToSim. Returns an exit code, or None when
+    the file needs ApsimToSim."""
+    with open(log_filename, "w") as tmp_file:
+        try:
+            for sim_filename in convert_apsim_file(apsim_filename):
+                tmp_file.write(f"Written {os.path.basename(sim_filename)}\n")
+        except UnsupportedComponent as e:
+            tmp_file.write(f"Not converted natively: {e}\n")
+            return None
+        except (OSError, SyntaxError, ValueError) as e:
+            tmp_file.write(f"Error: {e}\n")
+            return 1
+    return 0
+
+
+def convert_apsim_to_sim(apsim_filename, lock=None, stats=None):
+    """Converts an .apsim file to .sim files, in-process when use_native_converter() is on and the file only uses
+    components apsim.sim_converter handles."""
+    apsim_tmp_filename = get_log_filename(apsim_filename)
+    if native_convert_enabled():
+        returncode = convert_natively(apsim_filename, apsim_tmp_filename)
+        if returncode != None:
+            if stats != None:
+                stats["peak_rss"] = None
+            return returncode
+    return call_apsim(registry.to_sim_command() + [apsim_filename], apsim_tmp_filename, stats)
+
+
+def report_failure(filename):
+    """Returns a scheduler callback that prints the exception of a failed job for filename."""
+
+    def callback(future):
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e != None and not isinstance(e, RunCancelled):
+            print(f"{filename} failed: {e}")  # , file=sys.stderr
+
+    return callback
+
+
+def convert_job(apsim_filename, lock=None, policy=None, ledger=None):
+    """Converts one .apsim file with retries, writing its timing and resource record to ledger if given."""
+    check_cancelled()
+    record = start_job_record(apsim_filename)
+    stats = {}
+    try:
+        return run_with_retry("convert", apsim_filename, policy, lock, stats)
+    except RunCancelled:
+        record["status"] = "cancelled"
+        raise
+    except:
+        record["status"] = "failed"
+        raise
+    finally:
+        add_stage(record, "convert", stats)
+        if ledger != None:
+            ledger.write(finish_job_record(record, []))
+
+
+def convert_all_apsim_to_sim(apsim_filename_list, num_cores=None, policy=None, adaptive=False, checkpoint=None, progress=None, ledger=None):
+    """Converts .apsim files to .sim files. Returns failure manifest entries for files that couldn't be converted.
+    Each conversion is written to ledger (a RunLedger) if given, converted files are marked in checkpoint (a
+    Checkpoint) if given, and counted in progress (a ProgressTracker)."""
     apsim_file_total = len(apsim_filename_list)
     print(f"Converting {apsim_file_total} .apsim files to .sim files.")
+    failures = []
+    with cancel_scope(), SimScheduler(num_cores, adaptive=adaptive, progress=progress) as scheduler:
+        for apsim_filename in apsim_filename_list:
+            if _cancel.is_set():
+                break
+            future = scheduler.submit(
+                convert_job,
+                apsim_filename,
+                policy=policy,
+                ledger=ledger,
+                callback=lambda future, apsim_filename=apsim_filename: failures.extend(collect_failures(future, apsim_filename, "convert")),
+            )
+            if checkpoint != None:
+                future.add_done_callback(checkpoint.callback("convert", apsim_filename))
+    return failures
 
-    # add .apsim files to Queue
-    q = Queue()
-    for apsim_filename in apsim_filename_list:
-        q.put_nowait(apsim_filename)
 
-    # run .apsim files and start threads to convert
-    lock = threading.RLock()
-    threads = [threading.Thread(target=worker_apsim, args=(q, lock)) for _ in range(num_cores)]
-    for t in threads:
-        t.daemon = False  # program quits when threads die
-        t.start()
-    for _ in threads:
-        q.put_nowait(None)  # signal no more files
-    for t in threads:
-        t.join()  # wait for completion
+def run_a_sim(sim_filename, lock=None, stats=None):
+    """Runs a .sim file in APSIM."""
+    tmp_filename = get_log_filename(sim_filename)
+    return call_apsim(registry.apsim_command() + [sim_filename], tmp_filename, stats)
 
 
-def run_a_sim(sim_filename, lock):
-    """Runs a .sim file in APSIM."""
-    apsim_exe = find_apsim_exe()
-    tmp_filename = sim_filename.replace(".sim", ".tmp")
-    startupinfo = None
-    if "win" in sys.platform:
-        si = subprocess.STARTUPINFO()
-        si.dwFlags = subprocess.STARTF_USESHOWWINDOW
-        # si.wShowWindow = 6 # SW_MINIMIZE
-        si.wShowWindow = 0  # SW_HIDE - hides cmd windows
-        startupinfo = si
-    with open(tmp_filename, "w") as tmp_file:
-        subprocess.call(
-            [apsim_exe, sim_filename],
-            stdout=tmp_file,
-            stderr=tmp_file,
-            startupinfo=startupinfo,
-        )
+def run_a_pack(apsim_filename, lock=None, stats=None):
+    """Runs every simulation of an .apsim file with one Apsim.exe process, without converting to .sim files first."""
+    # outputs left from an earlier attempt would pass for this attempt's
+    for out_filenames in get_sim_outputs(apsim_filename).values():
+        for out_filename in out_filenames:
+            if os.path.exists(out_filename):
+                os.remove(out_filename)
+    tmp_filename = get_log_filename(apsim_filename)
+    return call_apsim(registry.apsim_command() + [apsim_filename], tmp_filename, stats)
 
 
-def worker_sim(queue, lock):
-    """Process files from the queue."""
-    for args in iter(queue.get, None):
+def run_many_sims(sim_filename_list, num_cores=None, policy=None, adaptive=False, ledger=None, checkpoint=None, progress=None, compress=None, callback=None):
+    """Runs apsim in parallel for every .sim file in sim_filename_list. Returns failure manifest entries for sims
+    that failed every retry. Each run is written to ledger (a RunLedger) if given, finished sims are marked in
+    checkpoint (a Checkpoint) if given, runs are counted in progress (a ProgressTracker) if given, the outputs
+    of finished sims are compressed with compress ('gzip' or 'zstd', see apsim.output_store) if given, and
+    callback is called with (sim_filename, future) as each sim finishes if given."""
+    print(f"Running Apsim for {len(sim_filename_list)} .sim files...")
+    failures = []
+
+    def on_done(sim_filename):
+        def done(future):
+            failures.extend(collect_failures(future, sim_filename, "simulate"))
+            if callback != None:
+                callback(sim_filename, future)
+
+        return done
+
+    with cancel_scope(), SimScheduler(num_cores, adaptive=adaptive, progress=progress) as scheduler:
+        for sim_filename in sim_filename_list:
+            if _cancel.is_set():
+                break
+            future = scheduler.submit(
+                run_sim_job,
+                sim_filename,
+                policy=policy,
+                ledger=ledger,
+                compress=compress,
+                callback=on_done(sim_filename),
+            )
+            if checkpoint != None:
+                future.add_done_callback(checkpoint.callback("simulate", sim_filename))
+    print("Runs completed.")
+    return failures
+
+
+def get_sim_outputs(apsim_filename):
+    """Maps each .sim file ApsimToSim writes for an .apsim file (one per <simulation> node, next to the .apsim file)
+    to the .out files that simulation reports to. A .sim file maps to itself.
+
+    Args:
+        apsim_filename (str): path to .apsim file, or .sim file
+
+    Returns:
+        [dict]: .sim path -> list of .out paths
+    """
+    folder = os.path.dirname(apsim_filename)
+    root = parse(apsim_filename).getroot()
+    if root.tag == "simulation":
+        return {apsim_filename: get_out_filenames(apsim_filename, root)}
+    sim_outputs = {}
+    for sim in root.iter("simulation"):
+        sim_filename = os.path.join(folder, f"{sim.get('name')}.sim")
+        out_filenames = []
+        for outputfile in sim.iter("outputfile"):
+            filename = outputfile.find("filename")
+            if filename != None and filename.text:
+                out_filenames.append(os.path.join(folder, filename.text))
+        sim_outputs[sim_filename] = out_filenames
+    return sim_outputs
+
+
+def is_sim_file(filename):
+    return os.path.splitext(filename)[1] == ".sim"
+
+
+def standalone_sim_files(folder, apsim_filenames):
+    """Lists the .sim files in folder that aren't converted from any of apsim_filenames, e.g. those written by
+    create_mukey_runs(output_format='sim').
+
+    Args:
+        folder (str): runs folder
+        apsim_filenames (list): .apsim files in the folder
+
+    Returns:
+        [list]: paths of the .sim files
+    """
+    sim_filenames = glob(os.path.join(folder, "*.sim"))
+    if len(sim_filenames) == 0:
+        return []
+    converted = {os.path.basename(f) for apsim_filename in apsim_filenames for f in get_sim_filenames(apsim_filename)}
+    return [f for f in sim_filenames if os.path.basename(f) not in converted]
+
+
+def get_sim_filenames(apsim_filename):
+    """Lists the .sim files ApsimToSim writes for an .apsim file.
+
+    Args:
+        apsim_filename (str): path to .apsim file
+
+    Returns:
+        [list]: paths of the .sim files
+    """
+    return list(get_sim_outputs(apsim_filename))
+
+
+def compress_sim_outputs(sim_outputs, compress):
+    """Compresses the .out and .sum files of finished simulations.
+
+    Args:
+        sim_outputs (dict): .sim path -> list of .out paths, see get_sim_outputs
+        compress (str): 'gzip' or 'zstd', see apsim.output_store; None (or 'zip', archived once the batch ends)
+            leaves them as they are
+    """
+    if compress in [None, "zip"]:
+        return
+    for sim_filename, out_filenames in sim_outputs.items():
+        compress_outputs(out_filenames + [os.path.splitext(sim_filename)[0] + ".sum"], compress)
+
+
+def convert_and_simulate(apsim_filename, record, policy=None, lock=None, packed=False):
+    """Converts one .apsim file and runs each of its .sim files, or runs a packed .apsim file or a .sim file
+    directly, adding the stages' stats to a ledger record.
+
+    Raises:
+        SimFailed: with one record per stage/file that failed every retry
+    """
+    stats = {}
+    if packed or is_sim_file(apsim_filename):
+        # a .sim file has nothing to convert or unpack
+        stage = "simulate" if is_sim_file(apsim_filename) else "pack"
+        try:
+            run_with_retry(stage, apsim_filename, policy, lock, stats)
+        finally:
+            add_stage(record, "simulate", stats)
+        return
+    try:
+        run_with_retry("convert", apsim_filename, policy, lock, stats)
+    finally:
+        add_stage(record, "convert", stats)
+    failures = []
+    for sim_filename in get_sim_filenames(apsim_filename):
+        stats = {}
         try:
-            run_a_sim(args, lock)
-        except Exception as e:  # catch exceptions to avoid exiting the thread prematurely
-            print(f"{args} failed: {e}")  # , file=sys.stderr
+            run_with_retry("simulate", sim_filename, policy, lock, stats)
+        except SimFailed as e:
+            failures.extend(e.records)
+        add_stage(record, "simulate", stats)
+    if len(failures) > 0:
+        raise SimFailed(failures)
 
 
-def run_many_sims(sim_filename_list, num_cores=None):
-    """Runs apsim in parallel for every .sim file in sim_filename_list."""
-    print(f"Running Apsim for {len(sim_filename_list)} .sim files...")
-    if num_cores == None:
-        num_cores = cpu_count() - 2
-    # Add .sim files to Queue
-    q = Queue()
-    for sim_filename in sim_filename_list:
-        q.put_nowait(sim_filename)
-
-    # Run .sim files and start threads
-    lock = threading.RLock()
-    threads = [threading.Thread(target=worker_sim, args=(q, lock)) for _ in range(num_cores)]
-    for t in threads:
-        t.daemon = False  # program quits when threads die
-        t.start()
-    for _ in threads:
-        q.put_nowait(None)  # signal no more files
-    for t in threads:
-        t.join()  # wait for completion
+def convert_and_run(apsim_filename, lock=None, policy=None, cache=None, ledger=None, scratch=False, packed=False, compress=None):
+    """Converts one .apsim file and immediately runs the .sim files it produced. A .sim file, e.g. written by
+    create_mukey_runs(output_format='sim'), is run without converting.
+
+    Args:
+        apsim_filename (str): path to .apsim or .sim file
+        policy (RetryPolicy, optional): retry settings for both stages. Defaults to RetryPolicy().
+        cache (SimCache, optional): result cache. When the file's key is cached its .out and .sum files are
+            restored (and compressed like a run's) and nothing is converted or run. Defaults to None.
+        ledger (RunLedger, optional): ledger to write the job's timing and resource record to. Defaults to None.
+        scratch (bool or str, optional): run in a private scratch directory, created in scratch_root() (True) or in
+            the given folder, and publish the outputs next to the .apsim file by atomic rename. A job that fails or is
+            cancelled only publishes its .tmp logs. Defaults to False.
+        packed (bool, optional): run every simulation of the file with one Apsim.exe process instead of converting it
+            and running one process per .sim file. Meant for packs written by create_mukey_runs(pack_size=...). A
+            pack that fails is retried as a whole. Defaults to False.
+        compress (str, optional): compress the .out and .sum files once they are written, 'gzip' or 'zstd' (see
+            apsim.output_store). Defaults to None.
+
+    Raises:
+        SimFailed: with one record per stage/file that failed every retry
+
+    Returns:
+        [list]: the .sim path of each simulation that was run
+    """
+    check_cancelled()
+    record = start_job_record(apsim_filename)
+    folder = os.path.dirname(apsim_filename)
+    sim_outputs = get_sim_outputs(apsim_filename)
+    out_filenames = [f for outs in sim_outputs.values() for f in outs]
+    # cached with the .sum files, so a restored file leaves what a run would
+    cached_filenames = out_filenames + [os.path.splitext(sim_filename)[0] + ".sum" for sim_filename in sim_outputs]
+    if len(sim_outputs) > 0:
+        record["mukey"] = get_mukey(list(sim_outputs)[0])
+    try:
+        if cache != None:
+            key = cache.key(apsim_filename)
+            if cache.get(key, cached_filenames):
+                record["status"] = "cached"
+                compress_sim_outputs(sim_outputs, compress)
+                return []
+        if not scratch:
+            convert_and_simulate(apsim_filename, record, policy, lock, packed)
+        else:
+            scratch_filename = make_scratch_dir(apsim_filename, None if scratch == True else scratch)
+            # outputs of a failed or cancelled job may be partial, only its logs are published
+            suffixes = [".tmp"]
+            try:
+                convert_and_simulate(scratch_filename, record, policy, lock, packed)
+                suffixes = None
+            except SimFailed as e:
+                # report the published files, the scratch directory is gone
+                for failure in e.records:
+                    failure["file"] = os.path.join(folder, os.path.basename(failure["file"]))
+                raise
+            finally:
+                publish_scratch_dir(scratch_filename, folder, suffixes)
+        if cache != None:
+            cache.put(key, cached_filenames)
+        compress_sim_outputs(sim_outputs, compress)
+        return list(sim_outputs)
+    except RunCancelled:
+        record["status"] = "cancelled"
+        raise
+    except:
+        record["status"] = "failed"
+        raise
+    finally:
+        if ledger != None:
+            ledger.write(finish_job_record(record, out_filenames))
+
+
+def run_sim_job(sim_filename, lock=None, policy=None, ledger=None, compress=None):
+    """Runs one .sim file with retries, writing its timing and resource record to ledger if given and compressing its
+    outputs with compress if given (see compress_sim_outputs)."""
+    check_cancelled()
+    record = start_job_record(sim_filename)
+    stats = {}
+    try:
+        attempts = run_with_retry("simulate", sim_filename, policy, lock, stats)
+        compress_sim_outputs({sim_filename: describe_job_file(sim_filename)["outputs"]}, compress)
+        return attempts
+    except RunCancelled:
+        record["status"] = "cancelled"
+        raise
+    except:
+        record["status"] = "failed"
+        raise
+    finally:
+        add_stage(record, "simulate", stats)
+        if ledger != None:
+            out_filenames = [os.path.splitext(sim_filename)[0] + ".out"]
+            ledger.write(finish_job_record(record, out_filenames))
+
+
+def run_pipeline(
+    apsim_filename_list,
+    num_cores=None,
+    max_in_flight=None,
+    callback=None,
+    policy=None,
+    manifest_path=None,
+    cache=None,
+    adaptive=False,
+    ledger=None,
+    scratch=False,
+    packed=False,
+    checkpoint=None,
+    progress=None,
+    compress=None,
+):
+    """Converts and runs every .apsim file, starting each file's simulation as soon as its own conversion is done.
+
+    Args:
+        apsim_filename_list (list): paths to .apsim files, and .sim files to run as they are
+        num_cores (int, optional): number of files to process at once. Defaults to default_num_workers().
+        max_in_flight (int, optional): maximum number of files queued or running. Defaults to 2 * num_cores.
+        callback (callable, optional): called with (apsim_filename, future) as each file finishes. Defaults to None.
+        policy (RetryPolicy, optional): retry settings. Defaults to RetryPolicy().
+        manifest_path (str, optional): where to write the failure manifest. Defaults to None (not written).
+        cache (SimCache, optional): skip files whose results are cached. Defaults to None.
+        adaptive (bool, optional): scale concurrency to fit in memory, see SimScheduler. Defaults to False.
+        ledger (RunLedger, optional): ledger to write each file's timing and resource record to. Defaults to None.
+        scratch (bool or str, optional): run each file in its own scratch directory, see convert_and_run. Defaults to False.
+        packed (bool, optional): run each file with one Apsim.exe process, see convert_and_run. Defaults to False.
+        checkpoint (Checkpoint, optional): marks each file that finished without error. Defaults to None.
+        progress (ProgressTracker, optional): counts each file as it starts and finishes. Defaults to None.
+        compress (str, optional): compress each file's outputs, see convert_and_run. Defaults to None.
+
+    Returns:
+        [dict]: apsim filename -> list of .sim files run, for every file that finished without error
+    """
+    print(f"Converting and running {len(apsim_filename_list)} .apsim and .sim files...")
+    results = {}
+    failures = []
+
+    def on_done(apsim_filename):
+        report = report_failure(apsim_filename)
+
+        def done(future):
+            report(future)
+            failures.extend(collect_failures(future, apsim_filename, "convert"))
+            if not future.cancelled() and future.exception() == None:
+                results[apsim_filename] = future.result()
+            if callback != None:
+                callback(apsim_filename, future)
+
+        return done
+
+    with cancel_scope(), SimScheduler(num_cores, max_in_flight, adaptive, progress) as scheduler:
+        for apsim_filename in apsim_filename_list:
+            if _cancel.is_set():
+                break
+            future = scheduler.submit(
+                convert_and_run, apsim_filename, policy=policy, cache=cache, ledger=ledger, scratch=scratch, packed=packed, compress=compress, callback=on_done(apsim_filename)
+            )
+            if checkpoint != None:
+                future.add_done_callback(checkpoint.callback("pipeline", apsim_filename))
     print("Runs completed.")
+    if manifest_path != None:
+        write_failure_manifest(manifest_path, failures)
+    return results
+
+
+def convert_run_and_parse(apsim_filename, parser=parse_all_output, lock=None, policy=None, cache=None, ledger=None, scratch=False, packed=False, compress=None):
+    """Converts and runs one .apsim file, then parses every .out file its simulations wrote.
+
+    Args:
+        apsim_filename (str): path to .apsim file, or .sim file to run as it is
+        parser (callable, optional): called with each .out path. Defaults to parse_all_output.
+        policy (RetryPolicy, optional): retry settings. Defaults to RetryPolicy().
+        cache (SimCache, optional): restore cached results instead of running. Defaults to None.
+        ledger (RunLedger, optional): ledger to write the job's record to. Defaults to None.
+        scratch (bool or str, optional): run in a scratch directory, see convert_and_run. Defaults to False.
+        packed (bool, optional): run the file with one Apsim.exe process, see convert_and_run. Defaults to False.
+        compress (str, optional): compress the outputs before parsing, see convert_and_run. The parser gets the
+            paths they were written to; parse_all_output and the other apsim_output_parser functions read them
+            wherever they are stored. Defaults to None.
+
+    Returns:
+        [list]: (out_filename, parsed output) for each .out file found
+    """
+    convert_and_run(apsim_filename, lock, policy, cache, ledger, scratch, packed, compress)
+    results = []
+    for out_filenames in get_sim_outputs(apsim_filename).values():
+        for out_filename in out_filenames:
+            if output_exists(out_filename):
+                results.append((out_filename, parser(out_filename)))
+            else:
+                print(f"{out_filename} was not written.")
+    return results
+
+
+def iter_pipeline(
+    apsim_filename_list,
+    num_cores=None,
+    max_in_flight=None,
+    parser=parse_all_output,
+    policy=None,
+    manifest_path=None,
+    cache=None,
+    adaptive=False,
+    ledger=None,
+    scratch=False,
+    packed=False,
+    checkpoint=None,
+    progress=None,
+    compress=None,
+):
+    """Streams converted, simulated and parsed results for each .apsim file in the order they finish.
 
+    There is no barrier between stages: a file's .sim is run as soon as it exists and its .out is parsed as soon
+    as the run ends, while other files are still converting.
 
-def run_all_simulations(apsim_files_path="apsim_files\\Accola", n_cores=None):
+    Args:
+        apsim_filename_list (list): paths to .apsim files, and .sim files to run as they are
+        num_cores (int, optional): number of files to process at once. Defaults to default_num_workers().
+        max_in_flight (int, optional): maximum number of files queued or running. Defaults to 2 * num_cores.
+        parser (callable, optional): called with each .out path. Defaults to parse_all_output.
+        policy (RetryPolicy, optional): retry settings. Defaults to RetryPolicy().
+        manifest_path (str, optional): where to write the failure manifest once the stream ends. Defaults to None.
+        cache (SimCache, optional): skip files whose results are cached. Defaults to None.
+        adaptive (bool, optional): scale concurrency to fit in memory, see SimScheduler. Defaults to False.
+        ledger (RunLedger, optional): ledger to write each file's timing and resource record to. Defaults to None.
+        scratch (bool or str, optional): run each file in its own scratch directory, see convert_and_run. Defaults to False.
+        packed (bool, optional): run each file with one Apsim.exe process, see convert_and_run. Defaults to False.
+        checkpoint (Checkpoint, optional): marks each file that finished without error. Defaults to None.
+        progress (ProgressTracker, optional): counts each file as it starts and finishes. Defaults to None.
+        compress (str, optional): compress each file's outputs before parsing, see convert_run_and_parse. Defaults to None.
+
+    Yields:
+        [tuple]: (out_filename, parsed output)
+    """
+    with cancel_scope():
+        done_queue = Queue()
+        failures = []
+        stop = threading.Event()
+        scheduler = SimScheduler(num_cores, max_in_flight, adaptive, progress)
+
+        def feed():
+            submitted = 0
+            for apsim_filename in apsim_filename_list:
+                if stop.is_set() or _cancel.is_set():
+                    break
+                future = scheduler.submit(
+                    convert_run_and_parse,
+                    apsim_filename,
+                    parser,
+                    policy=policy,
+                    cache=cache,
+                    ledger=ledger,
+                    scratch=scratch,
+                    packed=packed,
+                    compress=compress,
+                    callback=lambda future, apsim_filename=apsim_filename: done_queue.put((apsim_filename, future)),
+                )
+                if checkpoint != None:
+                    future.add_done_callback(checkpoint.callback("pipeline", apsim_filename))
+                submitted += 1
+            done_queue.put((None, submitted))
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            submitted = None
+            finished = 0
+            while submitted == None or finished < submitted:
+                apsim_filename, item = done_queue.get()
+                if apsim_filename == None:
+                    submitted = item
+                    continue
+                finished += 1
+                report_failure(apsim_filename)(item)
+                if item.exception() != None:
+                    failures.extend(collect_failures(item, apsim_filename, "convert"))
+                    continue
+                for result in item.result():
+                    yield result
+        finally:
+            stop.set()
+            feeder.join()
+            scheduler.shutdown(wait=True)
+            if manifest_path != None:
+                write_failure_manifest(manifest_path, failures)
+
+
+def run_all_simulations(
+    apsim_files_path="apsim_files\\Accola",
+    n_cores=None,
+    stream=False,
+    parser=parse_all_output,
+    policy=None,
+    cache=None,
+    adaptive=False,
+    ledger=False,
+    scratch=False,
+    packed=False,
+    resume=False,
+    priorities=None,
+    progress=False,
+    metrics_port=None,
+    compress=None,
+    incremental=False,
+):
     """
     Converts all .apsim files to .sim files and runs all .sim files in targeted folder.
 
@@ -167,62 +954,247 @@ def run_all_simulations(apsim_files_path="apsim_files\\Accola", n_cores=None):
         apsim_files_path {str} -- Path to .apsim files
         sim_files_path {str} -- Path to .sim files
         n_cores {int} -- number of cores to allocate to runs
+        stream {bool} -- convert, run and parse each file as its own pipeline instead of converting everything
+            before running anything, and return a generator of (out_filename, parsed output) (default: {False})
+        parser {callable} -- parser applied to each .out file in stream mode (default: {parse_all_output})
+        policy {RetryPolicy} -- retry settings for failed conversions and runs (default: {RetryPolicy()})
+        cache {SimCache} -- result cache; files whose inputs are already cached are restored instead of run. Cached
+            folders are processed per file with run_pipeline rather than in a convert phase and a run phase.
+            (default: {None})
+        adaptive {bool} -- scale the number of concurrent runs between 1 and n_cores (default: every usable CPU) to
+            fit the cgroup/machine memory limit, based on the measured memory of running sims (default: {False})
+        ledger {bool or str} -- append per-job timings, exit codes and peak memory to run_ledger.jsonl in the folder
+            (True) or to the given path; see apsim.telemetry.print_ledger_summary (default: {False})
+        scratch {bool or str} -- convert and run each file in its own scratch directory (True for
+            apsim.scratch.scratch_root(), or a folder) and publish finished outputs into the folder by atomic rename.
+            Like cache, runs per file with run_pipeline. (default: {False})
+        packed {bool} -- run each .apsim file directly with one Apsim.exe process, for files written by
+            create_mukey_runs(pack_size=...). Runs per file with run_pipeline. (default: {False})
+        resume {bool} -- keep the outputs of an earlier, interrupted batch and only schedule jobs its checkpoint
+            doesn't list as finished; see resume (default: {False})
+        priorities {dict} -- file (path or base name) -> priority; higher priority files are started first
+            (default: {None})
+        progress {bool} -- show a live progress line (jobs/sec, ETA, failures, worker use) while the batch runs, see
+            apsim.progress. Not shown in stream mode. (default: {False})
+        metrics_port {int} -- serve the batch's progress in the Prometheus text format at
+            http://127.0.0.1:<port>/metrics while it runs (until the process exits in stream mode) (default: {None})
+        compress {str} -- compress each job's .out and .sum files as it finishes ('gzip', or 'zstd' with the
+            zstandard package), or move them all into the folder's outputs.zip when the batch ends ('zip', not in
+            stream mode). apsim_output_parser reads them under their original names; see apsim.output_store
+            (default: {None})
+        incremental {bool} -- keep the outputs of jobs the folder's run manifest lists as ok and only run the jobs
+            that are pending or failed, e.g. those create_mukey_runs(incremental=True) rewrote. Runs everything when
+            the folder has no manifest. (default: {False})
+
+    .sim files already in the folder, e.g. written by create_mukey_runs(output_format='sim'), are run as they are
+    without a convert phase, or alongside the .apsim files in the modes that run per file. When the folder has a run_manifest.json (see apsim.run_manifest) its jobs are run
+    instead of the files found in the folder, and each job's status is recorded in it when the batch ends (not in
+    stream mode).
+
+    Jobs are started longest first, estimated from their clock, SWIM use and soil layers and from the timings of
+    earlier runs in the folder's run ledger (see apsim.job_cost), so long jobs don't hold up the end of the batch.
+    Finished jobs are recorded in checkpoint.jsonl in the folder. SIGINT or SIGTERM cancels the batch: queued jobs
+    are dropped and running APSIM processes terminated. Failed runs are written to failed_runs.json in the folder;
+    see rerun_failed.
 
-    Returns: None
+    Returns: None, or a generator of parsed results when stream is True
     """
     runs_folder_path = apsim_files_path
-    if os.path.exists(runs_folder_path):
-        num_files_removed = 0
-        for filename in os.listdir(runs_folder_path):
-            for pattern in ["*.tmp", "*.out", "*.sum"]:
-                if fnmatch.fnmatch(filename, pattern):
-                    old_file = os.path.join(runs_folder_path, filename)
-                    os.remove(old_file)
-                    num_files_removed += 1
-        print(f"Removed {num_files_removed} old files.")
-    else:
+    if not os.path.exists(runs_folder_path):
         print("Target folder does not exist.")
         return
+    if compress != None:
+        check_compression(compress)
+        if compress == "zip" and stream:
+            raise ValueError("compress='zip' archives the folder once the batch ends, use 'gzip' or 'zstd' with stream.")
+    checkpoint = Checkpoint(os.path.join(runs_folder_path, CHECKPOINT_FILENAME))
+    run_manifest = load_run_manifest(runs_folder_path)
+    if incremental and run_manifest == None:
+        print("No run manifest to tell which jobs changed, running every job.")
+        incremental = False
+    if not resume:
+        checkpoint.clear()
+        # outputs of unchanged jobs are kept, the writer already removed those of rewritten jobs
+        num_files_removed = 0 if incremental else remove_outputs(runs_folder_path)
+        for filename in os.listdir(runs_folder_path):
+            if fnmatch.fnmatch(filename, "*.tmp"):
+                old_file = os.path.join(runs_folder_path, filename)
+                os.remove(old_file)
+                num_files_removed += 1
+        print(f"Removed {num_files_removed} old files.")
     # get system number of cores if not specified
     if n_cores == None:
-        n_cores = cpu_count() - 2
-    print(f"Running on {n_cores} cores")
+        n_cores = available_cpus() if adaptive else default_num_workers()
+    print(f"Running on {'up to ' if adaptive else ''}{n_cores} cores")
 
     # combine working dir and apsim file paths to create complete file paths
-    wd = getcwd()
     time1 = perf_counter()
-    apsim_files = glob(apsim_files_path + "\\*.apsim")
-    complete_apsim_paths = [wd + f"\\{apsim_file}" for apsim_file in apsim_files]
-    # convert list of .apsim files to .sim files
-    convert_all_apsim_to_sim(complete_apsim_paths, num_cores=n_cores)
-
-    # get list of all converted .sim files and create their full paths
-    sim_files = glob(apsim_files_path + "\\*.sim")
-    complete_sim_paths = [wd + f"\\{sim_file}" for sim_file in sim_files]
-    # run .sim files
-    run_many_sims(complete_sim_paths, num_cores=n_cores)
+    per_file = stream or cache != None or scratch or packed
+    # per file, .sim jobs go through the pipeline too instead of a run phase of their own
+    kinds = ["apsim", "sim"] if per_file else ["apsim"]
+    if incremental:
+        unfinished = run_manifest.unfinished_jobs()
+        apsim_files = [job["job"] for job in unfinished if job["kind"] in kinds]
+        print(f"Incremental: {len(unfinished)} of {len(run_manifest.jobs())} jobs to run.")
+    elif run_manifest != None:
+        # the writer's manifest lists the jobs, no need to search the folder
+        apsim_files = [job_file for kind in kinds for job_file in run_manifest.job_files(kind=kind)]
+    else:
+        apsim_files = glob(os.path.join(apsim_files_path, "*.apsim"))
+        if per_file:
+            apsim_files += standalone_sim_files(apsim_files_path, apsim_files)
+    complete_apsim_paths = [os.path.abspath(apsim_file) for apsim_file in apsim_files]
+    if resume:
+        finished = checkpoint.completed("pipeline" if per_file else "convert")
+        complete_apsim_paths = [f for f in complete_apsim_paths if f not in finished]
+        print(f"Resuming: {len(finished)} .apsim files already finished.")
+    manifest_path = os.path.join(runs_folder_path, FAILURE_MANIFEST)
+    if ledger == True:
+        ledger = os.path.join(runs_folder_path, LEDGER_FILENAME)
+    ledger = RunLedger(ledger) if ledger else None
+    history = load_job_history(ledger.path if ledger != None else os.path.join(runs_folder_path, LEDGER_FILENAME))
+    complete_apsim_paths = order_by_cost(complete_apsim_paths, priorities, history)
+    trackers = {}
+    if progress or metrics_port != None:
+        if per_file:
+            trackers["pipeline"] = ProgressTracker("pipeline", len(complete_apsim_paths))
+        else:
+            trackers["convert"] = ProgressTracker("convert", len(complete_apsim_paths))
+            trackers["simulate"] = ProgressTracker("simulate")
+    metrics_server = serve_metrics(metrics_port) if metrics_port != None else None
+    if stream:
+        return iter_pipeline(
+            complete_apsim_paths,
+            num_cores=n_cores,
+            parser=parser,
+            policy=policy,
+            manifest_path=manifest_path,
+            cache=cache,
+            adaptive=adaptive,
+            ledger=ledger,
+            scratch=scratch,
+            packed=packed,
+            checkpoint=checkpoint,
+            progress=trackers.get("pipeline"),
+            compress=compress,
+        )
+    try:
+        with cancel_on_signals(), TerminalProgress() if progress else nullcontext():
+            if per_file:
+                run_pipeline(
+                    complete_apsim_paths,
+                    num_cores=n_cores,
+                    policy=policy,
+                    manifest_path=manifest_path,
+                    cache=cache,
+                    adaptive=adaptive,
+                    ledger=ledger,
+                    scratch=scratch,
+                    packed=packed,
+                    checkpoint=checkpoint,
+                    progress=trackers.get("pipeline"),
+                    compress=compress,
+                )
+            else:
+                # convert list of .apsim files to .sim files
+                failures = convert_all_apsim_to_sim(
+                    complete_apsim_paths, num_cores=n_cores, policy=policy, adaptive=adaptive, checkpoint=checkpoint, progress=trackers.get("convert"), ledger=ledger
+                )
+
+                # get list of all converted .sim files and create their full paths
+                if incremental:
+                    sim_files = [sim_file for job in unfinished for sim_file in job["sims"] if os.path.exists(sim_file)]
+                elif run_manifest != None:
+                    sim_files = [sim_file for sim_file in run_manifest.sim_files() if os.path.exists(sim_file)]
+                else:
+                    sim_files = glob(os.path.join(apsim_files_path, "*.sim"))
+                complete_sim_paths = [os.path.abspath(sim_file) for sim_file in sim_files]
+                if resume:
+                    finished = checkpoint.completed("simulate")
+                    complete_sim_paths = [f for f in complete_sim_paths if f not in finished]
+                complete_sim_paths = order_by_cost(complete_sim_paths, priorities, history)
+                if "simulate" in trackers:
+                    trackers["simulate"].set_total(len(complete_sim_paths))
+                # run .sim files
+                failures += run_many_sims(
+                    complete_sim_paths,
+                    num_cores=n_cores,
+                    policy=policy,
+                    adaptive=adaptive,
+                    ledger=ledger,
+                    checkpoint=checkpoint,
+                    progress=trackers.get("simulate"),
+                    compress=compress,
+                )
+                write_failure_manifest(manifest_path, failures)
+            if compress == "zip":
+                print(f"Archived {archive_outputs(runs_folder_path)} output files.")
+            if run_manifest != None:
+                scheduled = complete_apsim_paths if per_file else complete_apsim_paths + complete_sim_paths
+                run_manifest.update_statuses(scheduled, load_failure_manifest(manifest_path))
+                run_manifest.save()
+            if _cancel.is_set():
+                print(f"Batch cancelled. Finished jobs are listed in {checkpoint.path}, run resume() to complete the batch.")
+    finally:
+        if metrics_server != None:
+            metrics_server.shutdown()
     time2 = perf_counter()
     print(f"Processing time: {time2 - time1:0.4f} seconds")
 
 
-# #TODO
-# with open(tmpFilename, 'w') as tmpFile:
-#         with open(sumFilename, 'w') as sumFile:
-#             subprocess.call([apsimExePath, simFilename], stdout=sumFile, stderr=tmpFile, startupinfo=startupinfo)
-#     with open(tmpFilename, 'r') as tmpFile:
-#         lineList = tmpFile.readlines()
-#         #print len(lineList)
-#         if '100%' in lineList[-1]:
-#             # delete .sim file after processing
-#             os.remove(simFilename)
-#             simRerunAttemps = 0
-#         elif simRerunAttemps < 5:
-#             # attempt to re-run sim file at most 5 times
-#             _run_sim(simFilename, lock)
-#             simRerunAttemps += 1
-#         else:
-#             print 'Unable to process file :', simFilename
-#             simRerunAttemps = 0
+def resume(apsim_files_path, **kwargs):
+    """
+    Resumes a cancelled or killed run_all_simulations batch, scheduling only the jobs its checkpoint doesn't list
+    as finished.
+
+    Keyword Arguments:
+        apsim_files_path {str} -- Path to the folder run by run_all_simulations
+        kwargs -- any other run_all_simulations arguments, which should match the interrupted batch's
+
+    Returns: None, or a generator of parsed results when stream is True
+    """
+    return run_all_simulations(apsim_files_path, resume=True, **kwargs)
+
+
+def rerun_failed(apsim_files_path, n_cores=None, policy=None):
+    """
+    Reruns only the conversions and simulations listed in a folder's failure manifest and rewrites the manifest
+    with whatever still fails.
+
+    Keyword Arguments:
+        apsim_files_path {str} -- Path to the folder run by run_all_simulations
+        n_cores {int} -- number of cores to allocate to runs
+        policy {RetryPolicy} -- retry settings (default: {RetryPolicy()})
+
+    Returns: [list] -- failure records that remain
+    """
+    manifest_path = os.path.join(apsim_files_path, FAILURE_MANIFEST)
+    failures = load_failure_manifest(manifest_path)
+    apsim_filenames = sorted({record["file"] for record in failures if record["stage"] == "convert" and record["file"]})
+    sim_filenames = sorted({record["file"] for record in failures if record["stage"] == "simulate" and record["file"]})
+    pack_filenames = sorted({record["file"] for record in failures if record["stage"] == "pack" and record["file"]})
+    print(f"Rerunning {len(apsim_filenames)} failed conversions, {len(pack_filenames)} failed packs and {len(sim_filenames)} failed simulations.")
+    remaining = []
+    # files that ran again, whether they failed or not; the others (cancelled, or never started) keep their records
+    rerun = set()
+
+    def on_done(stage):
+        def done(filename, future):
+            remaining.extend(collect_failures(future, filename, stage))
+            if not future.cancelled() and not isinstance(future.exception(), RunCancelled):
+                rerun.add(filename)
+
+        return done
+
+    with cancel_on_signals():
+        run_pipeline(apsim_filenames, num_cores=n_cores, policy=policy, callback=on_done("convert"))
+        run_pipeline(pack_filenames, num_cores=n_cores, policy=policy, packed=True, callback=on_done("pack"))
+        run_many_sims(sim_filenames, num_cores=n_cores, policy=policy, callback=on_done("simulate"))
+    remaining += [record for record in failures if record["file"] not in rerun]
+    write_failure_manifest(manifest_path, remaining)
+    return remaining
+
+
 def main():
     """
     Main function for when running script as standalone. Will run all .apsim files in directory.
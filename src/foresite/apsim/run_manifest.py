@@ -0,0 +1,272 @@
+"""
+Run manifest: one JSON index of every job in a runs folder.
+
+create_mukey_runs writes run_manifest.json next to the files it creates, listing each job file (.apsim file, pack or
+.sim file) with what it simulates (field, rotation, end year, mukeys, met file), the .sim and .out files it produces,
+the hash of its inputs (see apsim.sim_cache.hash_simulation) and its status. run_all_simulations takes its job list
+from the manifest instead of globbing the folder and records each job's status when the batch ends, and
+apsim_output_parser.parse_manifest_output parses the outputs of finished jobs, optionally only those not parsed yet.
+
+Paths are stored relative to the manifest's folder, so a runs folder can be moved; the API takes and returns
+absolute paths. to_dataframe() gives one row per job, e.g. for writing the manifest to Parquet.
+
+Statuses:
+    pending -- written, not run yet (or cancelled before it finished)
+    ok -- ran and wrote every output
+    failed -- conversion or simulation failed every retry, see failed_runs.json
+"""
+
+import json
+import os
+import tempfile
+import threading
+from datetime import datetime
+from xml.etree.ElementTree import parse
+
+import pandas as pd
+from apsim.output_store import output_exists
+from apsim.sim_cache import hash_simulation
+from apsim.telemetry import get_mukey
+
+MANIFEST_FILENAME = "run_manifest.json"
+MANIFEST_VERSION = 1
+STATUSES = ["pending", "ok", "failed"]
+
+
+def get_out_filenames(filename, root=None):
+    """Lists the .out files a .sim or .apsim file (or pack) writes, next to the file.
+
+    Args:
+        filename (str): .sim or .apsim file
+        root (Element, optional): the file's parsed root, if already read. Defaults to None.
+    """
+    folder = os.path.dirname(os.path.abspath(filename))
+    if root == None:
+        root = parse(filename).getroot()
+    out_filenames = []
+    for out_filename in root.iter("filename"):
+        if out_filename.get("output") == "yes" and out_filename.text:
+            out_filenames.append(os.path.join(folder, out_filename.text))
+    # .sim files converted by apsim.sim_converter or ApsimToSim name them in their Report components
+    for component in root.iter("component"):
+        if component.get("class") == "Report" and component.findtext("initdata/outputfile"):
+            out_filenames.append(os.path.join(folder, component.findtext("initdata/outputfile")))
+    return out_filenames
+
+
+def describe_job_file(filename):
+    """Lists the .sim and .out files of an .apsim or .sim job file, and the mukeys it simulates.
+
+    Returns:
+        [dict]: 'sims', 'outputs' (absolute paths) and 'mukeys'
+    """
+    folder = os.path.dirname(os.path.abspath(filename))
+    root = parse(filename).getroot()
+    if root.tag == "simulation":
+        sim_names = [root.get("name") or os.path.splitext(os.path.basename(filename))[0]]
+        sims = [os.path.abspath(filename)]
+    else:
+        sim_names = [sim.get("name") for sim in root.iter("simulation")]
+        sims = [os.path.join(folder, f"{name}.sim") for name in sim_names]
+    return {"sims": sims, "outputs": get_out_filenames(filename, root), "mukeys": [get_mukey(name) for name in sim_names]}
+
+
+def describe_job(filename):
+    """describe_job_file with the file's 'hash' (see apsim.sim_cache.hash_simulation): what add_job records about a
+    job file, worked out where the file was written, e.g. in a writer process."""
+    description = describe_job_file(filename)
+    description["hash"] = hash_simulation(filename)
+    return description
+
+
+class RunManifest:
+    """Index of the jobs in a runs folder, saved as JSON. Safe to share between worker threads.
+
+    Args:
+        path (str): manifest file, read if it exists
+    """
+
+    ###
+    def __init__(self, path):
+        self.path = path
+        self.folder = os.path.dirname(os.path.abspath(path))
+        self._lock = threading.Lock()
+        self._jobs = {}
+        if os.path.exists(path):
+            with open(path, "r") as manifest_file:
+                self._jobs = json.load(manifest_file)["jobs"]
+
+    ###
+    def _relative(self, filename):
+        return os.path.relpath(os.path.abspath(filename), self.folder)
+
+    ###
+    def _absolute(self, filename):
+        return os.path.normpath(os.path.join(self.folder, filename))
+
+    ###
+    def _to_absolute(self, job):
+        job = dict(job)
+        job["job"] = self._absolute(job["job"])
+        for key in ["sims", "outputs"]:
+            job[key] = [self._absolute(f) for f in job[key]]
+        if job.get("met") != None:
+            job["met"] = self._absolute(job["met"])
+        return job
+
+    ###
+    def add_job(self, job_filename, field=None, rotation=None, end_year=None, met=None, input_hash=None, description=None):
+        """Adds (or replaces) a job file written to the folder, as pending.
+
+        Args:
+            job_filename (str): .apsim or .sim file
+            field (str, optional): field name. Defaults to None.
+            rotation (str, optional): rotation. Defaults to None.
+            end_year (int, optional): last simulated year. Defaults to None.
+            met (str, optional): met file. Defaults to None.
+            input_hash (str, optional): hash of what the file was generated from, compared by
+                create_mukey_runs(incremental=True) to tell whether it needs writing again. Defaults to None.
+            description (dict, optional): describe_job of the file, when it was already worked out. Defaults to
+                None (the file is read).
+
+        Returns:
+            [dict]: the job record
+        """
+        if description == None:
+            description = describe_job(job_filename)
+        job = {
+            "job": self._relative(job_filename),
+            "kind": os.path.splitext(job_filename)[1].lstrip("."),
+            "field": field,
+            "rotation": rotation,
+            "end_year": end_year,
+            "mukeys": description["mukeys"],
+            "met": self._relative(met) if met != None else None,
+            "sims": [self._relative(f) for f in description["sims"]],
+            "outputs": [self._relative(f) for f in description["outputs"]],
+            "hash": description["hash"],
+            "input_hash": input_hash,
+            "status": "pending",
+            "parsed": False,
+            "updated": datetime.now().isoformat(timespec="seconds"),
+        }
+        with self._lock:
+            self._jobs[job["job"]] = job
+        return self._to_absolute(job)
+
+    ###
+    def set_status(self, job_filename, status):
+        """Sets a job's status; a job that (re)ran needs parsing again."""
+        if status not in STATUSES:
+            raise ValueError(f"Unknown status {status}, use one of {STATUSES}.")
+        with self._lock:
+            job = self._jobs[self._relative(job_filename)]
+            if job["status"] != status or status == "ok":
+                job["parsed"] = False
+            job["status"] = status
+            job["updated"] = datetime.now().isoformat(timespec="seconds")
+
+    ###
+    def job(self, job_filename):
+        """Returns the record of a job file (with absolute paths), None if it isn't listed."""
+        with self._lock:
+            job = self._jobs.get(self._relative(job_filename))
+        return self._to_absolute(job) if job != None else None
+
+    ###
+    def remove_job(self, job_filename):
+        with self._lock:
+            self._jobs.pop(self._relative(job_filename), None)
+
+    ###
+    def set_parsed(self, job_filename, parsed=True):
+        with self._lock:
+            self._jobs[self._relative(job_filename)]["parsed"] = parsed
+
+    ###
+    def jobs(self, status=None, kind=None):
+        """Returns the job records (with absolute paths), optionally only those with a status and/or kind."""
+        with self._lock:
+            jobs = [job for job in self._jobs.values() if (status == None or job["status"] == status) and (kind == None or job["kind"] == kind)]
+        return [self._to_absolute(job) for job in jobs]
+
+    ###
+    def unfinished_jobs(self, kind=None):
+        """Returns the jobs that still need running: pending (new or rewritten) or failed."""
+        return [job for job in self.jobs(kind=kind) if job["status"] != "ok"]
+
+    ###
+    def job_files(self, status=None, kind=None):
+        return [job["job"] for job in self.jobs(status, kind)]
+
+    ###
+    def sim_files(self, status=None):
+        return [sim for job in self.jobs(status) for sim in job["sims"]]
+
+    ###
+    def update_statuses(self, filenames, failures):
+        """Records how a batch went for the jobs it ran: jobs with a failure record are failed, jobs that wrote every
+        output are ok and the rest (cancelled) stay as they were.
+
+        Args:
+            filenames (list): job or .sim files the batch scheduled
+            failures (list): failure manifest entries of the batch, see run_apsim.load_failure_manifest
+        """
+        scheduled = set(os.path.abspath(f) for f in filenames)
+        failed_files = set(os.path.abspath(record["file"]) for record in failures)
+        for job in self.jobs():
+            files = [job["job"]] + job["sims"]
+            if not any(f in scheduled for f in files):
+                continue
+            if any(f in failed_files for f in files):
+                self.set_status(job["job"], "failed")
+            elif all(output_exists(out) for out in job["outputs"]):
+                self.set_status(job["job"], "ok")
+
+    ###
+    def clear(self):
+        """Forgets every job, for a freshly written folder."""
+        with self._lock:
+            self._jobs = {}
+
+    ###
+    def save(self):
+        """Writes the manifest, replacing the old file in one step."""
+        with self._lock:
+            data = json.dumps({"version": MANIFEST_VERSION, "jobs": self._jobs}, indent=1)
+        fd, partial = tempfile.mkstemp(prefix=f".{os.path.basename(self.path)}.", suffix=".partial", dir=self.folder)
+        with os.fdopen(fd, "w") as manifest_file:
+            manifest_file.write(data)
+        os.replace(partial, self.path)
+
+    ###
+    def to_dataframe(self):
+        """Returns one row per job, with absolute paths."""
+        return pd.DataFrame(self.jobs())
+
+
+def load_run_manifest(folder):
+    """Returns the RunManifest of a runs folder, or None if the folder has none."""
+    path = os.path.join(folder, MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        return None
+    return RunManifest(path)
+
+
+def build_run_manifest(folder, field=None, rotation=None, end_year=None):
+    """Writes a manifest for a runs folder created without one, listing its .apsim files, or its .sim files when it
+    has no .apsim files.
+
+    Returns:
+        [RunManifest]: the saved manifest
+    """
+    manifest = RunManifest(os.path.join(folder, MANIFEST_FILENAME))
+    manifest.clear()
+    names = sorted(os.listdir(folder))
+    job_names = [name for name in names if name.endswith(".apsim")]
+    if len(job_names) == 0:
+        job_names = [name for name in names if name.endswith(".sim")]
+    for name in job_names:
+        manifest.add_job(os.path.join(folder, name), field, rotation, end_year)
+    manifest.save()
+    return manifest
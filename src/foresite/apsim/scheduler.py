@@ -0,0 +1,129 @@
+"""
+Job scheduler for APSIM conversion and simulation runs.
+
+Every job in the runner spends its time waiting on an external APSIM process, so
+the scheduler keeps a fixed pool of worker threads, each driving one child
+process at a time, and bounds how many jobs may be queued ahead of the workers.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from apsim.resources import AdaptiveConcurrency, available_cpus, default_num_workers
+
+_job = threading.local()
+
+
+def current_job():
+    """Returns what the scheduler knows about the job running on this thread: 'worker' (thread name) and
+    'queue_wait' (seconds between submit and start). Empty outside a scheduler job."""
+    return dict(getattr(_job, "info", {}))
+
+
+class SimScheduler:
+    """Runs jobs on a pool of workers with a bound on queued work.
+
+    Args:
+        num_workers (int, optional): number of worker threads, the most jobs that can run at once. Defaults to
+            default_num_workers().
+        max_in_flight (int, optional): maximum number of submitted jobs that are queued or running. ``submit`` blocks
+            once this many jobs are outstanding. Defaults to twice num_workers.
+        adaptive (bool, optional): let an AdaptiveConcurrency controller scale the number of jobs running at once
+            to fit in memory, up to num_workers. num_workers then defaults to every usable CPU. Defaults to False.
+        progress (ProgressTracker, optional): counts every job as it starts and finishes; jobs that raise count as
+            failed. Defaults to None.
+    """
+
+    ###
+    def __init__(self, num_workers=None, max_in_flight=None, adaptive=False, progress=None):
+        if num_workers == None:
+            num_workers = available_cpus() if adaptive else default_num_workers()
+        if max_in_flight == None:
+            max_in_flight = 2 * num_workers
+        self.num_workers = num_workers
+        self.max_in_flight = max(max_in_flight, num_workers)
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="apsim-worker")
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        # jobs running right now and how many may run, changed by set_concurrency()
+        self._running = 0
+        self.concurrency = num_workers
+        self._gate = threading.Condition()
+        self.controller = None
+        self.progress = progress
+        if adaptive:
+            self.set_concurrency(default_num_workers())
+            self.controller = AdaptiveConcurrency(self)
+            self.controller.start()
+
+    ###
+    def set_concurrency(self, concurrency):
+        """Changes how many jobs may run at once, between 1 and num_workers. Running jobs are never interrupted."""
+        with self._gate:
+            self.concurrency = max(1, min(self.num_workers, concurrency))
+            self._gate.notify_all()
+
+    ###
+    def _run_gated(self, queued, fn, args, kwargs):
+        with self._gate:
+            while self._running >= self.concurrency:
+                self._gate.wait()
+            self._running += 1
+        worker = threading.current_thread().name
+        _job.info = {"worker": worker, "queue_wait": time() - queued}
+        if self.progress != None:
+            self.progress.start_job(worker)
+        ok = False
+        try:
+            result = fn(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            _job.info = {}
+            if self.progress != None:
+                self.progress.finish_job(worker, ok)
+            with self._gate:
+                self._running -= 1
+                self._gate.notify_all()
+
+    ###
+    def submit(self, fn, *args, callback=None, **kwargs):
+        """Schedules fn(*args, **kwargs) on a worker. Blocks while max_in_flight jobs are outstanding.
+
+        Args:
+            fn (callable): job to run
+            callback (callable, optional): called with the finished future. Defaults to None.
+
+        Returns:
+            [Future]: future holding the job's return value or exception
+        """
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._run_gated, time(), fn, args, kwargs)
+        except:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._release_slot)
+        if callback != None:
+            future.add_done_callback(callback)
+        return future
+
+    ###
+    def _release_slot(self, future):
+        self._slots.release()
+
+    ###
+    def shutdown(self, wait=True):
+        """Stops accepting jobs and optionally waits for running jobs to finish."""
+        self._executor.shutdown(wait=wait)
+        if self.controller != None:
+            self.controller.stop()
+
+    ###
+    def __enter__(self):
+        return self
+
+    ###
+    def __exit__(self, exc_type, exc_value, tb):
+        self.shutdown(wait=True)
+        return False
@@ -0,0 +1,113 @@
+"""
+Per-job scratch directories for the APSIM runner.
+
+A job converts and runs its .apsim file in a private directory, ideally on tmpfs or a local disk, so concurrent
+batches can't overwrite each other's .sim, .tmp and .out files and the batch folder only ever sees finished files.
+Input files referenced with relative paths (e.g. met_files/x.met) are linked into the scratch directory. When the
+job ends its outputs are published to the batch folder by atomic rename.
+
+Environment variables:
+    FORESITE_SCRATCH -- folder to create scratch directories in. Defaults to /dev/shm when it exists, otherwise the
+        system temp folder.
+"""
+
+import os
+import shutil
+import tempfile
+from xml.etree.ElementTree import parse
+
+
+def scratch_root():
+    """Returns the folder scratch directories are created in."""
+    if os.environ.get("FORESITE_SCRATCH"):
+        return os.environ["FORESITE_SCRATCH"]
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def link_or_copy(src, dst):
+    try:
+        os.symlink(src, dst)
+    except (OSError, NotImplementedError):
+        # e.g. Windows without symlink rights
+        shutil.copyfile(src, dst)
+
+
+def make_scratch_dir(apsim_filename, root=None):
+    """Creates a scratch directory holding a copy of an .apsim file and links to its relative input files.
+
+    Args:
+        apsim_filename (str): path to .apsim file
+        root (str, optional): folder to create the directory in. Defaults to scratch_root().
+
+    Returns:
+        [str]: path of the .apsim copy in the scratch directory
+    """
+    if root == None:
+        root = scratch_root()
+    if not os.path.exists(root):
+        os.makedirs(root)
+    name = os.path.splitext(os.path.basename(apsim_filename))[0]
+    scratch_dir = tempfile.mkdtemp(prefix=f"foresite_{name}_", dir=root)
+    scratch_filename = os.path.join(scratch_dir, os.path.basename(apsim_filename))
+    shutil.copyfile(apsim_filename, scratch_filename)
+    folder = os.path.dirname(os.path.abspath(apsim_filename))
+    for filename in parse(apsim_filename).getroot().iter("filename"):
+        if filename.get("input") != "yes" or not filename.text or os.path.isabs(filename.text):
+            continue
+        input_path = os.path.join(folder, filename.text)
+        scratch_path = os.path.join(scratch_dir, filename.text)
+        if not os.path.exists(input_path) or os.path.lexists(scratch_path):
+            continue
+        os.makedirs(os.path.dirname(scratch_path), exist_ok=True)
+        link_or_copy(input_path, scratch_path)
+    return scratch_filename
+
+
+def publish_file(src, dest):
+    """Moves src to dest so that dest is either the old file or the complete new one, never a partial file."""
+    try:
+        os.replace(src, dest)
+        return
+    except OSError:
+        # different file systems, copy next to dest first
+        pass
+    fd, partial = tempfile.mkstemp(prefix=f".{os.path.basename(dest)}.", suffix=".partial", dir=os.path.dirname(dest))
+    os.close(fd)
+    try:
+        shutil.copyfile(src, partial)
+        os.replace(partial, dest)
+    except:
+        os.remove(partial)
+        raise
+    os.remove(src)
+
+
+def publish_scratch_dir(scratch_filename, dest_folder, suffixes=None):
+    """Publishes every file a job wrote in its scratch directory to dest_folder and removes the scratch directory.
+
+    Args:
+        scratch_filename (str): .apsim copy returned by make_scratch_dir
+        dest_folder (str): batch folder
+        suffixes (list, optional): only publish files ending in one of these, e.g. ['.tmp'] for the logs of a
+            failed job. The other files are discarded. Defaults to None (every file).
+
+    Returns:
+        [list]: published paths in dest_folder
+    """
+    scratch_dir = os.path.dirname(scratch_filename)
+    published = []
+    try:
+        for name in sorted(os.listdir(scratch_dir)):
+            src = os.path.join(scratch_dir, name)
+            if src == scratch_filename or os.path.islink(src) or not os.path.isfile(src):
+                continue
+            if suffixes != None and not name.endswith(tuple(suffixes)):
+                continue
+            dest = os.path.join(dest_folder, name)
+            publish_file(src, dest)
+            published.append(dest)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    return published
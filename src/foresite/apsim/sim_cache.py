@@ -0,0 +1,124 @@
+"""
+Content-addressed cache of APSIM simulation results.
+
+Results are stored under a key built from the canonical XML of the .apsim file plus the contents of every input
+file it references (met files, crop ini files), so a simulation whose inputs haven't changed is never run twice.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from time import time
+from xml.etree.ElementTree import canonicalize, parse
+
+
+def hash_simulation(apsim_filename):
+    """Builds the cache key for an .apsim file.
+
+    Args:
+        apsim_filename (str): path to .apsim file
+
+    Returns:
+        [str]: hex sha256 of the canonical XML and the referenced input files
+    """
+    folder = os.path.dirname(apsim_filename)
+    digest = hashlib.sha256()
+    digest.update(canonicalize(from_file=apsim_filename, strip_text=True).encode("utf-8"))
+    root = parse(apsim_filename).getroot()
+    for filename in root.iter("filename"):
+        if filename.get("input") != "yes" or not filename.text:
+            continue
+        input_path = os.path.join(folder, filename.text)
+        digest.update(filename.text.encode("utf-8"))
+        if os.path.exists(input_path):
+            with open(input_path, "rb") as input_file:
+                for chunk in iter(lambda: input_file.read(1 << 20), b""):
+                    digest.update(chunk)
+        else:
+            digest.update(b"<missing>")
+    return digest.hexdigest()
+
+
+class SimCache:
+    """Stores output files (.out and .sum) by simulation key and evicts least recently used entries beyond max_bytes.
+
+    Args:
+        cache_dir (str): folder holding one subfolder per cached key
+        max_bytes (int, optional): total size to keep. Defaults to 10 GB.
+    """
+
+    ###
+    def __init__(self, cache_dir, max_bytes=10 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # key -> [size in bytes, last used]
+        self._entries = {}
+        for key in os.listdir(cache_dir):
+            entry_path = os.path.join(cache_dir, key)
+            if key.startswith(".") or not os.path.isdir(entry_path):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_path, f)) for f in os.listdir(entry_path))
+            self._entries[key] = [size, os.path.getmtime(entry_path)]
+
+    ###
+    def key(self, apsim_filename):
+        return hash_simulation(apsim_filename)
+
+    ###
+    def total_bytes(self):
+        with self._lock:
+            return sum(size for size, _ in self._entries.values())
+
+    ###
+    def get(self, key, out_filenames):
+        """Copies cached .out files for key to out_filenames.
+
+        Returns:
+            [bool]: True if every file was in the cache and has been restored
+        """
+        entry_path = os.path.join(self.cache_dir, key)
+        with self._lock:
+            if key not in self._entries:
+                return False
+            cached = [os.path.join(entry_path, os.path.basename(f)) for f in out_filenames]
+            if not all(os.path.exists(f) for f in cached):
+                return False
+            now = time()
+            self._entries[key][1] = now
+            os.utime(entry_path, (now, now))
+        for cached_filename, out_filename in zip(cached, out_filenames):
+            shutil.copyfile(cached_filename, out_filename)
+        return True
+
+    ###
+    def put(self, key, out_filenames):
+        """Stores .out files under key and evicts old entries if the cache is over max_bytes."""
+        out_filenames = [f for f in out_filenames if os.path.exists(f)]
+        if len(out_filenames) == 0:
+            return
+        staging = tempfile.mkdtemp(prefix=".staging-", dir=self.cache_dir)
+        for out_filename in out_filenames:
+            shutil.copyfile(out_filename, os.path.join(staging, os.path.basename(out_filename)))
+        size = sum(os.path.getsize(os.path.join(staging, f)) for f in os.listdir(staging))
+        entry_path = os.path.join(self.cache_dir, key)
+        with self._lock:
+            if key in self._entries:
+                shutil.rmtree(entry_path, ignore_errors=True)
+            os.replace(staging, entry_path)
+            self._entries[key] = [size, time()]
+            self._evict()
+
+    ###
+    def _evict(self):
+        total = sum(size for size, _ in self._entries.values())
+        for key, (size, _) in sorted(self._entries.items(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            del self._entries[key]
+            total -= size
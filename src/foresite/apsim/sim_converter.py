@@ -0,0 +1,494 @@
+"""
+In-process .apsim to .sim conversion for the components Foresite writes, in place of ApsimToSim.exe.
+
+apsim_input_writer only emits a small set of components (clock, metfile, summaryfile, soil, surfaceom, fertiliser,
+maize, soybean, operations, manager and outputfile), so their .sim form can be built directly from the .apsim XML
+without starting a .NET process per file. Each component becomes a <component> with its DLL and an <initdata> block;
+layered soil values are written space separated as APSIM reads them. Crop ini files (and the model ini files of the
+APSIM install, when one is found) are read once per process and inlined, like ApsimToSim does.
+
+Files using anything outside that subset raise UnsupportedComponent, and the runner falls back to ApsimToSim for
+them. compare_sim_files() diffs a converted file against ApsimToSim's output of the same .apsim file, for validating
+the converter on a machine with APSIM installed.
+
+Example:
+    sim_filenames = convert_apsim_file("field_1_cfs.apsim")
+    differences = compare_sim_files("reference/name_field_mukey_1_rot_cfs_sim.sim", sim_filenames[0])
+"""
+
+import functools
+import math
+import os
+from xml.etree.ElementTree import Element, ElementTree, SubElement, parse
+
+MODEL_DIR = "%apsim%\\Model\\"
+SIM_VERSION = "36"
+
+# .apsim node tag -> (DLL, component class)
+COMPONENT_DLLS = {
+    "metfile": ("Input.dll", "Input"),
+    "clock": ("Clock.dll", "Clock"),
+    "summaryfile": ("SummaryFile.dll", "SummaryFile"),
+    "outputfile": ("Report.dll", "Report"),
+    "SoilWater": ("SoilWat.dll", "SoilWat"),
+    "Swim": ("SWIM3.dll", "SWIM3"),
+    "SoilOrganicMatter": ("SoilNitrogen.dll", "SoilNitrogen"),
+    "surfaceom": ("SurfaceOM.dll", "SurfaceOM"),
+    "fertiliser": ("Fertiliser.dll", "Fertiliser"),
+    "maize": ("Maize.dll", "Maize"),
+    "soybean": ("Plant.dll", "Plant.soybean"),
+    "operations": ("Operations.dll", "Operations"),
+    "manager": ("Manager.dll", "Manager"),
+}
+
+# nodes with nothing to run, e.g. the graphs under an outputfile
+IGNORED_TAGS = ["Graph", "memo", "tracker"]
+
+# SoilWater node -> SoilWat initdata name
+SOILWAT_PARAMS = {
+    "SummerCona": "summercona",
+    "SummerU": "summeru",
+    "SummerDate": "summerdate",
+    "WinterCona": "wintercona",
+    "WinterU": "winteru",
+    "WinterDate": "winterdate",
+    "DiffusConst": "diffus_const",
+    "DiffusSlope": "diffus_slope",
+    "Salb": "salb",
+    "CN2Bare": "cn2_bare",
+    "CNRed": "cn_red",
+    "CNCov": "cn_cov",
+    "Slope": "slope",
+    "DischargeWidth": "discharge_width",
+    "CatchmentArea": "catchment_area",
+    "MaxPond": "max_pond",
+}
+
+# Water node -> soil water initdata name
+WATER_LAYERS = {"Thickness": "dlayer", "BD": "bd", "AirDry": "air_dry", "LL15": "ll15", "DUL": "dul", "SAT": "sat", "KS": "ks"}
+
+# SoilOrganicMatter node -> SoilNitrogen initdata name
+SOM_PARAMS = {"RootCN": "root_cn", "RootWt": "root_wt", "SoilCN": "soil_cn", "EnrACoeff": "enr_a_coeff", "EnrBCoeff": "enr_b_coeff"}
+SOM_LAYERS = {"OC": "oc", "FBiom": "fbiom", "FInert": "finert"}
+
+
+class UnsupportedComponent(ValueError):
+    """Raised for .apsim content outside the subset the native converter handles."""
+
+
+def get_values(parent, tag):
+    """Returns the <double> values of a layered node as strings, or None if the node is missing."""
+    node = parent.find(tag)
+    if node == None:
+        return None
+    return [d.text.strip() for d in node.findall("double")]
+
+
+def is_missing(value):
+    return value == None or value.strip() == "" or value.strip().lower() == "nan"
+
+
+def add_param(initdata, name, value):
+    """Adds an initdata parameter, leaving out missing (NaN) values so the component uses its default."""
+    if isinstance(value, list):
+        if len(value) == 0 or any(is_missing(v) for v in value):
+            return None
+        value = " ".join(value)
+    elif is_missing(value):
+        return None
+    param = SubElement(initdata, name)
+    param.text = value.strip()
+    return param
+
+
+def new_component(parent, name, tag):
+    """Adds an empty <component> for an .apsim node tag and returns its <initdata>."""
+    dll, class_name = COMPONENT_DLLS[tag]
+    component = SubElement(parent, "component")
+    component.set("name", name)
+    component.set("executable", MODEL_DIR + dll)
+    component.set("class", class_name)
+    executable = SubElement(component, "executable")
+    executable.set("name", MODEL_DIR + dll)
+    executable.set("version", "1.0")
+    return SubElement(component, "initdata")
+
+
+@functools.lru_cache(maxsize=None)
+def read_ini(ini_filename):
+    """Reads the constants of a crop or model ini file, once per process.
+
+    Returns:
+        [tuple]: constant elements, from the file's <Model> section when it has one
+    """
+    root = parse(ini_filename).getroot()
+    model = root.find(".//Model")
+    if model != None:
+        root = model
+    # a single crop node holding the constants, e.g. <maize>
+    if len(root) == 1 and len(root[0]) > 0:
+        root = root[0]
+    return tuple(root)
+
+
+def model_folder():
+    """Returns the Model folder of the configured APSIM install, or None without one."""
+    from apsim.executables import registry
+
+    try:
+        apsim_exe = registry.apsim_command()[-1]
+    except FileNotFoundError:
+        return None
+    folder = os.path.dirname(apsim_exe)
+    return folder if os.path.isdir(folder) else None
+
+
+def inline_ini(initdata, ini_filename):
+    """Appends the constants of an ini file to a component's initdata."""
+    present = set(param.tag for param in initdata)
+    for constant in read_ini(ini_filename):
+        if constant.tag not in present:
+            initdata.append(constant)
+
+
+def inline_model_ini(initdata, model_dir, dll):
+    """Appends the default constants shipped with the APSIM install for a component DLL, if there are any."""
+    if model_dir == None:
+        return
+    ini_filename = os.path.join(model_dir, dll.replace(".dll", ".xml"))
+    if os.path.exists(ini_filename):
+        inline_ini(initdata, ini_filename)
+
+
+def initial_sw(water, initial_water):
+    """Initial soil water per layer from an <InitialWater> node: FractionFull of plant available water."""
+    ll15 = [float(v) for v in get_values(water, "LL15")]
+    dul = [float(v) for v in get_values(water, "DUL")]
+    fraction = 1.0
+    if initial_water != None and initial_water.findtext("FractionFull"):
+        fraction = float(initial_water.findtext("FractionFull"))
+    method = "FilledFromTop" if initial_water == None else initial_water.findtext("PercentMethod", "FilledFromTop")
+    if method == "FilledFromTop" and 0 < fraction < 1:
+        thickness = [float(v) for v in get_values(water, "Thickness")]
+        capacity = [(d - ll) * t for d, ll, t in zip(dul, ll15, thickness)]
+        remaining = fraction * sum(capacity)
+        sw = []
+        for ll, cap, t in zip(ll15, capacity, thickness):
+            filled = min(cap, remaining)
+            remaining -= filled
+            sw.append(ll + filled / t)
+        return [f"{v:.3f}" for v in sw]
+    return [f"{ll + fraction * (d - ll):.3f}" for ll, d in zip(ll15, dul)]
+
+
+def check_layers(node, water_thickness):
+    thickness = get_values(node, "Thickness")
+    if thickness != None and [float(t) for t in thickness] != [float(t) for t in water_thickness]:
+        raise UnsupportedComponent(f"{node.tag} layers differ from the Water layers")
+
+
+def convert_soil(paddock, soil, model_dir=None):
+    """Adds the soil water and soil nitrogen components of a <Soil> node. Returns the SoilCrop nodes by crop."""
+    water = soil.find("Water")
+    if water == None:
+        raise UnsupportedComponent("Soil without Water")
+    water_thickness = get_values(water, "Thickness")
+    swim = soil.find("Swim")
+    if swim != None:
+        initdata = new_component(paddock, "Swim", "Swim")
+        for param in swim:
+            if len(param) == 0:
+                add_param(initdata, param.tag.lower(), param.text)
+        for group in swim:
+            if len(group) == 0:
+                continue
+            for param in group:
+                values = get_values(group, param.tag) if len(param) > 0 else param.text
+                add_param(initdata, param.tag.lower(), values)
+        inline_model_ini(initdata, model_dir, COMPONENT_DLLS["Swim"][0])
+    else:
+        soil_water = soil.find("SoilWater")
+        if soil_water == None:
+            raise UnsupportedComponent("Soil without SoilWater or Swim")
+        check_layers(soil_water, water_thickness)
+        initdata = new_component(paddock, "Soil Water", "SoilWater")
+        for tag, name in SOILWAT_PARAMS.items():
+            add_param(initdata, name, soil_water.findtext(tag))
+        add_param(initdata, "swcon", get_values(soil_water, "SWCON"))
+        inline_model_ini(initdata, model_dir, COMPONENT_DLLS["SoilWater"][0])
+    for tag, name in WATER_LAYERS.items():
+        add_param(initdata, name, get_values(water, tag))
+    add_param(initdata, "sw", initial_sw(water, soil.find("InitialWater")))
+
+    som = soil.find("SoilOrganicMatter")
+    if som != None:
+        check_layers(som, water_thickness)
+        initdata = new_component(paddock, "Soil Nitrogen", "SoilOrganicMatter")
+        for tag, name in SOM_PARAMS.items():
+            add_param(initdata, name, som.findtext(tag))
+        add_param(initdata, "dlayer", water_thickness)
+        for tag, name in SOM_LAYERS.items():
+            add_param(initdata, name, get_values(som, tag))
+        analysis = soil.find("Analysis")
+        if analysis != None:
+            check_layers(analysis, water_thickness)
+            add_param(initdata, "ph", get_values(analysis, "PH"))
+        for sample in soil.findall("Sample"):
+            check_layers(sample, water_thickness)
+            add_param(initdata, "no3ppm", get_values(sample, "NO3"))
+            add_param(initdata, "nh4ppm", get_values(sample, "NH4"))
+        inline_model_ini(initdata, model_dir, COMPONENT_DLLS["SoilOrganicMatter"][0])
+
+    return {crop.get("name", "").lower(): crop for crop in water.findall("SoilCrop")}
+
+
+def convert_crop(paddock, crop, soil_crops, model_dir=None):
+    initdata = new_component(paddock, crop.get("name", crop.tag), crop.tag)
+    soil_crop = soil_crops.get(crop.tag)
+    if soil_crop == None:
+        raise UnsupportedComponent(f"no SoilCrop for {crop.tag}")
+    add_param(initdata, "ll", get_values(soil_crop, "LL"))
+    add_param(initdata, "kl", get_values(soil_crop, "KL"))
+    add_param(initdata, "xf", get_values(soil_crop, "XF"))
+    add_param(initdata, "uptake_source", "calc")
+    ini_filename = crop.findtext("ini/filename")
+    if ini_filename:
+        inline_ini(initdata, ini_filename)
+    else:
+        inline_model_ini(initdata, model_dir, COMPONENT_DLLS[crop.tag][0])
+
+
+def convert_surfaceom(paddock, surfaceom, model_dir=None):
+    initdata = new_component(paddock, surfaceom.get("name", "SurfaceOrganicMatter"), "surfaceom")
+    add_param(initdata, "name", surfaceom.findtext("PoolName"))
+    for tag in ["type", "mass", "cnr", "standing_fraction"]:
+        add_param(initdata, tag, surfaceom.findtext(tag))
+    inline_model_ini(initdata, model_dir, COMPONENT_DLLS["surfaceom"][0])
+
+
+def convert_outputfile(paddock, outputfile):
+    initdata = new_component(paddock, outputfile.get("name", "outputfile"), "outputfile")
+    out_filename = outputfile.findtext("filename")
+    if not out_filename:
+        raise UnsupportedComponent("outputfile without a filename")
+    add_param(initdata, "outputfile", out_filename)
+    for variable in outputfile.iter("variable"):
+        add_param(initdata, "variable", variable.text)
+    for event in outputfile.iter("event"):
+        add_param(initdata, "event", event.text)
+    add_param(initdata, "title", outputfile.findtext("title"))
+    for constant in outputfile.iter("constant"):
+        add_param(initdata, constant.get("name"), constant.text)
+
+
+def convert_operations(paddock, operations):
+    initdata = new_component(paddock, operations.get("name", "Operations Schedule"), "operations")
+    for op in operations.findall("operation"):
+        operation = SubElement(initdata, "operation")
+        operation.set("condition", op.get("condition", "start_of_day"))
+        SubElement(operation, "date").text = op.findtext("date")
+        SubElement(operation, "action").text = op.findtext("action")
+
+
+def convert_manager(paddock, manager):
+    name = manager.get("name", "manager")
+    initdata = new_component(paddock, name, "manager")
+    for script in manager.findall("script"):
+        event = script.findtext("event")
+        text = script.findtext("text") or ""
+        rule = SubElement(initdata, "rule")
+        rule.set("name", f"{name} rules")
+        rule.set("condition", event)
+        rule.text = text
+
+
+def convert_area(sim_elem, area, model_dir=None):
+    """Adds a paddock <system> for an <area> node."""
+    paddock = SubElement(sim_elem, "system")
+    paddock.set("name", area.get("name", "paddock"))
+    paddock.set("executable", MODEL_DIR + "ProtocolManager.dll")
+    soil_crops = {}
+    soil = area.find("Soil")
+    if soil != None:
+        soil_crops = convert_soil(paddock, soil, model_dir)
+    for node in area:
+        if node.tag == "Soil":
+            continue
+        elif node.tag == "surfaceom":
+            convert_surfaceom(paddock, node, model_dir)
+        elif node.tag == "fertiliser":
+            initdata = new_component(paddock, node.get("name", "fertiliser"), "fertiliser")
+            inline_model_ini(initdata, model_dir, COMPONENT_DLLS["fertiliser"][0])
+        elif node.tag in ["maize", "soybean"]:
+            convert_crop(paddock, node, soil_crops, model_dir)
+        elif node.tag == "outputfile":
+            convert_outputfile(paddock, node)
+        elif node.tag == "folder":
+            # the OpManager's "Manager folder"
+            for child in node:
+                if child.tag == "operations":
+                    convert_operations(paddock, child)
+                elif child.tag == "manager":
+                    convert_manager(paddock, child)
+                else:
+                    raise UnsupportedComponent(f"{child.tag} in {node.get('name')}")
+        elif node.tag == "operations":
+            convert_operations(paddock, node)
+        elif node.tag == "manager":
+            convert_manager(paddock, node)
+        elif node.tag not in IGNORED_TAGS:
+            raise UnsupportedComponent(node.tag)
+    return paddock
+
+
+def convert_simulation(sim, model_dir=None):
+    """Builds the .sim XML of one <simulation> node.
+
+    Args:
+        sim (Element): <simulation> node of an .apsim file
+        model_dir (str, optional): APSIM Model folder to inline default constants from. Defaults to None.
+
+    Raises:
+        UnsupportedComponent: when the simulation uses a component the converter doesn't handle
+
+    Returns:
+        [Element]: the .sim root
+    """
+    name = sim.get("name")
+    sim_elem = Element("simulation")
+    sim_elem.set("name", name)
+    sim_elem.set("executable", MODEL_DIR + "ProtocolManager.dll")
+    sim_elem.set("version", SIM_VERSION)
+    SubElement(sim_elem, "title").text = name
+    for node in sim:
+        if node.tag == "metfile":
+            initdata = new_component(sim_elem, "met", "metfile")
+            filename = SubElement(initdata, "filename")
+            filename.set("name", "filename")
+            filename.set("input", "yes")
+            filename.text = node.findtext("filename")
+        elif node.tag == "clock":
+            initdata = new_component(sim_elem, "clock", "clock")
+            add_param(initdata, "start_date", node.findtext("start_date"))
+            add_param(initdata, "end_date", node.findtext("end_date"))
+        elif node.tag == "summaryfile":
+            initdata = new_component(sim_elem, "SummaryFile", "summaryfile")
+            add_param(initdata, "summaryfile", f"{name}.sum")
+        elif node.tag == "area":
+            convert_area(sim_elem, node, model_dir)
+        elif node.tag not in IGNORED_TAGS:
+            raise UnsupportedComponent(node.tag)
+    return sim_elem
+
+
+def convert_apsim_file(apsim_filename, model_dir=None):
+    """Writes <simulation name>.sim next to an .apsim file for each of its simulations, as ApsimToSim does.
+
+    Every simulation is converted before any .sim file is written, so an unsupported file leaves nothing behind.
+
+    Args:
+        apsim_filename (str): path to .apsim file
+        model_dir (str, optional): APSIM Model folder to inline default constants from. Defaults to model_folder().
+
+    Raises:
+        UnsupportedComponent: when a simulation uses a component the converter doesn't handle
+
+    Returns:
+        [list]: paths of the .sim files
+    """
+    if model_dir == None:
+        model_dir = model_folder()
+    folder = os.path.dirname(apsim_filename)
+    sims = [convert_simulation(sim, model_dir) for sim in parse(apsim_filename).getroot().iter("simulation")]
+    sim_filenames = []
+    for sim_elem in sims:
+        sim_filename = os.path.join(folder, f"{sim_elem.get('name')}.sim")
+        ElementTree(sim_elem).write(sim_filename)
+        sim_filenames.append(sim_filename)
+    return sim_filenames
+
+
+def convert_many(apsim_filenames, model_dir=None):
+    """Converts a batch of .apsim files in this process, sharing the ini file cache.
+
+    Returns:
+        [tuple]: (list of .sim paths, dict of .apsim path -> error for files that couldn't be converted)
+    """
+    if model_dir == None:
+        model_dir = model_folder()
+    sim_filenames = []
+    errors = {}
+    for apsim_filename in apsim_filenames:
+        try:
+            sim_filenames.extend(convert_apsim_file(apsim_filename, model_dir))
+        except (OSError, SyntaxError, ValueError) as e:
+            errors[apsim_filename] = e
+    return sim_filenames, errors
+
+
+def same_value(expected, actual, rel_tol):
+    expected = (expected or "").split()
+    actual = (actual or "").split()
+    if len(expected) != len(actual):
+        return False
+    for e, a in zip(expected, actual):
+        if e == a:
+            continue
+        try:
+            if not math.isclose(float(e), float(a), rel_tol=rel_tol):
+                return False
+        except ValueError:
+            if e.lower() != a.lower():
+                return False
+    return True
+
+
+def component_params(component):
+    """Maps a component's initdata parameters to their text; repeated parameters are joined in order."""
+    params = {}
+    initdata = component.find("initdata")
+    if initdata == None:
+        return params
+    for param in initdata:
+        text = (param.text or "").strip() if len(param) == 0 else " ".join((p.text or "").strip() for p in param.iter() if p is not param)
+        params[param.tag.lower()] = params[param.tag.lower()] + "\n" + text if param.tag.lower() in params else text
+    return params
+
+
+def sim_components(sim_filename):
+    """Maps '<system path>/<class>' to each component of a .sim file."""
+    components = {}
+
+    def walk(node, path):
+        for child in node:
+            if child.tag == "system":
+                walk(child, f"{path}/{child.get('name')}")
+            elif child.tag == "component":
+                components[f"{path}/{child.get('class')}"] = child
+
+    walk(parse(sim_filename).getroot(), "")
+    return components
+
+
+def compare_sim_files(expected_filename, actual_filename, rel_tol=1e-6):
+    """Lists the differences between two .sim files, e.g. ApsimToSim's output and convert_apsim_file()'s.
+
+    Components are matched by their system path and class, parameters by name; numbers are compared with rel_tol.
+    Parameters that only one file has are reported too.
+
+    Returns:
+        [list]: (component, parameter, expected, actual) tuples, empty when the files agree
+    """
+    expected = sim_components(expected_filename)
+    actual = sim_components(actual_filename)
+    differences = []
+    for key in sorted(set(expected) | set(actual)):
+        if key not in actual or key not in expected:
+            differences.append((key, None, key in expected, key in actual))
+            continue
+        expected_params = component_params(expected[key])
+        actual_params = component_params(actual[key])
+        for name in sorted(set(expected_params) | set(actual_params)):
+            if not same_value(expected_params.get(name), actual_params.get(name), rel_tol):
+                differences.append((key, name, expected_params.get(name), actual_params.get(name)))
+    return differences
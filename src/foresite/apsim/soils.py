@@ -154,6 +154,44 @@ def set_value_by_depth(soil_df, var_name, min_depth, max_depth, value, eqn=None)
     return
 
 
+###
+def fetch_soil_properties(dbconn, mukeys, chunk_size=500):
+    """Fetches the SSURGO horizons of many mukeys with api.get_soil_properties, one query per chunk of mukeys
+    instead of one per mukey, and groups them by mukey.
+
+    Args:
+        dbconn (obj): Connection to PostgreSQL server with SSURGO data
+        mukeys (list): SSURGO mukeys
+        chunk_size (int, optional): most mukeys per query. Defaults to 500.
+
+    Returns:
+        [dict]: str(mukey) -> dataframe of its horizons, in the order the query returned them. Mukeys without
+            horizons are left out.
+    """
+    # imported here so building soils from dataframes doesn't need sqlalchemy
+    from sqlalchemy import text
+
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be at least 1, got {chunk_size}.")
+    mukeys = list(dict.fromkeys(str(mukey) for mukey in mukeys))
+    # the mukeys are bound as one array parameter, never formatted into the query
+    soil_query = text("select * from api.get_soil_properties( cast(:mukeys as text[]) )")
+    soils = {}
+    for start in range(0, len(mukeys), chunk_size):
+        chunk = mukeys[start : start + chunk_size]
+        soil_df = pd.read_sql(soil_query, dbconn, params={"mukeys": list(chunk)})
+        if soil_df.empty:
+            continue
+        if "mukey" not in soil_df.columns:
+            if len(chunk) > 1:
+                raise ValueError("api.get_soil_properties returned no mukey column to group horizons by, use chunk_size=1.")
+            soils[chunk[0]] = soil_df
+            continue
+        for mukey, horizons in soil_df.groupby(soil_df["mukey"].astype(str), sort=False):
+            soils[mukey] = horizons.reset_index(drop=True)
+    return soils
+
+
 ###
 def calculate_saxton_rawls(soil_df):
     """Add calculated Saxton-Rawls variables to soils dataframe"""
@@ -0,0 +1,138 @@
+"""
+Per-job run ledger for the APSIM runner.
+
+Each finished job appends one JSON line with its timings and resource use:
+    job -- .apsim (or .sim) file. A batch that converts every file before running any writes one record for each
+        conversion and one for each .sim run.
+    mukey -- SSURGO mukey parsed from the simulation name, when there is one
+    worker -- name of the worker thread that ran the job
+    status -- 'ok', 'failed' or 'cached'
+    queue_wait -- seconds between the job being queued and a worker starting it
+    convert_seconds, simulate_seconds -- wall time of each stage, retries included
+    convert_returncode, simulate_returncode -- exit codes of the last attempt
+    attempts -- conversion and simulation attempts in total
+    peak_rss -- largest resident memory of any APSIM process of the job, in bytes
+    output_bytes -- size of the .out files written, as stored (compressed, see apsim.output_store)
+    started -- unix time the job started
+"""
+
+import json
+import os
+import re
+import threading
+from time import perf_counter, time
+
+import pandas as pd
+from apsim.output_store import output_size
+from apsim.scheduler import current_job
+
+LEDGER_FILENAME = "run_ledger.jsonl"
+SUMMARY_COLUMNS = ["queue_wait", "convert_seconds", "simulate_seconds", "total_seconds", "peak_rss", "output_bytes"]
+
+
+def get_mukey(filename):
+    """Returns the mukey in a Foresite simulation or file name, or None."""
+    match = re.search("mukey_(.*?)_rot", os.path.basename(filename))
+    if match == None:
+        return None
+    return match.group(1)
+
+
+def start_job_record(job):
+    """Starts a ledger record for a job running on the current scheduler worker."""
+    info = current_job()
+    return {
+        "job": job,
+        "mukey": get_mukey(job),
+        "worker": info.get("worker"),
+        "status": "ok",
+        "queue_wait": info.get("queue_wait"),
+        "convert_seconds": 0.0,
+        "simulate_seconds": 0.0,
+        "convert_returncode": None,
+        "simulate_returncode": None,
+        "attempts": 0,
+        "peak_rss": None,
+        "output_bytes": 0,
+        "started": time(),
+        "_start": perf_counter(),
+    }
+
+
+def add_stage(record, stage, stats):
+    """Adds the stats filled in by run_with_retry for one 'convert' or 'simulate' stage to a job record."""
+    record[f"{stage}_seconds"] += stats.get("seconds", 0.0)
+    record[f"{stage}_returncode"] = stats.get("returncode")
+    record["attempts"] += stats.get("attempts", 0)
+    if stats.get("peak_rss") != None:
+        record["peak_rss"] = max(record["peak_rss"] or 0, stats["peak_rss"])
+
+
+def finish_job_record(record, out_filenames):
+    """Fills in the total time and output size of a job record; compressed outputs count their compressed size."""
+    record["total_seconds"] = perf_counter() - record.pop("_start")
+    record["output_bytes"] = sum(output_size(f) for f in out_filenames)
+    return record
+
+
+class RunLedger:
+    """Appends job records to a JSON lines file. Safe to share between worker threads.
+
+    Args:
+        path (str): ledger file, created if it doesn't exist
+    """
+
+    ###
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    ###
+    def write(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            with open(self.path, "a") as ledger_file:
+                ledger_file.write(line + "\n")
+
+
+def read_ledger(path):
+    """Reads a run ledger into a dataframe with one row per job."""
+    with open(path, "r") as ledger_file:
+        records = [json.loads(line) for line in ledger_file if line.strip()]
+    df = pd.DataFrame(records)
+    for col in SUMMARY_COLUMNS:
+        if col not in df.columns:
+            df[col] = float("nan")
+    return df
+
+
+def summarize_ledger(path, top=10):
+    """Summarizes a run ledger.
+
+    Args:
+        path (str): ledger file
+        top (int, optional): number of slowest jobs to list. Defaults to 10.
+
+    Returns:
+        [dict]: 'jobs' and 'failed' counts, 'percentiles' (p50/p90/p99/max of each timing and resource column) and
+        'slowest' (the top slowest jobs with their mukey)
+    """
+    df = read_ledger(path)
+    percentiles = df[SUMMARY_COLUMNS].astype("float64").quantile([0.5, 0.9, 0.99, 1.0])
+    percentiles.index = ["p50", "p90", "p99", "max"]
+    slowest = df.sort_values("total_seconds", ascending=False).head(top)
+    return {
+        "jobs": len(df),
+        "failed": int((df["status"] == "failed").sum()) if "status" in df.columns else 0,
+        "percentiles": percentiles,
+        "slowest": slowest[[c for c in ["mukey", "job", "worker", "status", "total_seconds", "simulate_seconds", "peak_rss"] if c in slowest.columns]],
+    }
+
+
+def print_ledger_summary(path, top=10):
+    """Prints summarize_ledger() for a ledger file."""
+    summary = summarize_ledger(path, top)
+    print(f"{summary['jobs']} jobs, {summary['failed']} failed")
+    print(summary["percentiles"].to_string())
+    print(f"Slowest {top} jobs:")
+    print(summary["slowest"].to_string(index=False))
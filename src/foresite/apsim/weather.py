@@ -1,4 +1,8 @@
-"""Tbw."""
+"""Tbw.
+
+requests and openpyxl are imported where weather data is downloaded or written to Excel, so building simulations
+doesn't need them.
+"""
 
 import io
 import json
@@ -7,10 +11,6 @@ import urllib
 
 import numpy as np
 import pandas as pd
-import requests
-from openpyxl import Workbook
-from openpyxl.styles import Alignment
-from openpyxl.utils.dataframe import dataframe_to_rows
 
 DAYMET_URL = "https://daymet.ornl.gov/single-pixel/api/data"
 
@@ -124,6 +124,8 @@ class Weather:
             "vars": ",".join(attributes),
             "years": ",".join(year_arr),
         }
+        import requests
+
         req = requests.get(DAYMET_URL, params=payload)
         wth_df = pd.read_csv(io.StringIO(req.text), sep=",", header=6)
 
@@ -210,6 +212,8 @@ class Weather:
         # request from API
         nasa_params = r"PRECTOTCORR,ALLSKY_SFC_SW_DWN,T2M_MIN,T2M_MAX,WS2M"
         full_url = f"{NASA_URL}startDate={start_year}0101&endDate={end_year}1231&lat={lat}&lon={lon}&outputList={output}&userCommunity=SSE"
+        import requests
+
         json_response = json.loads(requests.get(full_url).content.decode("utf-8"))
         # Selects the file URL from the JSON response
         csv_request_url = json_response["outputs"][output.lower()]
@@ -306,6 +310,10 @@ class Weather:
         else:
             lat = self.lat
             lon = self.lon
+        from openpyxl import Workbook
+        from openpyxl.styles import Alignment
+        from openpyxl.utils.dataframe import dataframe_to_rows
+
         # greene_df.to_excel('greene.xlsx', index=False)
         wb = Workbook()
         ws = wb.active
@@ -443,6 +451,8 @@ class Weather:
             "vars": ",".join(attributes),
             "years": ",".join(year_arr),
         }
+        import requests
+
         req = requests.get(DAYMET_URL, params=payload)
         spinup_df = pd.read_csv(io.StringIO(req.text), sep=",", header=6)
 
@@ -527,6 +537,10 @@ def create_excel_met(lat, long, start_year, end_year, met_name, tar_folder="apsi
     wth_df = wth_obj.data
     tav = round(wth_df["maxt"].mean(), 1)
     amp = round(wth_df["maxt"].max(), 1)
+    from openpyxl import Workbook
+    from openpyxl.styles import Alignment
+    from openpyxl.utils.dataframe import dataframe_to_rows
+
     # greene_df.to_excel('greene.xlsx', index=False)
     wb = Workbook()
     ws = wb.active
@@ -29,7 +29,20 @@ def Weather():
 
 
 ###
-def set_output_variables(out_file, var_list):
+def set_output_variables(out_file, var_list, events=None, precision=5):
+    """Creates an APSIM outputfile node reporting var_list to out_file.
+
+    Args:
+        out_file (str): .out filename
+        var_list (list): report variables
+        events (list, optional): report events, e.g. ['harvesting'] or ['end_of_year']. Defaults to ['daily'].
+        precision (int, optional): decimal places written. Defaults to 5.
+
+    Returns:
+        [xml]: outputfile node
+    """
+    if events == None:
+        events = ["daily"]
     output_xml = Element("outputfile")
     filename = SubElement(output_xml, "filename")
     filename.set("name", "filename")
@@ -47,12 +60,13 @@ def set_output_variables(out_file, var_list):
     consts = SubElement(vars, "constants")
     const = SubElement(consts, "constant")
     const.set("name", "precision")
-    const.text = "5"
+    const.text = str(precision)
 
     evnts = SubElement(output_xml, "events")
     evnts.set("name", "Output variable events")
-    evnt = SubElement(evnts, "event")
-    evnt.text = "daily"
+    for event in events:
+        evnt = SubElement(evnts, "event")
+        evnt.text = event
 
     var_list = [var for var in var_list if var not in ["dd/mm/yyyy as Date", "day", "year"]]
 
@@ -5,6 +5,8 @@ import os
 import shutil
 import sys
 import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
 from glob import glob
 from zipfile import ZipFile
@@ -48,65 +50,78 @@ def create_apsim_files_from_dict(
     maize_xml=None,
     soy_xml=None,
     tar_folder=None,
+    num_workers=1,
+    incremental=False,
 ):
-    for i in runs_dict:
-        rotation = runs_dict[i][0]
-        runs_folder = runs_dict[i][1]
-        field_prefix = runs_dict[i][2]
-        met_file = runs_dict[i][3]
-        end_year = runs_dict[i][4]
-        mgmt_folder = os.path.join(tar_folder, runs_dict[i][7])
-        start_year = end_year - 3
-        prior_year = end_year - 1
-        ssurgo_file = os.path.join(tar_folder, "ssurgo", runs_dict[i][5])
-        ssurgo_gdf = gpd.read_file(ssurgo_file)
-        mukeys = list(np.unique(ssurgo_gdf["mukey"]))
-        out_path = os.path.join(
-            tar_folder,
-            "apsim_files",
-            runs_folder,
-            str(end_year),
-            rotation,
-            "met_files",
-        )
-        if not os.path.exists(out_path):
-            os.makedirs(out_path)
-        if rotation == "cfs":
-            corn_mgmt = get_management_file(mgmt_folder, f"{field_prefix}_{rotation}_{end_year}.json")
-            soy_mgmt = get_management_file(mgmt_folder, f"{field_prefix}_sfc_{prior_year}.json")
-            # print(json.dumps(corn_mgmt, indent=1))
-            # print(json.dumps(soy_mgmt, indent=1))
-        elif rotation == "sfc":
-            soy_mgmt = get_management_file(mgmt_folder, f"{field_prefix}_{rotation}_{end_year}.json")
-            corn_mgmt = get_management_file(mgmt_folder, f"{field_prefix}_cfs_{prior_year}.json")
-            # print(json.dumps(soy_mgmt, indent=1))
-            # print(json.dumps(corn_mgmt, indent=1))
-        create_mukey_runs(
-            mukeys,
-            dbconn,
-            rotation,
-            met_file,
-            field_name=runs_folder,
-            tar_folder=tar_folder,
-            start_year=start_year,
-            end_year=end_year,
-            sfc_mgmt=soy_mgmt,
-            cfs_mgmt=corn_mgmt,
-            swim=swim,
-            saxton=saxton,
-            maize_xml=maize_xml,
-            soy_xml=soy_xml,
-        )
-        met_src_path = os.path.join(tar_folder, "met_files", met_folder, runs_dict[i][3])
-        met_tar_path = os.path.join(
-            tar_folder,
-            "apsim_files",
-            runs_folder,
-            str(end_year),
-            rotation,
-            "met_files",
-        )
-        copy_met_file(met_src_path, met_tar_path)
+    """Writes the .apsim files of every field/rotation in runs_dict. With num_workers > 1 the files are built in a
+    process pool shared by every create_mukey_runs call. Returns the mukeys whose file wasn't written, by runs_dict
+    key (see create_mukey_runs). incremental only rewrites the files whose inputs changed, see create_mukey_runs."""
+    failures = {}
+    with ProcessPoolExecutor(num_workers) if num_workers > 1 else nullcontext() as executor:
+        for i in runs_dict:
+            rotation = runs_dict[i][0]
+            runs_folder = runs_dict[i][1]
+            field_prefix = runs_dict[i][2]
+            met_file = runs_dict[i][3]
+            end_year = runs_dict[i][4]
+            mgmt_folder = os.path.join(tar_folder, runs_dict[i][7])
+            start_year = end_year - 3
+            prior_year = end_year - 1
+            ssurgo_file = os.path.join(tar_folder, "ssurgo", runs_dict[i][5])
+            ssurgo_gdf = gpd.read_file(ssurgo_file)
+            mukeys = list(np.unique(ssurgo_gdf["mukey"]))
+            out_path = os.path.join(
+                tar_folder,
+                "apsim_files",
+                runs_folder,
+                str(end_year),
+                rotation,
+                "met_files",
+            )
+            if not os.path.exists(out_path):
+                os.makedirs(out_path)
+            # other rotations have no management files here, create_mukey_runs reports them
+            corn_mgmt = soy_mgmt = None
+            if rotation == "cfs":
+                corn_mgmt = get_management_file(mgmt_folder, f"{field_prefix}_{rotation}_{end_year}.json")
+                soy_mgmt = get_management_file(mgmt_folder, f"{field_prefix}_sfc_{prior_year}.json")
+                # print(json.dumps(corn_mgmt, indent=1))
+                # print(json.dumps(soy_mgmt, indent=1))
+            elif rotation == "sfc":
+                soy_mgmt = get_management_file(mgmt_folder, f"{field_prefix}_{rotation}_{end_year}.json")
+                corn_mgmt = get_management_file(mgmt_folder, f"{field_prefix}_cfs_{prior_year}.json")
+                # print(json.dumps(soy_mgmt, indent=1))
+                # print(json.dumps(corn_mgmt, indent=1))
+            failures[i] = create_mukey_runs(
+                mukeys,
+                dbconn,
+                rotation,
+                met_file,
+                field_name=runs_folder,
+                tar_folder=tar_folder,
+                start_year=start_year,
+                end_year=end_year,
+                sfc_mgmt=soy_mgmt,
+                cfs_mgmt=corn_mgmt,
+                swim=swim,
+                saxton=saxton,
+                maize_xml=maize_xml,
+                soy_xml=soy_xml,
+                num_workers=num_workers,
+                executor=executor,
+                incremental=incremental,
+            )
+            met_src_path = os.path.join(tar_folder, "met_files", met_folder, runs_dict[i][3])
+            met_tar_path = os.path.join(
+                tar_folder,
+                "apsim_files",
+                runs_folder,
+                str(end_year),
+                rotation,
+                "met_files",
+            )
+            copy_met_file(met_src_path, met_tar_path)
+    return failures
 
 
 def run_apsim_files_from_dict(runs_dict, tar_folder):
@@ -1,4 +1,110 @@
+import asyncio
+import importlib.util
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib.request
+from glob import glob
+from unittest import mock
+from xml.etree.ElementTree import Element, ElementTree, SubElement, fromstring, parse, tostring
+
+import numpy as np
+import pandas as pd
+
+# apsim modules import each other as a top-level `apsim` package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "foresite"))
+
+import apsim.run_apsim as run_apsim
+from apsim.apsim_input_writer import SimulationTemplate, build_management_xml, build_mukey_simulation, create_mukey_runs, management_key, management_xml
+from apsim.apsim_output_parser import parse_manifest_output, parse_pack_output, parse_summary_output
+from apsim.async_runner import get_out_filenames, iter_sims_async, run_sims_async
+from apsim.checkpoint import CHECKPOINT_FILENAME, Checkpoint
+from apsim.executables import ExecutableRegistry, configure_executables
+from apsim.fake_apsim import use_fake_backend, write_fake_batch
+from apsim.job_cost import order_by_cost
+from apsim.job_queue import LEASE_QUERY, JobQueue, run_worker
+from apsim.output_profiles import output_profile
+from apsim.output_store import archive_outputs, is_output, list_outputs, remove_outputs
+from apsim.progress import ProgressTracker, serve_metrics
+from apsim.resources import AdaptiveConcurrency
+from apsim.run_manifest import build_run_manifest, load_run_manifest
+from apsim.scheduler import SimScheduler
+from apsim.sim_cache import SimCache, hash_simulation
+from apsim.sim_converter import convert_many
+from apsim.soils import Soil, fetch_soil_properties
+from apsim.telemetry import RunLedger, read_ledger, summarize_ledger
+
+needs_sqlalchemy = unittest.skipUnless(importlib.util.find_spec("sqlalchemy"), "needs sqlalchemy")
+
+
+def soil_horizons(mukey):
+    horizon = {"wfifteenbar_r": 12.0, "wthirdbar_r": 28.0, "dbthirdbar_r": 1.4, "ksat_r": 9.0, "claytotal_r": 25.0, "sandtotal_r": 30.0, "om_r": 3.0, "ph1to1h2o_r": 6.5}
+    return [dict(horizon, mukey=mukey, hzdept_r=top, hzdepb_r=bottom) for top, bottom in [(0, 20), (20, 60), (60, 200)]]
+
+
+def read_soil_properties(query, dbconn, params=None):
+    """Stands in for pd.read_sql in fetch_soil_properties: three horizons per mukey, and a depth the Soil can't
+    compare for mukey 4."""
+    soil_df = pd.DataFrame([horizon for mukey in params["mukeys"] for horizon in soil_horizons(mukey)])
+    soil_df.loc[soil_df["mukey"] == "4", "hzdepb_r"] = "bad"
+    return soil_df
+
+
+def management(crop):
+    return {
+        "tillage_implement": "disk",
+        "tillage_depth": 100,
+        "tillage_residue_incorporation": 0.5,
+        "tillage_timing": "15-apr",
+        "kg_n_ha": 150,
+        "fertilize_n_on": "20-apr",
+        "n_fertilizer": "UreaN",
+        "fert_depth": 50,
+        "sow_crop": crop,
+        "cultivar": "B_110" if crop == "maize" else "IA_2",
+        "planting_date": "05-may",
+        "sowing_density": 8,
+        "sowing_depth": 50,
+        "row_spacing": 760,
+        "harvest": crop,
+        "harvest_date": "15-oct",
+    }
+
+
+def write_mukey_runs(mukeys, tar_folder=None, **kwargs):
+    """Runs create_mukey_runs for field 'f' in tar_folder (default: a new folder), kwargs overriding the cfs
+    2015-2018 settings. Returns the runs folder and the failures."""
+    if tar_folder == None:
+        tar_folder = tempfile.mkdtemp()
+    settings = {
+        "rotation": "cfs",
+        "met_name": "m.met",
+        "field_name": "f",
+        "start_year": 2015,
+        "end_year": 2018,
+        "sfc_mgmt": management("soybean"),
+        "cfs_mgmt": management("maize"),
+        "maize_xml": "maize.xml",
+        "soy_xml": "soy.xml",
+    }
+    settings.update(kwargs)
+    with mock.patch("apsim.soils.pd.read_sql", side_effect=read_soil_properties):
+        failures = create_mukey_runs(mukeys, None, tar_folder=tar_folder, **settings)
+    return os.path.join(tar_folder, "apsim_files", "f", str(settings["end_year"]), settings["rotation"]), failures
+
+
+def read_apsim_files(folder):
+    names = sorted(name for name in os.listdir(folder) if name.endswith(".apsim"))
+    contents = {}
+    for name in names:
+        with open(os.path.join(folder, name), "rb") as apsim_file:
+            contents[name] = apsim_file.read()
+    return contents
 
 
 # create test class that inherits from unittest class
@@ -6,3 +112,628 @@ class TestApsimWriter(unittest.TestCase):
     def test_apsimwriter(self):
         # eg. self.assertEqual()
         pass
+
+    @needs_sqlalchemy
+    def test_soil_properties_are_fetched_in_chunks(self):
+        queries = []
+
+        def read_sql(query, dbconn, params=None):
+            queries.append((str(query), params["mukeys"]))
+            # two horizons per mukey, none for 3
+            return pd.DataFrame([{"mukey": int(m), "hzdept_r": d} for m in params["mukeys"] if m != "3" for d in [0, 20]])
+
+        with mock.patch("apsim.soils.pd.read_sql", side_effect=read_sql):
+            soils = fetch_soil_properties(None, [1, 2, 3, 4, 5, 2], chunk_size=2)
+        self.assertEqual([mukeys for _, mukeys in queries], [["1", "2"], ["3", "4"], ["5"]])
+        self.assertNotIn("'", queries[0][0])
+        self.assertEqual(sorted(soils), ["1", "2", "4", "5"])
+        self.assertEqual(list(soils["4"]["hzdept_r"]), [0, 20])
+        self.assertEqual(list(soils["4"].index), [0, 1])
+
+    @needs_sqlalchemy
+    def test_parallel_writer_matches_serial_and_reports_failed_mukeys(self):
+        serial_folder, serial_failures = write_mukey_runs([1, 2, 3, 4, 5])
+        # the workers describe what they write, the manifest doesn't read the files back
+        with mock.patch("apsim.run_manifest.describe_job", side_effect=AssertionError("file read back")):
+            parallel_folder, parallel_failures = write_mukey_runs([1, 2, 3, 4, 5], num_workers=3)
+        serial_files = read_apsim_files(serial_folder)
+        self.assertEqual(sorted(serial_files), ["f_1_cfs.apsim", "f_2_cfs.apsim", "f_3_cfs.apsim", "f_5_cfs.apsim"])
+        self.assertEqual(read_apsim_files(parallel_folder), serial_files)
+        for failures in [serial_failures, parallel_failures]:
+            self.assertEqual([failure["mukey"] for failure in failures], [4])
+            self.assertIn("Traceback", failures[0]["error"])
+            self.assertIn("TypeError", failures[0]["error"])
+        jobs = load_run_manifest(parallel_folder).jobs()
+        self.assertEqual(len(jobs), 4)
+        for job in jobs:
+            self.assertEqual(job["hash"], hash_simulation(job["job"]))
+            self.assertEqual(job["outputs"], [os.path.join(parallel_folder, f"name_f_mukey_{job['mukeys'][0]}_rot_cfs_sim.out")])
+
+    @needs_sqlalchemy
+    def test_packs_are_cut_by_position_in_soils_list(self):
+        serial_folder, _ = write_mukey_runs([5, 1, 3, 2, 6], pack_size=2)
+        parallel_folder, _ = write_mukey_runs([5, 1, 3, 2, 6], pack_size=2, num_workers=2)
+        serial_files = read_apsim_files(serial_folder)
+        self.assertEqual(read_apsim_files(parallel_folder), serial_files)
+        packs = {}
+        for name in serial_files:
+            root = parse(os.path.join(serial_folder, name)).getroot()
+            packs[name] = [sim.get("name").split("_")[3] for sim in root.iter("simulation")]
+        self.assertEqual(packs, {"f_cfs_pack_0.apsim": ["5", "1"], "f_cfs_pack_1.apsim": ["3", "2"], "f_cfs_pack_2.apsim": ["6"]})
+
+    @needs_sqlalchemy
+    def test_bad_rotation_or_years_are_reported_without_touching_the_folder(self):
+        tar_folder = tempfile.mkdtemp()
+        folder, _ = write_mukey_runs([1, 2], tar_folder)
+        _, failures = write_mukey_runs([1, 2], tar_folder, start_year=2016)
+        self.assertEqual([failure["mukey"] for failure in failures], [1, 2])
+        self.assertIn("divisble by 3", failures[0]["error"])
+        _, failures = write_mukey_runs([1, 2], tar_folder, rotation="corn")
+        self.assertIn("Unknown rotation corn", failures[1]["error"])
+        self.assertEqual(sorted(read_apsim_files(folder)), ["f_1_cfs.apsim", "f_2_cfs.apsim"])
+        self.assertEqual(len(load_run_manifest(folder).job_files()), 2)
+
+    @needs_sqlalchemy
+    def test_incremental_rewrite_clears_archived_outputs_and_lost_soils(self):
+        tar_folder = tempfile.mkdtemp()
+        folder, _ = write_mukey_runs(["1", "2", "3"], tar_folder, start_year=2018)
+        use_fake_backend()
+        self.addCleanup(configure_executables)
+        run_apsim.run_all_simulations(folder, n_cores=2, compress="zip")
+        out_filenames = [os.path.join(folder, f"name_f_mukey_{mukey}_rot_cfs_sim.out") for mukey in ["1", "2", "3"]]
+        self.assertEqual(list_outputs(folder), out_filenames)
+
+        def changed_soils(query, dbconn, params=None, read_soils=read_soil_properties):
+            soil_df = read_soils(query, dbconn, params)
+            soil_df.loc[soil_df["mukey"] == "2", "om_r"] = 4.0
+            return soil_df[soil_df["mukey"] != "3"]
+
+        with mock.patch.object(sys.modules[__name__], "read_soil_properties", changed_soils):
+            _, failures = write_mukey_runs(["1", "2", "3"], tar_folder, start_year=2018, incremental=True)
+        self.assertEqual(failures, [{"mukey": "3", "error": "soil not found"}])
+        self.assertEqual(list_outputs(folder), out_filenames[:1])
+        self.assertEqual(sorted(read_apsim_files(folder)), ["f_1_cfs.apsim", "f_2_cfs.apsim"])
+        manifest = load_run_manifest(folder)
+        self.assertEqual(manifest.job(os.path.join(folder, "f_3_cfs.apsim")), None)
+        self.assertEqual(manifest.job_files(status="pending"), [os.path.join(folder, "f_2_cfs.apsim")])
+
+    def test_template_renders_the_bytes_of_a_simulation_built_from_scratch(self):
+        sim_settings = {
+            "field_name": "f",
+            "rotation": "cfs",
+            "met_name": "m.met",
+            "met_path": "met_files/m.met",
+            "start_year": 2015,
+            "end_year": 2018,
+            "sfc_mgmt": management("soybean"),
+            "cfs_mgmt": management("maize"),
+            "maize_xml": "maize.xml",
+            "soy_xml": "soy.xml",
+        }
+        template = SimulationTemplate(sim_settings)
+        for soil_id in ["123", "a&b\"<c>'d\u00e9"]:
+            soil_df = pd.DataFrame(soil_horizons(soil_id))
+            expected_sim = build_mukey_simulation(soil_id, Soil(soil_df.copy()).soil_xml(), **sim_settings)
+            sim = template.render(soil_id, soil_df.copy())
+            self.assertEqual(sim, tostring(expected_sim, encoding="us-ascii"))
+            self.assertEqual(fromstring(sim).get("name"), f"name_f_mukey_{soil_id}_rot_cfs_sim")
+            # written as a pack of two, as ElementTree writes the folder
+            folder = Element("folder", {"version": "36", "creator": "C-CHANGE Foresite", "name": "f"})
+            folder.extend([expected_sim, expected_sim])
+            expected_filename = os.path.join(tempfile.mkdtemp(), "expected.apsim")
+            ElementTree(folder).write(expected_filename)
+            filename = os.path.join(tempfile.mkdtemp(), "pack.apsim")
+            template.write(filename, [sim, sim])
+            with open(filename, "rb") as written, open(expected_filename, "rb") as expected:
+                self.assertEqual(written.read(), expected.read())
+
+    def test_cached_management_matches_uncached_for_numpy_values(self):
+        # management read from a dataframe has numpy and pandas values
+        mgmt_df = pd.DataFrame([management("maize")])
+        cfs_mgmt = {key: mgmt_df[key].iloc[0] for key in mgmt_df.columns}
+        self.assertIsInstance(cfs_mgmt["kg_n_ha"], np.int64)
+        sfc_mgmt = dict(management("soybean"), tillage_depth=np.float64(100.0))
+        expected = tostring(build_management_xml("cfs", 2015, 2018, sfc_mgmt, cfs_mgmt), encoding="us-ascii")
+        for _ in range(2):
+            self.assertEqual(tostring(management_xml("cfs", 2015, 2018, sfc_mgmt, cfs_mgmt), encoding="us-ascii"), expected)
+        # a str amount builds different operations, so it doesn't share the numpy amount's cache entry
+        self.assertNotEqual(management_key(cfs_mgmt), management_key(dict(cfs_mgmt, kg_n_ha="150")))
+
+
+class TestSimScheduler(unittest.TestCase):
+    def test_bounded_in_flight(self):
+        lock = threading.Lock()
+        state = {"running": 0, "peak": 0}
+
+        def job(i):
+            with lock:
+                state["running"] += 1
+                state["peak"] = max(state["peak"], state["running"])
+            time.sleep(0.01)
+            with lock:
+                state["running"] -= 1
+            return i * 2
+
+        done = []
+        with SimScheduler(num_workers=2, max_in_flight=3) as scheduler:
+            futures = [scheduler.submit(job, i, callback=lambda f: done.append(f.result())) for i in range(10)]
+        self.assertEqual([f.result() for f in futures], [i * 2 for i in range(10)])
+        self.assertEqual(sorted(done), [i * 2 for i in range(10)])
+        self.assertLessEqual(state["peak"], 2)
+
+
+class TestProgress(unittest.TestCase):
+    def test_scheduler_counts_jobs_and_metrics_are_served(self):
+        tracker = ProgressTracker("test", total=4)
+
+        def job(i):
+            if i == 3:
+                raise ValueError("failed job")
+
+        with SimScheduler(2, progress=tracker) as scheduler:
+            for i in range(4):
+                scheduler.submit(job, i)
+        snapshot = tracker.snapshot()
+        self.assertEqual((snapshot["done"], snapshot["failed"], snapshot["running"], snapshot["eta"]), (3, 1, 0, 0))
+        self.assertIn("test 4/4 (1 failed)", tracker.format_line())
+        server = serve_metrics(0)
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+                text = response.read().decode()
+        finally:
+            server.shutdown()
+        self.assertIn('foresite_jobs_failed_total{stage="test"} 1', text)
+        self.assertIn('foresite_worker_utilization{stage="test",worker="apsim-worker', text)
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+    def test_target_follows_measured_job_memory(self):
+        with SimScheduler(num_workers=8) as scheduler:
+            controller = AdaptiveConcurrency(scheduler, headroom=0.0, job_memory=100)
+            self.assertEqual(controller.target_workers({}, available=450, limit=1000), 4)
+            controller.peak_job_rss = 200
+            # two running jobs already hold 400 bytes
+            self.assertEqual(controller.target_workers({1: 200, 2: 200}, available=200, limit=1000), 3)
+            self.assertEqual(controller.target_workers({}, available=10, limit=1000), 1)
+            scheduler.set_concurrency(100)
+            self.assertEqual(scheduler.concurrency, 8)
+
+
+class TestRetry(unittest.TestCase):
+    def test_retries_until_log_complete(self):
+        sim_filename = os.path.join(tempfile.mkdtemp(), "name_field_mukey_1_rot_cc_sim.sim")
+        attempts = []
+
+        def fake_run(filename, lock=None, stats=None):
+            attempts.append(filename)
+            with open(run_apsim.get_log_filename(filename), "w") as log:
+                log.write("100%\n" if len(attempts) == 3 else "42%\n")
+            return 0
+
+        original = run_apsim.run_a_sim
+        run_apsim.run_a_sim = fake_run
+        try:
+            policy = run_apsim.RetryPolicy(max_attempts=3, backoff=0.0)
+            self.assertEqual(run_apsim.run_with_retry("simulate", sim_filename, policy), 3)
+            attempts.clear()
+            with self.assertRaises(run_apsim.SimFailed) as failed:
+                run_apsim.run_with_retry("simulate", sim_filename, run_apsim.RetryPolicy(max_attempts=2, backoff=0.0))
+            self.assertEqual(failed.exception.records[0]["reason"], "incomplete")
+            self.assertEqual(failed.exception.records[0]["attempts"], 2)
+        finally:
+            run_apsim.run_a_sim = original
+
+
+class TestSimCache(unittest.TestCase):
+    def write_apsim(self, folder, met_text):
+        with open(os.path.join(folder, "weather.met"), "w") as met:
+            met.write(met_text)
+        apsim_filename = os.path.join(folder, "field.apsim")
+        with open(apsim_filename, "w") as apsim_file:
+            apsim_file.write(
+                '<folder name="field"><simulation name="sim"><metfile><filename input="yes">weather.met</filename></metfile>'
+                '<area><outputfile><filename output="yes">sim.out</filename></outputfile></area></simulation></folder>'
+            )
+        return apsim_filename
+
+    def test_key_follows_met_contents_and_lru_eviction(self):
+        folder = tempfile.mkdtemp()
+        apsim_filename = self.write_apsim(folder, "year day rain\n")
+        key_one = hash_simulation(apsim_filename)
+        self.assertEqual(key_one, hash_simulation(apsim_filename))
+        key_two = hash_simulation(self.write_apsim(folder, "year day rain maxt\n"))
+        self.assertNotEqual(key_one, key_two)
+
+        out_filename = os.path.join(folder, "sim.out")
+        cache = SimCache(os.path.join(folder, "cache"), max_bytes=150)
+        for key in [key_one, key_two]:
+            with open(out_filename, "w") as out_file:
+                out_file.write(key + "\n")
+            cache.put(key, [out_filename])
+        # both entries fit; a third pushes out the least recently used one
+        self.assertTrue(cache.get(key_one, [out_filename]))
+        cache.put("third", [out_filename])
+        self.assertFalse(cache.get(key_two, [out_filename]))
+        self.assertTrue(cache.get(key_one, [out_filename]))
+        with open(out_filename) as out_file:
+            self.assertEqual(out_file.read(), key_one + "\n")
+
+
+class TestExecutableRegistry(unittest.TestCase):
+    def test_explicit_paths_and_launcher(self):
+        registry = ExecutableRegistry(apsim_exe="/opt/apsim/Model/Apsim.exe", to_sim_exe="/bin/true", launcher="mono --debug")
+        self.assertEqual(registry.apsim_command(), ["mono", "--debug", "/opt/apsim/Model/Apsim.exe"])
+        self.assertEqual(registry.to_sim_command(), ["mono", "--debug", "/bin/true"])
+
+    def test_apsim_home_and_missing_exe(self):
+        registry = ExecutableRegistry(apsim_home="/opt/APSIM710", launcher=[])
+        self.assertEqual(registry.apsim_command(), [os.path.join("/opt/APSIM710", "Model", "Apsim.exe")])
+        with self.assertRaises(FileNotFoundError):
+            ExecutableRegistry(launcher=[])._command("Missing.exe", None, "FORESITE_TEST_UNSET")
+
+
+class TestFakeBackend(unittest.TestCase):
+    def tearDown(self):
+        configure_executables()
+
+    def test_pipeline_runs_against_fake_apsim(self):
+        folder = tempfile.mkdtemp()
+        apsim_filenames = write_fake_batch(folder, 3, start_year=2017, end_year=2018)
+        use_fake_backend()
+        ledger_path = os.path.join(folder, "run_ledger.jsonl")
+        results = run_apsim.run_pipeline(apsim_filenames, num_cores=2, manifest_path=os.path.join(folder, run_apsim.FAILURE_MANIFEST), ledger=RunLedger(ledger_path))
+        self.assertEqual(len(results), 3)
+        summary = summarize_ledger(ledger_path)
+        self.assertEqual(summary["jobs"], 3)
+        self.assertEqual(summary["failed"], 0)
+        self.assertEqual(sorted(summary["slowest"]["mukey"]), ["0", "1", "2"])
+        for apsim_filename in apsim_filenames:
+            for out_filenames in run_apsim.get_sim_outputs(apsim_filename).values():
+                df = run_apsim.parse_all_output(out_filenames[0])
+                self.assertEqual(len(df), 730)
+                self.assertEqual(sorted(df["year"].unique()), [2017, 2018])
+        self.assertEqual(run_apsim.load_failure_manifest(os.path.join(folder, run_apsim.FAILURE_MANIFEST)), [])
+
+    def test_batch_ledger_records_conversions(self):
+        folder = tempfile.mkdtemp()
+        apsim_filenames = write_fake_batch(folder, 2, start_year=2018, end_year=2018)
+        use_fake_backend()
+        run_apsim.run_all_simulations(folder, n_cores=2, ledger=True)
+        records = read_ledger(os.path.join(folder, "run_ledger.jsonl"))
+        converts = records[records["job"].str.endswith(".apsim")]
+        self.assertEqual(sorted(converts["job"]), sorted(apsim_filenames))
+        self.assertTrue((converts["convert_seconds"] > 0).all())
+        self.assertTrue(converts["queue_wait"].notna().all())
+        self.assertEqual(len(records[records["job"].str.endswith(".sim")]), 2)
+
+    def test_cache_hit_leaves_the_files_of_a_fresh_run(self):
+        folder = tempfile.mkdtemp()
+        apsim_filename = write_fake_batch(folder, 1, start_year=2018, end_year=2018)[0]
+        use_fake_backend()
+        cache = SimCache(os.path.join(folder, "cache"))
+
+        def outputs():
+            return sorted(name for name in os.listdir(folder) if is_output(name))
+
+        run_apsim.convert_and_run(apsim_filename, cache=cache, compress="gzip")
+        fresh = outputs()
+        self.assertEqual(fresh, ["name_field_mukey_0_rot_cfs_sim.out.gz", "name_field_mukey_0_rot_cfs_sim.sum.gz"])
+        remove_outputs(folder)
+        with mock.patch.object(run_apsim, "convert_and_simulate", side_effect=AssertionError("ran instead of restoring")):
+            run_apsim.convert_and_run(apsim_filename, cache=cache, compress="gzip")
+        self.assertEqual(outputs(), fresh)
+
+    def test_native_converter_feeds_fake_apsim(self):
+        folder = tempfile.mkdtemp()
+        apsim_filename = write_fake_batch(folder, 1, start_year=2017, end_year=2018)[0]
+        tree = parse(apsim_filename)
+        area = tree.getroot().find("simulation/area")
+        soil = SubElement(area, "Soil")
+        SubElement(SubElement(soil, "InitialWater"), "FractionFull").text = "0.5"
+        water = SubElement(soil, "Water")
+        for tag, values in [("Thickness", ["100", "200"]), ("LL15", ["0.1", "0.2"]), ("DUL", ["0.3", "0.4"])]:
+            node = SubElement(water, tag)
+            for value in values:
+                SubElement(node, "double").text = value
+        SubElement(soil, "SoilWater").append(water.find("Thickness"))
+        tree.write(apsim_filename)
+        use_fake_backend()
+        run_apsim.use_native_converter()
+        self.addCleanup(run_apsim.use_native_converter, None)
+        self.assertEqual(run_apsim.run_with_retry("convert", apsim_filename), 1)
+        self.assertIn("Written", run_apsim.read_log_tail(run_apsim.get_log_filename(apsim_filename))[0])
+        sim_filename = run_apsim.get_sim_filenames(apsim_filename)[0]
+        soil_water = parse(sim_filename).getroot().find(".//component[@class='SoilWat']/initdata")
+        self.assertEqual(soil_water.findtext("dlayer"), "100 200")
+        # half full from the top: the first layer's 20 mm fill up, then 10 of the second's 40 mm
+        self.assertEqual(soil_water.findtext("sw"), "0.300 0.250")
+        run_apsim.run_with_retry("simulate", sim_filename)
+        self.assertEqual(len(run_apsim.parse_all_output(get_out_filenames(sim_filename)[0])), 730)
+
+    def test_folder_of_sim_files_runs_without_converting(self):
+        folder = tempfile.mkdtemp()
+        apsim_filenames = write_fake_batch(folder, 2, start_year=2017, end_year=2018)
+        sim_filenames, errors = convert_many(apsim_filenames)
+        self.assertEqual(errors, {})
+        for apsim_filename in apsim_filenames:
+            os.remove(apsim_filename)
+        use_fake_backend()
+        run_apsim.run_all_simulations(folder, n_cores=2)
+        for sim_filename in sim_filenames:
+            self.assertEqual(len(run_apsim.parse_all_output(get_out_filenames(sim_filename)[0])), 730)
+
+    @needs_sqlalchemy
+    def test_written_sim_files_run_per_file(self):
+        ini_folder = tempfile.mkdtemp()
+        for name in ["maize.xml", "soy.xml"]:
+            with open(os.path.join(ini_folder, name), "w") as ini_file:
+                ini_file.write("<type><Model><x>1</x></Model></type>")
+        folder, failures = write_mukey_runs(
+            ["1", "2"], output_format="sim", start_year=2018, maize_xml=os.path.join(ini_folder, "maize.xml"), soy_xml=os.path.join(ini_folder, "soy.xml")
+        )
+        self.assertEqual(failures, [])
+        out_filenames = sorted(os.path.join(folder, f"name_f_mukey_{mukey}_rot_cfs_sim.out") for mukey in ["1", "2"])
+        use_fake_backend()
+        results = run_apsim.run_all_simulations(folder, n_cores=2, stream=True)
+        self.assertEqual(sorted(out_filename for out_filename, _ in results), out_filenames)
+        run_apsim.run_all_simulations(folder, n_cores=2, scratch=tempfile.mkdtemp())
+        self.assertEqual(len(load_run_manifest(folder).job_files(status="ok")), 2)
+        # without a manifest the .sim files are found in the folder
+        os.remove(os.path.join(folder, "run_manifest.json"))
+        run_apsim.run_all_simulations(folder, n_cores=2, scratch=tempfile.mkdtemp())
+        for out_filename in out_filenames:
+            self.assertEqual(len(run_apsim.parse_all_output(out_filename)), 365)
+
+    def test_run_manifest_drives_runner_and_parser(self):
+        folder = tempfile.mkdtemp()
+        apsim_filenames = write_fake_batch(folder, 2, start_year=2017, end_year=2018)
+        manifest = build_run_manifest(folder, field="field", rotation="cfs", end_year=2018)
+        self.assertEqual(sorted(manifest.job_files(status="pending")), sorted(apsim_filenames))
+        # not in the manifest, so not part of the batch
+        write_fake_batch(os.path.join(folder, "other"), 1)
+        os.replace(os.path.join(folder, "other", "field_0_cfs.apsim"), os.path.join(folder, "stray.apsim"))
+        use_fake_backend()
+        run_apsim.run_all_simulations(folder, n_cores=2)
+        manifest = load_run_manifest(folder)
+        self.assertEqual(sorted(manifest.job_files(status="ok")), sorted(apsim_filenames))
+        self.assertFalse(os.path.exists(os.path.join(folder, "stray.tmp")))
+        self.assertEqual(len(parse_manifest_output(folder)), 2 * 730)
+        self.assertEqual(len(parse_manifest_output(folder, new_only=True)), 0)
+
+    def test_incremental_run_only_runs_rewritten_jobs(self):
+        folder = tempfile.mkdtemp()
+        apsim_filenames = sorted(write_fake_batch(folder, 2, start_year=2018, end_year=2018))
+        build_run_manifest(folder)
+        use_fake_backend()
+        run_apsim.run_all_simulations(folder, n_cores=2)
+        out_filenames = [os.path.join(folder, f"name_field_mukey_{i}_rot_cfs_sim.out") for i in range(2)]
+        mtimes = [os.stat(f).st_mtime_ns for f in out_filenames]
+        # a rewritten file is pending again
+        manifest = load_run_manifest(folder)
+        manifest.add_job(apsim_filenames[1], input_hash="changed")
+        manifest.save()
+        self.assertEqual([job["job"] for job in manifest.unfinished_jobs()], [apsim_filenames[1]])
+        time.sleep(0.01)
+        run_apsim.run_all_simulations(folder, n_cores=2, incremental=True)
+        self.assertEqual(os.stat(out_filenames[0]).st_mtime_ns, mtimes[0])
+        self.assertNotEqual(os.stat(out_filenames[1]).st_mtime_ns, mtimes[1])
+        manifest = load_run_manifest(folder)
+        self.assertEqual(sorted(manifest.job_files(status="ok")), apsim_filenames)
+        self.assertEqual(manifest.job(apsim_filenames[1])["input_hash"], "changed")
+
+    def test_annual_summary_profile_parses_like_daily_output(self):
+        folder = tempfile.mkdtemp()
+        write_fake_batch(folder, 1, start_year=2017, end_year=2018, output_profile="annual-summary")
+        use_fake_backend()
+        run_apsim.run_all_simulations(folder, n_cores=1)
+        out_filename = os.path.join(folder, "name_field_mukey_0_rot_cfs_sim.out")
+        self.assertEqual(list(run_apsim.parse_all_output(out_filename)["date"]), ["31/12/2017", "31/12/2018"])
+        summary = parse_summary_output(out_filename)
+        self.assertEqual(list(summary["year"]), [2017, 2018])
+        self.assertIn("max of maize.yield on end_of_day from reported to now as maize_yield", output_profile("annual-summary")[0])
+
+    def test_compressed_and_archived_outputs_parse_transparently(self):
+        folder = tempfile.mkdtemp()
+        write_fake_batch(folder, 2, start_year=2018, end_year=2018)
+        build_run_manifest(folder)
+        use_fake_backend()
+        run_apsim.run_all_simulations(folder, n_cores=2, compress="gzip")
+        self.assertEqual(glob(os.path.join(folder, "*.out")) + glob(os.path.join(folder, "*.sum")), [])
+        self.assertEqual(len(glob(os.path.join(folder, "*.out.gz"))), 2)
+        self.assertEqual(len(load_run_manifest(folder).job_files(status="ok")), 2)
+        self.assertEqual(len(parse_manifest_output(folder)), 2 * 365)
+        out_filename = list_outputs(folder)[0]
+        self.assertEqual(len(run_apsim.parse_all_output(out_filename)), 365)
+        self.assertEqual(archive_outputs(folder), 4)
+        self.assertEqual(glob(os.path.join(folder, "*.gz")), [])
+        self.assertEqual(len(run_apsim.parse_all_output(out_filename)), 365)
+        self.assertEqual(len(parse_summary_output(out_filename)), 1)
+
+    def test_scratch_runs_publish_into_folder(self):
+        folder = tempfile.mkdtemp()
+        scratch_root = tempfile.mkdtemp()
+        apsim_filenames = write_fake_batch(folder, 2, start_year=2018, end_year=2018)
+        use_fake_backend()
+        results = run_apsim.run_pipeline(apsim_filenames, num_cores=2, scratch=scratch_root)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(os.listdir(scratch_root), [])
+        for apsim_filename in apsim_filenames:
+            for sim_filename, out_filenames in run_apsim.get_sim_outputs(apsim_filename).items():
+                self.assertTrue(os.path.exists(sim_filename))
+                self.assertEqual(len(run_apsim.parse_all_output(out_filenames[0])), 365)
+        self.assertEqual([f for f in os.listdir(folder) if f.endswith(".partial")], [])
+
+    def test_failed_scratch_runs_only_publish_logs(self):
+        folder = tempfile.mkdtemp()
+        scratch_root = tempfile.mkdtemp()
+        apsim_filenames = write_fake_batch(folder, 4, start_year=2018, end_year=2018)
+        use_fake_backend(failure_rate=1.0)
+        manifest_path = os.path.join(folder, run_apsim.FAILURE_MANIFEST)
+        policy = run_apsim.RetryPolicy(max_attempts=2, backoff=0.0)
+        results = run_apsim.run_pipeline(apsim_filenames, num_cores=2, scratch=scratch_root, policy=policy, manifest_path=manifest_path)
+        self.assertEqual(results, {})
+        self.assertEqual(os.listdir(scratch_root), [])
+        self.assertEqual(list_outputs(folder), [])
+        failures = run_apsim.load_failure_manifest(manifest_path)
+        self.assertEqual(len(failures), 4)
+        for failure in failures:
+            self.assertTrue(os.path.exists(run_apsim.get_log_filename(failure["file"])))
+
+    def test_packed_runs_use_one_process_per_pack(self):
+        folder = tempfile.mkdtemp()
+        apsim_filenames = write_fake_batch(folder, 5, start_year=2018, end_year=2018, pack_size=2)
+        self.assertEqual(len(apsim_filenames), 3)
+        use_fake_backend()
+        results = run_apsim.run_pipeline(apsim_filenames, num_cores=2, packed=True)
+        self.assertEqual(sum(len(sims) for sims in results.values()), 5)
+        self.assertEqual(glob(os.path.join(folder, "*.sim")), [])
+        df = parse_pack_output(apsim_filenames[0])
+        self.assertEqual(sorted(df["mukey"].unique()), ["0", "1"])
+        self.assertEqual(len(df), 730)
+
+    def test_cancelled_batch_resumes_from_checkpoint(self):
+        folder = tempfile.mkdtemp()
+        write_fake_batch(folder, 6, start_year=2018, end_year=2018)
+        use_fake_backend(latency=0.3)
+        threading.Timer(0.5, run_apsim.cancel_runs).start()
+        run_apsim.run_all_simulations(folder, n_cores=2)
+        checkpoint = Checkpoint(os.path.join(folder, CHECKPOINT_FILENAME))
+        self.assertLess(len(checkpoint.completed("convert")), 6)
+        self.assertEqual(run_apsim.load_failure_manifest(os.path.join(folder, run_apsim.FAILURE_MANIFEST)), [])
+        run_apsim.resume(folder, n_cores=2)
+        self.assertEqual(len(checkpoint.completed("simulate")), 6)
+        self.assertEqual(len(glob(os.path.join(folder, "*.out"))), 6)
+
+    def test_cancellation_ends_with_its_batch(self):
+        folder = tempfile.mkdtemp()
+        apsim_filenames = write_fake_batch(folder, 2, start_year=2018, end_year=2018)
+        use_fake_backend()
+        manifest_path = os.path.join(folder, run_apsim.FAILURE_MANIFEST)
+        failures = [{"stage": "convert", "file": f, "reason": "exit_code", "returncode": 1, "attempts": 3, "log_tail": []} for f in apsim_filenames]
+        run_apsim.write_failure_manifest(manifest_path, failures)
+        # a cancel with no batch running doesn't stop later batches
+        run_apsim.cancel_runs()
+        self.assertEqual(run_apsim.rerun_failed(folder, n_cores=2), [])
+        self.assertEqual(len(glob(os.path.join(folder, "*.out"))), 2)
+        run_apsim.cancel_runs()
+        self.assertEqual(len(run_apsim.run_pipeline(apsim_filenames, num_cores=2)), 2)
+        self.assertFalse(run_apsim.run_cancelled())
+        # files a cancelled rerun didn't get to keep their failure records
+        run_apsim.write_failure_manifest(manifest_path, failures)
+        with mock.patch.object(run_apsim, "run_pipeline", side_effect=lambda *args, **kwargs: run_apsim.cancel_runs()):
+            self.assertEqual(run_apsim.rerun_failed(folder, n_cores=2), failures)
+        self.assertEqual(run_apsim.load_failure_manifest(manifest_path), failures)
+        self.assertEqual(len(list(run_apsim.run_all_simulations(folder, n_cores=2, stream=True))), 2)
+
+    def test_async_runner_streams_logs_and_results(self):
+        folder = tempfile.mkdtemp()
+        apsim_filenames = write_fake_batch(folder, 3, start_year=2018, end_year=2018)
+        use_fake_backend()
+        run_apsim.convert_all_apsim_to_sim(apsim_filenames, num_cores=2)
+        sim_filenames = sorted(glob(os.path.join(folder, "*.sim")))
+        lines = []
+
+        async def collect():
+            return [result async for result in iter_sims_async(sim_filenames, concurrency=2, on_line=lambda f, line: lines.append(line))]
+
+        results = asyncio.run(collect())
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(len(df) == 365 for _, df in results))
+        self.assertEqual(lines.count("100%"), 3)
+        self.assertEqual(glob(os.path.join(folder, "*_sim.tmp")), [])
+        use_fake_backend(failure_rate=1.0)
+        failures = asyncio.run(run_sims_async(sim_filenames[:1], policy=run_apsim.RetryPolicy(max_attempts=2, backoff=0.0)))
+        self.assertEqual(failures[0]["attempts"], 2)
+
+
+class TestJobQueue(unittest.TestCase):
+    def test_expired_lease_is_taken_over(self):
+        queue = JobQueue(os.path.join(tempfile.mkdtemp(), "queue.db"), lease_seconds=0.05, max_attempts=2)
+        self.assertEqual(queue.enqueue(["a.apsim", "b.apsim"]), 2)
+        self.assertEqual(queue.enqueue(["a.apsim"]), 0)
+        job_id, _ = queue.lease("node-1")
+        time.sleep(0.1)
+        # node-1 missed its heartbeat, so node-2 gets the same job and node-1 can't complete it
+        self.assertEqual(queue.lease("node-2")[0], job_id)
+        self.assertFalse(queue.heartbeat(job_id, "node-1"))
+        self.assertFalse(queue.complete(job_id, "node-1"))
+        self.assertTrue(queue.complete(job_id, "node-2"))
+        other_id, _ = queue.lease("node-2")
+        time.sleep(0.1)
+        queue.lease("node-3")
+        time.sleep(0.1)
+        # expired max_attempts times
+        self.assertEqual(queue.lease("node-3"), None)
+        self.assertEqual(queue.counts(), {"pending": 0, "leased": 0, "done": 1, "failed": 1})
+        self.assertEqual(queue.failures()[0]["reason"], "lease_expired")
+
+    def test_worker_cancels_job_whose_lease_was_taken_over(self):
+        folder = tempfile.mkdtemp()
+        apsim_filename = write_fake_batch(folder, 1, start_year=2018, end_year=2018)[0]
+        queue_path = os.path.join(folder, "queue.db")
+        queue = JobQueue(queue_path)
+        queue.enqueue([apsim_filename])
+        use_fake_backend(latency=10.0)
+        self.addCleanup(configure_executables)
+        ledger_path = os.path.join(folder, "run_ledger.jsonl")
+        finished = []
+        worker = threading.Thread(target=lambda: finished.append(run_worker(queue_path, "slow", num_cores=1, ledger=RunLedger(ledger_path), lease_seconds=0.3, poll=0.05)))
+        worker.start()
+        while queue.counts()["leased"] == 0:
+            time.sleep(0.01)
+        # another worker takes the job over, as if the lease had expired
+        with sqlite3.connect(queue_path) as conn:
+            conn.execute("update jobs set worker = 'fast', lease_expires = ?", (time.time() + 60,))
+            job_id = conn.execute("select id from jobs").fetchone()[0]
+        deadline = time.time() + 5
+        while not os.path.exists(ledger_path) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(list(read_ledger(ledger_path)["status"]), ["cancelled"])
+        self.assertTrue(queue.complete(job_id, "fast"))
+        worker.join(timeout=10)
+        self.assertEqual(finished, [0])
+        self.assertEqual(glob(os.path.join(folder, "*.sim")), [])
+
+    def test_worker_processes_share_queue(self):
+        folder = tempfile.mkdtemp()
+        write_fake_batch(folder, 6, start_year=2018, end_year=2018)
+        queue_path = os.path.join(folder, "queue.db")
+        src = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "foresite")
+        fake = os.path.join(src, "apsim", "fake_apsim.py")
+        env = dict(os.environ, PYTHONPATH=src, APSIM_LAUNCHER=f"{sys.executable} {fake}", APSIM_EXE="run", APSIM_TO_SIM_EXE="convert")
+        subprocess.run([sys.executable, "-m", "apsim.job_queue", "enqueue", queue_path, folder], env=env, check=True, stdout=subprocess.DEVNULL)
+        workers = [
+            subprocess.Popen([sys.executable, "-m", "apsim.job_queue", "work", queue_path, "--cores", "2", "--poll", "0.1"], env=env, stdout=subprocess.DEVNULL) for _ in range(2)
+        ]
+        for worker in workers:
+            self.assertEqual(worker.wait(timeout=120), 0)
+        self.assertEqual(JobQueue(queue_path).counts()["done"], 6)
+        self.assertEqual(len(glob(os.path.join(folder, "*.out"))), 6)
+
+
+class TestJobCost(unittest.TestCase):
+    def test_longest_first_with_priorities_and_history(self):
+        folder = tempfile.mkdtemp()
+        short = write_fake_batch(os.path.join(folder, "short"), 1, start_year=2018, end_year=2018)[0]
+        long = write_fake_batch(os.path.join(folder, "long"), 1, start_year=2010, end_year=2018)[0]
+        self.assertEqual(order_by_cost([short, long]), [long, short])
+        self.assertEqual(order_by_cost([short, long], priorities={short: 1}), [short, long])
+        # measured run times win over the estimate
+        self.assertEqual(order_by_cost([short, long], history={short: 100.0, long: 1.0}), [short, long])
+
+    def test_queue_leases_by_priority_then_cost(self):
+        queue = JobQueue(os.path.join(tempfile.mkdtemp(), "queue.db"))
+        queue.enqueue(["a.apsim", "b.apsim"], costs={"a.apsim": 1.0, "b.apsim": 5.0})
+        queue.enqueue(["field.apsim"], priority=10, costs={"field.apsim": 0.5})
+        leased = [os.path.basename(queue.lease("node")[1]) for _ in range(3)]
+        self.assertEqual(leased, ["field.apsim", "b.apsim", "a.apsim"])
+        # an expired lease competes with pending jobs by priority
+        with sqlite3.connect(queue.path) as conn:
+            conn.execute("update jobs set lease_expires = 0")
+        queue.enqueue(["low.apsim"], costs={"low.apsim": 100.0})
+        self.assertEqual(os.path.basename(queue.lease("node")[1]), "field.apsim")
+        # pending and expired jobs are read from the index, not by scanning and sorting the table
+        with sqlite3.connect(queue.path) as conn:
+            plan = [row[3] for row in conn.execute("explain query plan " + LEASE_QUERY, (0.0,))]
+        self.assertEqual(len([step for step in plan if "USING INDEX jobs_lease_order" in step]), 2)
+        self.assertNotIn("SCAN jobs", plan)